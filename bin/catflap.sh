@@ -58,9 +58,20 @@ python3 ./src/catflap/main.py --stream $STREAM \
                 --web $WEBSITE
 }
 
-until run_command; do
-    echo "Program stopped with exit code $?. Restarting" >&2
-    sleep 10
+# The flap is not protected until it is running again, so restart straight away.
+# Only if it keeps crashing soon after starting wait longer each time, up to 30s
+DELAY=0
+while true; do
+    STARTED=$SECONDS
+    run_command && break
+    CODE=$?
+    if (( SECONDS - STARTED > 60 )); then
+        DELAY=0
+    else
+        DELAY=$(( DELAY == 0 ? 1 : (DELAY * 2 > 30 ? 30 : DELAY * 2) ))
+    fi
+    echo "Program stopped with exit code $CODE. Restarting in ${DELAY}s" >&2
+    sleep $DELAY
 done
                 
 
@@ -1,5 +1,8 @@
 from abc import ABC, abstractmethod
 from array import array
+import numpy as np
+
+from pixelformat import PixelFormat
 
 class AbstractImageSource(ABC):
     def __init__(self, **kwargs):
@@ -13,7 +16,19 @@ class AbstractImageSource(ABC):
     @property
     def isopen(self) -> bool:
         return self._isopen
-    
+
+    @property
+    def frame_rate(self) -> float:
+        '''The native frame rate of the source, or 0 for a live source that
+        delivers frames at its own pace'''
+        return 0
+
+    @property
+    def pixel_format(self) -> PixelFormat:
+        '''The channel order of the frames from this source in memory. OpenCV
+        sources are BGR'''
+        return PixelFormat.BGR
+
     @staticmethod
     @abstractmethod
     def can_supply_images(source: str) -> bool:
@@ -33,7 +48,16 @@ class AbstractImageSource(ABC):
         return 0
 
     @abstractmethod
-    def get_image(self) -> array:
-        '''Gets the next image from an image source
-        Returns the image, or None when there are no more'''
+    def get_image(self, out=None) -> array:
+        '''Gets the next image from an image source, into out when it is given
+        and the right shape. Returns the image, or None when there are no more'''
         return None
+
+    @staticmethod
+    def _into(frame, out) -> array:
+        '''Copy the frame into out if it fits, for sources that cannot capture
+        straight into a given buffer'''
+        if frame is None or out is None or out.shape != frame.shape or out.dtype != frame.dtype:
+            return frame
+        np.copyto(out, frame)
+        return out
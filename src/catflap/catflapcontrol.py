@@ -1,4 +1,5 @@
 from base_logger import logger
+from pipeline_metrics import metrics
 import platform
 CPU = platform.processor()
 from base_logger import logger
@@ -7,11 +8,16 @@ from base_logger import logger
 
 
 # A messy attempt at platform independence
+GPIO = None
 if CPU == "i386":
     # This is the non-ARM case, a desktop system
     pass
 else:
-    import RPi.GPIO as GPIO
+    try:
+        import RPi.GPIO as GPIO
+    except ImportError:
+        # Some other desktop system, ie. Linux on x86_64
+        logger.warning(f"RPi.GPIO not available on {CPU}, the cat flap will not be controlled")
 
 GPIO_PIN = 21
 
@@ -20,17 +26,23 @@ class CatFlapControl():
     '''Control the relay that enables or disables the cat flap.
     When GPIO is LOW then the NC connections on the relay are closed.
     This means that normally the GPIO will be LOW and when it is necessary
-    to lock the cat flap then the GPIO will be driven HIGH'''
-    def __init__(self) -> None:
+    to lock the cat flap then the GPIO will be driven HIGH.
+    Each cat flap has its own relay, on its own pin'''
+    def __init__(self, pin:int=GPIO_PIN) -> None:
         self._locked = False
+        self._pin = pin
 
-        if CPU == "i386":
+        if GPIO == None:
             pass
         else:
             # Set up GPIO
             GPIO.setmode(GPIO.BCM)
-            GPIO.setup(GPIO_PIN, GPIO.OUT)
-            GPIO.output(GPIO_PIN, GPIO.LOW)
+            GPIO.setup(self._pin, GPIO.OUT)
+            GPIO.output(self._pin, GPIO.LOW)
+
+    @property
+    def pin(self) -> int:
+        return self._pin
 
     @property
     def locked(self) -> bool:
@@ -38,37 +50,41 @@ class CatFlapControl():
 
     @property
     def gpio_state(self) -> int:
-        if CPU == "i386":
+        if GPIO == None:
             if self._locked == True: return 1 
             else: return 0
-        state = GPIO.input(GPIO_PIN)
+        state = GPIO.input(self._pin)
         return state
 
     def lock(self) -> None:
         # if self._locked == True and self.gpio_state == 1:
         #     return
+        if self._locked == False:
+            metrics.inc('flap_locks')
         self._locked = True
-        logger.debug(f"{self.__class__.__name__} locking cat flap")
-        if CPU == "i386":
+        logger.debug("%s locking cat flap", self.__class__.__name__)
+        if GPIO == None:
             pass
         else:
-            GPIO.output(GPIO_PIN, GPIO.HIGH)
+            GPIO.output(self._pin, GPIO.HIGH)
 
     def unlock(self) -> None:
         # if self._locked == False and self.gpio_state == 0:
         #     return
+        if self._locked == True:
+            metrics.inc('flap_unlocks')
         self._locked = False
-        logger.debug(f"{self.__class__.__name__} unlocking cat flap")
-        if CPU == "i386":
+        logger.debug("%s unlocking cat flap", self.__class__.__name__)
+        if GPIO == None:
             pass
         else:
-            GPIO.output(GPIO_PIN, GPIO.LOW)
+            GPIO.output(self._pin, GPIO.LOW)
 
     def exit(self) -> None:
         logger.debug(f"{self.__class__.__name__} exiting")
         self.cat_flap_unlock()
-        if CPU == "i386":
+        if GPIO == None:
             pass
         else:
-            # Clean up GPIO on program exit
-            GPIO.cleanup()
+            # Clean up GPIO on program exit, only the pin of this flap
+            GPIO.cleanup(self._pin)
@@ -0,0 +1,202 @@
+'''The labels and the evaluation thresholds, reloaded while the cat flap runs.
+
+labels.json, trigger_config.json and eval_config.json are read into a ConfigSnapshot
+- checked, and the thresholds compiled into ThresholdTables - with a version number
+that goes up with every reload. The ConfigStore holds the current snapshot. A
+background thread looks at the files every few seconds and reloads them when one has
+changed, SIGHUP (kill -HUP <pid>) reloads them straight away. A config that does not
+load or is not right is logged and the snapshot in use is kept. At startup there is
+nothing to keep, so what the old evaluation got by with - ie. a threshold for a label
+the model does not have - is only logged and left out.
+
+An episode takes the current snapshot when it starts, in triggering, and keeps it to
+the end - a reload never changes the thresholds in the middle of a decision.
+'''
+import json
+import os
+import signal
+import sys
+import time
+from enum import Enum
+from threading import Thread, Event
+
+from base_logger import logger, log_event
+from pipeline_metrics import metrics
+from evaluation import ThresholdTable
+
+
+class ConfigSnapshot():
+    '''One version of the labels and the thresholds of the triggering and the locked
+        states. Never changed once made, so it can be handed to any thread'''
+    def __init__(self, version:int, labels:list, trigger:ThresholdTable, eval:ThresholdTable) -> None:
+        self.version = version
+        self.labels = labels
+        self.trigger = trigger
+        self.eval = eval
+        self.loaded = time.time()
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__} version {self.version} labels {self.labels}"
+
+
+class ConfigStore():
+    '''Holds the current ConfigSnapshot, and makes a new one when the files change'''
+    def __init__(self, label_json:str, trigger_json:str, eval_json:str, result_enum:Enum) -> None:
+        '''Loads the files, a config that cannot be loaded at startup raises ValueError'''
+        self._files = (label_json, trigger_json, eval_json)
+        self._result_enum = result_enum
+        self._stamps = self._file_stamps()
+        self._reload = Event()
+        self._stop = None
+
+        # Counters
+        self._reloads = 0
+        self._failures = 0
+
+        self._current = self._load(1, strict=False)
+        metrics.set('config_version', self._current.version)
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__} version {self._current.version} reloads {self._reloads} failures {self._failures}"
+
+    @property
+    def current(self) -> ConfigSnapshot:
+        '''The latest good snapshot'''
+        return self._current
+
+    '''Counters'''
+    @property
+    def reloads(self) -> int:
+        return self._reloads
+
+    @property
+    def failures(self) -> int:
+        return self._failures
+
+    def _file_stamps(self) -> list:
+        '''What tells a file has changed - it may be replaced rather than written to'''
+        stamps = []
+        for name in self._files:
+            try:
+                st = os.stat(name)
+                stamps.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except OSError:
+                stamps.append(None)
+        return stamps
+
+    def _load(self, version:int, strict:bool=True) -> ConfigSnapshot:
+        '''Read, check and compile the files, see ThresholdTable for strict'''
+        loaded = []
+        for name in self._files:
+            try:
+                with open(name) as j:
+                    loaded.append(json.load(j))
+            except Exception as e:
+                raise ValueError(f"Error opening JSON {name} - {e.__class__} - {e}")
+        labels, trigger, eval = loaded
+        if isinstance(labels, dict) == False or isinstance(labels.get('labels'), list) == False \
+                or all(isinstance(l, str) for l in labels['labels']) == False:
+            raise ValueError(f"{self._files[0]} needs a list of labels")
+        labels = labels['labels']
+        tables = []
+        for name, config in zip(self._files[1:], (trigger, eval)):
+            try:
+                tables.append(ThresholdTable(labels, config, self._result_enum, strict))
+            except ValueError as e:
+                raise ValueError(f"{name} - {e}")
+            for problem in tables[-1].ignored:
+                logger.warning(f"{self.__class__.__name__} {name} - {problem}, ignored")
+        return ConfigSnapshot(version, labels, *tables)
+
+    def reload(self, changed:float=None) -> bool:
+        '''Load the files again. Returns True if there is a new snapshot. changed is when
+            the change was made, if known, for the latency'''
+        start = time.monotonic()
+        self._stamps = self._file_stamps()
+        try:
+            snapshot = self._load(self._current.version + 1)
+        except ValueError as e:
+            self._failures += 1
+            metrics.inc('config_reload_failures')
+            logger.error(f"{self.__class__.__name__} keeping version {self._current.version} - {e}")
+            return False
+        # Swapped in one go, an episode starting now gets all of the old or all of the new
+        self._current = snapshot
+        self._reloads += 1
+        seconds = time.monotonic() - start
+        latency = f", {time.time() - changed:.2f}s after the change" if changed != None else ""
+        logger.info(f"{self.__class__.__name__} loaded config version {snapshot.version} in {seconds * 1000:.1f}ms{latency}")
+        log_event('config', version=snapshot.version, seconds=round(seconds, 4),
+                  latency=round(time.time() - changed, 3) if changed != None else None)
+        metrics.observe('config_reload_seconds', seconds)
+        metrics.set('config_version', snapshot.version)
+        return True
+
+    def check(self) -> bool:
+        '''Reload if a file has changed since it was last loaded'''
+        stamps = self._file_stamps()
+        if stamps == self._stamps:
+            return False
+        changed = max((s[2] / 1e9 for s in stamps if s != None), default=None)
+        return self.reload(changed)
+
+    def request_reload(self, *args) -> None:
+        '''Reload on the watcher thread as soon as it can - also the SIGHUP handler'''
+        self._reload.set()
+
+    def install_signal(self, signum=signal.SIGHUP) -> None:
+        '''Reload whenever the signal arrives. Only from the main thread'''
+        signal.signal(signum, self.request_reload)
+
+    def start_watching(self, interval:float=2) -> None:
+        '''Look for changes every interval seconds from a background thread, 0 only
+            reloads when asked to'''
+        if self._stop != None:
+            return
+        stop = self._stop = Event()
+        def _watcher():
+            while stop.is_set() == False:
+                if self._reload.wait(interval if interval > 0 else None) == True:
+                    self._reload.clear()
+                    if stop.is_set() == False:
+                        self.reload()
+                elif interval > 0:
+                    self.check()
+        Thread(target=_watcher, name="configwatcher", daemon=True).start()
+
+    def stop_watching(self) -> None:
+        if self._stop != None:
+            self._stop.set()
+            self._reload.set()
+            self._stop = None
+
+
+def main():
+    '''Loads the configs, then reloads them on every change until Ctrl-C'''
+    import argparse
+    from statetypes import CatDetection
+    parser = argparse.ArgumentParser(description="Watch and reload the evaluation configs")
+    parser.add_argument('--label-json', help="JSON file containing the detection labels", type=str, default='./labels.json')
+    parser.add_argument('--trigger-json', help="JSON file with the triggering state evaluation", type=str, default='./trigger_config.json')
+    parser.add_argument('--eval-json', help="JSON file with the motion locked state evaluation", type=str, default='./eval_config.json')
+    parser.add_argument('--interval', help="Seconds between looking for changes", type=float, default=2)
+    args = parser.parse_args()
+
+    try:
+        store = ConfigStore(args.label_json, args.trigger_json, args.eval_json, CatDetection)
+    except ValueError as e:
+        logger.error(f"{e}")
+        sys.exit(1)
+    logger.info(f"{store.current}")
+    store.install_signal()
+    store.start_watching(args.interval)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        store.stop_watching()
+        logger.info(f"{store}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+'''Offline evaluation of a model over a directory of labelled images. The recorded
+images are named <label>-<score>-<date>-<time>_catcam.jpg, the label is taken as
+the ground truth. The images are spread over a pool of worker processes, each with
+its own interpreter - the model file is memory mapped by TFLite, so the workers
+share its pages. Writes a confusion matrix, the score distribution per class and
+the images per second.
+
+python evalcorpus.py --images ./recordings --model cats.tflite --workers 8 --output eval.json
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+
+import cv2 as cv
+import numpy as np
+
+from base_logger import logger
+
+
+# Cat-with-mouse-52-20230804-001533.496_catcam.jpg
+NAME_PATTERN = re.compile(r'^(.*)-(\d+)-(\d{8}-\d{6}\.\d{3})_catcam\.jpg$')
+NO_DETECTION = 'None'
+SCORE_BINS = np.linspace(0, 1, 11)
+
+# The detector of each worker process
+_detector = None
+
+
+def find_images(directory:str, labels:list) -> tuple:
+    '''All the labelled images below directory as (path, label), and the number of
+        files skipped because the name or label is not known'''
+    images = []
+    skipped = 0
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            match = NAME_PATTERN.match(name)
+            if match == None:
+                if name.endswith('_catcam.jpg'):
+                    skipped += 1
+                continue
+            if match.group(1) not in labels:
+                skipped += 1
+                continue
+            images.append((os.path.join(root, name), match.group(1)))
+    return images, skipped
+
+
+def _init_worker(model:str, use_coral:bool, num_threads:int, input_size:tuple) -> None:
+    '''Load the model once in each worker process'''
+    global _detector
+    from tflite_detect import TFLiteDetect
+    _detector = TFLiteDetect(model, use_coral, num_threads, input_size)
+
+
+def _evaluate(item:tuple) -> tuple:
+    '''Runs in a worker - returns (path, truth, best score per label, seconds)'''
+    image_path, truth = item
+    image = cv.imread(image_path)
+    if image is None:
+        return image_path, truth, None, 0
+    start = time.perf_counter()
+    scores = {}
+    for d in _detector.detect(image):
+        scores[d.label] = max(scores.get(d.label, 0), d.score)
+    return image_path, truth, scores, time.perf_counter() - start
+
+
+class CorpusReport():
+    '''Adds up the results of the workers'''
+    def __init__(self, labels:list) -> None:
+        self._labels = labels
+        self._predicted = labels + [NO_DETECTION]
+        self._confusion = np.zeros((len(labels), len(self._predicted)), np.int64)
+        self._true_scores = defaultdict(list)   # Score given to the true label, per class
+        self._top_scores = defaultdict(list)    # Score of the prediction, per class
+        self._inference = []
+        self._failed = []
+
+    def add(self, image_path:str, truth:str, scores:dict, seconds:float) -> None:
+        if scores == None:
+            self._failed.append(image_path)
+            return
+        self._inference.append(seconds)
+        predicted = max(scores, key=scores.get) if len(scores) > 0 else NO_DETECTION
+        self._confusion[self._labels.index(truth), self._predicted.index(predicted)] += 1
+        self._true_scores[truth].append(scores.get(truth, 0))
+        self._top_scores[truth].append(scores.get(predicted, 0))
+
+    @staticmethod
+    def _distribution(scores:list) -> dict:
+        if len(scores) == 0:
+            return {'count': 0}
+        s = np.array(scores)
+        return {'count': len(s), 'mean': round(float(s.mean()), 3),
+                'p10': round(float(np.percentile(s, 10)), 3), 'p50': round(float(np.percentile(s, 50)), 3),
+                'p90': round(float(np.percentile(s, 90)), 3),
+                'histogram': np.histogram(s, SCORE_BINS)[0].tolist()}
+
+    def summary(self, elapsed:float, workers:int) -> dict:
+        total = int(self._confusion.sum())
+        correct = int(sum(self._confusion[i, i] for i in range(len(self._labels))))
+        per_class = {}
+        for i, label in enumerate(self._labels):
+            row = int(self._confusion[i].sum())
+            column = int(self._confusion[:, i].sum())
+            per_class[label] = {'images': row,
+                'recall': round(self._confusion[i, i] / row, 3) if row > 0 else None,
+                'precision': round(self._confusion[i, i] / column, 3) if column > 0 else None,
+                'true_label_score': self._distribution(self._true_scores[label]),
+                'predicted_score': self._distribution(self._top_scores[label])}
+        inference = np.array(self._inference) * 1000 if len(self._inference) > 0 else np.zeros(1)
+        return {'images': total, 'failed': len(self._failed), 'accuracy': round(correct / total, 3) if total > 0 else None,
+                'workers': workers, 'seconds': round(elapsed, 2),
+                'images_per_second': round(total / elapsed, 1) if elapsed > 0 else 0,
+                'inference_ms': {'mean': round(float(inference.mean()), 1), 'p95': round(float(np.percentile(inference, 95)), 1)},
+                'predicted_labels': self._predicted, 'confusion': self._confusion.tolist(),
+                'classes': per_class}
+
+    def confusion_table(self) -> str:
+        '''The confusion matrix as text, truth down the side, predictions across'''
+        width = max(len(l) for l in self._predicted) + 2
+        lines = ['truth \\ predicted'.ljust(width) + ''.join(p.rjust(width) for p in self._predicted)]
+        for i, label in enumerate(self._labels):
+            lines.append(label.ljust(width) + ''.join(str(n).rjust(width) for n in self._confusion[i]))
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a model over a directory of labelled *_catcam.jpg images")
+    parser.add_argument('--images', help="Directory of labelled images, searched recursively", required=True, type=str)
+    parser.add_argument('--model', help="Path of the object detection model", default='cats.tflite', type=str)
+    parser.add_argument('--label-json', help="JSON file containing the detection labels", type=str, default='./labels.json')
+    parser.add_argument('--workers', help="Number of worker processes", type=int, default=os.cpu_count())
+    parser.add_argument('--num_threads', help="CPU threads per interpreter", type=int, default=1)
+    parser.add_argument('--enable_edgetpu', help="Run the model on EdgeTPU", action='store_true')
+    parser.add_argument('--model_input', help="Model input size w,h to resize to before inference", type=str)
+    parser.add_argument('--chunk', help="Images handed to a worker at a time", type=int, default=16)
+    parser.add_argument('--output', help="Write the JSON report here", type=str)
+    args = parser.parse_args()
+
+    with open(args.label_json) as j:
+        labels = json.load(j)['labels']
+    images, skipped = find_images(args.images, labels)
+    if len(images) == 0:
+        logger.error(f"No labelled images found in {args.images}")
+        return 1
+    logger.info(f"Evaluating {len(images)} images with {args.model} on {args.workers} workers, skipped {skipped} unlabelled")
+
+    input_size = tuple(int(x) for x in args.model_input.split(',')) if args.model_input != None else None
+    report = CorpusReport(labels)
+    # Spawned, not forked, so no worker inherits interpreter or camera state
+    context = multiprocessing.get_context('spawn')
+    start = time.perf_counter()
+    with context.Pool(args.workers, _init_worker, (args.model, args.enable_edgetpu, args.num_threads, input_size)) as pool:
+        # Give the workers a moment to load their models before the clock starts
+        pool.map(time.sleep, [0] * args.workers)
+        start = time.perf_counter()
+        for i, result in enumerate(pool.imap_unordered(_evaluate, images, chunksize=args.chunk)):
+            report.add(*result)
+            if (i + 1) % 1000 == 0:
+                logger.info(f"{i + 1} of {len(images)} images, {(i + 1) / (time.perf_counter() - start):.1f}/s")
+    elapsed = time.perf_counter() - start
+
+    summary = report.summary(elapsed, args.workers)
+    summary['skipped'] = skipped
+    print(report.confusion_table())
+    print(f"{summary['images']} images in {summary['seconds']}s, {summary['images_per_second']} images/s, accuracy {summary['accuracy']}")
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,18 @@
 from collections import deque
+import numbers
 import numpy as np
 from enum import Enum
 from base_logger import logger
 
 
+# Values in the moving average of each label
+WINDOW = 5
+
+
 class Stats:
     '''Container class for a queue with a rolling average
         Don't create these yourself, use the StatsFactory'''
-    def __init__(self, name:str, window=5, initial=0.01):
+    def __init__(self, name:str, window=WINDOW, initial=0.01):
         '''Create an array, with low initial values'''
         self._name = name
         self._queue = deque(maxlen=window)
@@ -61,7 +66,8 @@ class Stats:
         if self._moving_average >= self.average_threshold and self._count >= self.min_result_count:
             self._status = self._triggered_result
 
-        logger.debug(f"{__class__.__name__} pushed value: {self._name},{value:.2f} == {self} result {self._status.name}")
+        # Formatted only when debug logging is on, this runs for every detection
+        logger.debug("%s pushed value: %s,%.2f == %s result %s", __class__.__name__, self._name, value, self, self._status.name)
         return self._status
 
 
@@ -107,9 +113,9 @@ class Evaluation():
     def __init__(self, labels:list, config, result_enum: Enum, min=3, delta=0.30) -> None:
         '''_stats is a dictionary { label, Eval() } to evaluate each
         incoming result. 
-        The label Undecided is an extra value.
+        The label Undecided is an extra value, added to a copy of labels.
         '''
-        labels.append('Undecided')
+        labels = labels + ['Undecided']
         factory = StatsFactory(config, result_enum)
         self._stats = dict([(l, factory.create(l)) for l in labels])
         self._count = 0
@@ -157,22 +163,375 @@ class Evaluation():
         return self._result
 
 
+class ThresholdTable():
+    '''A threshold config checked and compiled once for VectorEvaluation - the slot of each
+    label, the result a slot gives when it wins, and the thresholds as arrays. Every
+    evaluation made from the table shares it, so it is never changed once made.
+    Raises ValueError for a config that cannot be used. What Evaluation got by with - a
+    threshold for a label that is not one of labels, two thresholds for a label, a value
+    out of range - raises too if strict, otherwise it is listed in ignored and the config
+    is used as Evaluation would: unknown labels left out, the last threshold of a label wins'''
+    def __init__(self, labels:list, config, result_enum: Enum, strict:bool=False) -> None:
+        if isinstance(config, dict) == False or isinstance(config.get('thresholds'), list) == False:
+            raise ValueError("the config needs a list of thresholds")
+        if len(labels) + 1 != len(result_enum):
+            raise ValueError(f"{len(labels)} labels do not match the {len(result_enum)} results")
+        self.ignored = []
+        def problem(message:str) -> None:
+            if strict == True:
+                raise ValueError(message)
+            self.ignored.append(message)
+        thresholds = {}
+        for entry in config['thresholds']:
+            label = entry.get('label') if isinstance(entry, dict) else None
+            values = entry.get('values') if isinstance(entry, dict) else None
+            if isinstance(label, str) == False:
+                raise ValueError("threshold without a label")
+            if isinstance(values, dict) == False:
+                raise ValueError(f"no values for {label}")
+            count = values.get('min_result_count')
+            threshold = values.get('average_threshold')
+            if isinstance(count, numbers.Integral) == False or isinstance(count, bool) == True:
+                raise ValueError(f"min_result_count of {label} is {count}, it must be a whole number")
+            if isinstance(threshold, numbers.Real) == False or isinstance(threshold, bool) == True:
+                raise ValueError(f"average_threshold of {label} is {threshold}, it must be a number")
+            if label not in labels:
+                problem(f"threshold for unknown label {label}")
+                continue
+            if label in thresholds:
+                problem(f"two thresholds for {label}")
+            if count < 1:
+                problem(f"min_result_count of {label} is {count}, it must be at least 1")
+            if not 0 <= threshold <= 1:
+                problem(f"average_threshold of {label} is {threshold}, it must be from 0 to 1")
+            thresholds[label] = values
+
+        self.labels = list(labels)
+        self.result_enum = result_enum
+        self.slot = {}          # label -> index into the arrays, -1 if not configured
+        self.members = []       # The result of each slot when it wins
+        for index, label in enumerate(labels + ['Undecided']):
+            if label in thresholds and label not in self.slot:
+                self.slot[label] = len(self.members)
+                self.members.append(result_enum(index))
+            else:
+                self.slot.setdefault(label, -1)
+        self.threshold = np.array([thresholds[l]['average_threshold'] for l in self.slot if self.slot[l] >= 0], np.float64)
+        self.min_count = np.array([thresholds[l]['min_result_count'] for l in self.slot if self.slot[l] >= 0], np.int64)
+        self.threshold.setflags(write=False)
+        self.min_count.setflags(write=False)
+
+    def evaluation(self) -> 'VectorEvaluation':
+        '''A new evaluation with these thresholds'''
+        return VectorEvaluation(self.labels, self, self.result_enum)
+
+
+class VectorEvaluation():
+    '''The same evaluation as Evaluation, with the windows of every configured label
+    held in preallocated numpy arrays instead of one Stats object each, and
+    add_records takes a batch - a whole recording - and works out the result after
+    each record with array operations. For the few detections of a frame the states
+    call add_record, as the list building of a batch costs more than it saves.
+    Each window is added up oldest first with sum(), as Stats.push does it, so the
+    results are the same as Evaluation's, bit for bit.
+    '''
+    # Smaller batches are quicker one record at a time than with array operations
+    BATCH_MIN = 16
+
+    def __init__(self, labels:list, config, result_enum: Enum) -> None:
+        '''Only the labels with thresholds in config get a slot in the arrays, records
+            of the other labels are ignored. As for Evaluation, result_enum must be in
+            the order of labels and end in UNDECIDED. config is the JSON config, or a
+            ThresholdTable already compiled from it'''
+        table = config if isinstance(config, ThresholdTable) == True else ThresholdTable(labels, config, result_enum)
+        self._slot = table.slot
+        self._members = table.members
+        self._threshold = table.threshold
+        self._min_count = table.min_count
+        size = len(self._members)
+
+        # Per slot: the last WINDOW values, and the same as Stats
+        self._ring = np.zeros((size, WINDOW), np.float64)
+        self._counts = np.zeros(size, np.int64)
+        self._max = np.full(size, 0.01, np.float64)
+        self._min = np.full(size, 0.01, np.float64)
+        self._average = np.zeros(size, np.float64)
+        self._score = np.zeros(size, np.float64)
+        self._triggered = np.zeros(size, bool)
+        self._live = []         # The triggered slots, in order
+        self._winner = -1       # The best of them
+
+        self._count = 0
+        self._result = result_enum(len(result_enum)-1)
+        self._last_result = self._default_result = result_enum(len(result_enum)-1)
+
+    def __str__(self) -> str:
+        return f"{self._count}:{self._result}"
+
+    @property
+    def result(self) -> int:
+        '''The result of the determination'''
+        return self._result
+
+    def _add(self, slot:int, value:float) -> int:
+        '''Push one value into a slot, and return the result of the best triggered slot'''
+        n = int(self._counts[slot])
+        position = n % WINDOW
+        self._ring[slot, position] = value
+        n += 1
+        self._counts[slot] = n
+        # Added up oldest first with sum(), as Stats does - a running sum can differ in the last bit
+        window = self._ring[slot].tolist()
+        start = n % WINDOW if n >= WINDOW else 0
+        average = sum(window[start:n] if n < WINDOW else window[start:] + window[:start]) / min(n, WINDOW)
+        self._average[slot] = average
+        high = self._max.item(slot)
+        if value > high:
+            self._max[slot] = high = value
+        if value < self._min.item(slot):
+            self._min[slot] = value
+        score = n * high * average
+        self._score[slot] = score
+        if slot not in self._live and average >= self._threshold.item(slot) and n >= self._min_count.item(slot):
+            self._triggered[slot] = True
+            self._live = sorted(self._live + [slot])
+
+        # Of the triggered slots the highest (count * max * average) wins, on a tie the first.
+        # Only this slot changed, so only the winner losing score needs them all compared
+        if slot in self._live:
+            if self._winner < 0:
+                self._winner = slot
+            elif self._winner == slot:
+                self._winner = self._best()
+            else:
+                best = self._score.item(self._winner)
+                if score > best or (score == best and slot < self._winner):
+                    self._winner = slot
+        if self._winner < 0:
+            return self._default_result
+        return self._members[self._winner]
+
+    def _best(self) -> int:
+        '''The triggered slot with the highest score, the first of equals, or -1'''
+        best = -1
+        for slot in self._live:
+            if best < 0 or self._score.item(slot) > self._score.item(best):
+                best = slot
+        return best
+
+    def add_record(self, label:str, value:float) -> int:
+        '''Add the record to the statistic, if the label is relevant for this evaluation
+            The return value is from the CatDetection Enum'''
+        slot = self._slot[label]
+        if slot >= 0:
+            self._last_result = self._add(slot, value)
+        return self._last_result
+
+    def add_records(self, labels:list, values:list, until:tuple=()) -> list:
+        '''Add a batch of records in order, ie. all the detections of a frame. Returns
+            the result after each record, as add_record would have. With until, the
+            batch stops after the first record whose result is in until - the rest
+            are not added and have no result'''
+        count = len(labels)
+        if count < self.BATCH_MIN:
+            # A frame has a few detections, straight through _add is cheapest
+            results = []
+            result = self._last_result
+            for n in range(count):
+                slot = self._slot[labels[n]]
+                if slot >= 0:
+                    result = self._add(slot, values[n])
+                results.append(result)
+                if result in until:
+                    break
+            self._last_result = result
+            return results
+
+        slots = np.array([self._slot[l] for l in labels], np.int64)
+        values = np.asarray(values, np.float64)
+        results, update = self._batch(slots, values)
+        if len(until) > 0:
+            stop = next((n for n, r in enumerate(results) if r in until), None)
+            if stop != None and stop < len(results) - 1:
+                results, update = self._batch(slots[:stop + 1], values[:stop + 1])
+        self._commit(update)
+        if len(results) > 0:
+            self._last_result = results[-1]
+        return results
+
+    def _batch(self, slots:np.ndarray, values:np.ndarray) -> tuple:
+        '''The result after each record of the batch, and the state of each slot after
+            the whole batch, without changing anything'''
+        records = np.flatnonzero(slots >= 0)
+        s = slots[records]
+        count = np.empty(len(s), np.int64)
+        total = np.empty(len(s), np.float64)
+        high = np.empty(len(s), np.float64)
+        low = np.empty(len(s), np.float64)
+        triggered = np.empty(len(s), bool)
+        update = []
+        for slot in np.unique(s).tolist():
+            rows = np.flatnonzero(s == slot)
+            new = values[records[rows]]
+            done = int(self._counts[slot])
+            pushes = done + np.arange(len(rows))
+            # The window of each push, oldest first - the values still in the ring, then
+            # this batch, after zeros that sum() adds without changing anything
+            kept = min(done, WINDOW)
+            history = np.concatenate((np.zeros(WINDOW), self._ring[slot, np.arange(done - kept, done) % WINDOW], new))
+            windows = np.lib.stride_tricks.sliding_window_view(history, WINDOW)[kept + 1:kept + 1 + len(rows)]
+            count[rows] = pushes + 1
+            total[rows] = list(map(sum, windows.tolist()))
+            high[rows] = np.maximum.accumulate(np.concatenate(([self._max[slot]], new)))[1:]
+            low[rows] = np.minimum.accumulate(np.concatenate(([self._min[slot]], new)))[1:]
+            average = total[rows] / np.minimum(count[rows], WINDOW)
+            hit = (average >= self._threshold[slot]) & (count[rows] >= self._min_count[slot])
+            triggered[rows] = np.logical_or.accumulate(np.concatenate(([self._triggered[slot]], hit)))[1:]
+            last = rows[-1]
+            keep = slice(max(len(rows) - WINDOW, 0), None)
+            update.append((slot, int(count[last]), high[last], low[last], average[-1],
+                           triggered[last], pushes[keep] % WINDOW, new[keep]))
+        average = total / np.minimum(count, WINDOW)
+        score = count * high * average
+
+        # The state of every slot after each record - its own last record so far, or as it was
+        latest = np.full((len(s), len(self._members)), -1, np.int64)
+        latest[np.arange(len(s)), s] = np.arange(len(s))
+        latest = np.maximum.accumulate(latest, axis=0)
+        seen = latest >= 0
+        pick = np.where(seen, latest, 0)
+        live = np.where(seen, triggered[pick], self._triggered)
+        scores = np.where(live, np.where(seen, score[pick], self._score), -np.inf)
+        winner = np.where(live.any(axis=1), np.argmax(scores, axis=1), len(self._members))
+
+        # Records of labels that are not configured keep the result before them
+        table = self._members + [self._default_result, self._last_result]
+        index = np.full(len(slots), len(self._members) + 1, np.int64)
+        index[records] = winner
+        before = np.where(slots >= 0, np.arange(len(slots)), -1)
+        before = np.maximum.accumulate(before) if len(slots) > 0 else before
+        index = np.where(before >= 0, index[np.maximum(before, 0)], index)
+        return [table[i] for i in index.tolist()], update
+
+    def _commit(self, update:list) -> None:
+        for slot, count, high, low, average, triggered, positions, new in update:
+            self._ring[slot, positions] = new
+            self._counts[slot] = count
+            self._max[slot] = high
+            self._min[slot] = low
+            self._average[slot] = average
+            self._score[slot] = count * high * average
+            self._triggered[slot] = triggered
+        self._live = np.flatnonzero(self._triggered).tolist()
+        self._winner = self._best()
+
+
+def recorded_streams(directory:str, labels:list) -> list:
+    '''The detection streams cached by threshold_sweep.py, one per clip. Each stream is
+        a list of frames, each frame a list of (label, score) - a frame without any
+        detections is a low certainty background, as the triggering state treats it'''
+    import glob
+    from os import path
+    streams = []
+    for name in sorted(glob.glob(path.join(directory, '**', '*.npz'), recursive=True)):
+        with np.load(name) as cached:
+            frames = [[] for _ in range(int(cached['frames']))]
+            for f, l, s in zip(cached['frame'].tolist(), cached['label'].tolist(), cached['score'].tolist()):
+                frames[f].append((labels[l], s))
+        streams.append([f if len(f) > 0 else [('Background', 0.5)] for f in frames])
+    return streams
+
+
+def synthetic_streams(count:int, labels:list, seed:int=0) -> list:
+    '''Random streams as recorded_streams, of 0 to 3 detections a frame. Half have model
+        like scores in steps of 1/256, half any float'''
+    rng = np.random.default_rng(seed)
+    streams = []
+    for n in range(count):
+        frames = []
+        for _ in range(rng.integers(20, 300)):
+            k = rng.integers(0, 4)
+            scores = rng.integers(0, 256, k) / 256 if n % 2 == 0 else rng.random(k)
+            frames.append([(labels[i], float(s)) for i, s in zip(rng.integers(0, len(labels), k), scores)])
+        streams.append(frames)
+    return streams
+
+
 def main():
+    '''Times VectorEvaluation against Evaluation over recorded detection streams - the npz
+        files threshold_sweep.py caches - or synthetic ones. That they give the same
+        results is checked by tests/test_evaluation.py'''
+    import argparse
     import json
-    with open ("./labels.json") as j:
+    import time
+    from os import path
+    from statetypes import CatDetection
+
+    here = path.dirname(path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Time VectorEvaluation against Evaluation")
+    parser.add_argument('--streams', help="Directory of detection npz files cached by threshold_sweep.py", type=str)
+    parser.add_argument('--synthetic', help="Synthetic streams to add", type=int, default=200)
+    parser.add_argument('--label-json', help="JSON file containing the detection labels", type=str, default=path.join(here, 'labels.json'))
+    parser.add_argument('--trigger-json', help="JSON file with the triggering state evaluation", type=str, default=path.join(here, 'trigger_config.json'))
+    parser.add_argument('--eval-json', help="JSON file with the motion locked state evaluation", type=str, default=path.join(here, 'eval_config.json'))
+    args = parser.parse_args()
+
+    with open(args.label_json) as j:
         labels = json.load(j)['labels']
-        with open ("./eval_config.json") as e:
-            config = json.load(e)
-
-    e = Evaluation(labels, config, CatDetection)
-    result = e.add_record("Background", 0.60)
-    result = e.add_record("Background", 0.60)
-    result = e.add_record("Cat-alone", 0.55)
-    result = e.add_record("Background", 0.60)
-    result = e.add_record("Cat-alone", 0.60)
-    result = e.add_record("Background", 0.60)
-    result = e.add_record("Cat-alone", 0.65)
-    pass
+    configs = []
+    for name in (args.trigger_json, args.eval_json):
+        with open(name) as j:
+            configs.append(json.load(j))
+
+    streams = recorded_streams(args.streams, labels) if args.streams != None else []
+    streams += synthetic_streams(args.synthetic, labels)
+    records = sum(len(f) for s in streams for f in s)
+    print(f"{len(streams)} streams, {records} records")
+
+    # And how long they take
+    def timed(func) -> float:
+        start = time.perf_counter()
+        for config in configs:
+            for frames in streams:
+                func(config, frames)
+        return (time.perf_counter() - start) / len(configs) / records * 1e6
+
+    def legacy(config, frames):
+        e = Evaluation(labels, config, CatDetection)
+        for f in frames:
+            for l, s in f:
+                e.add_record(l, s)
+
+    def single(config, frames):
+        e = VectorEvaluation(labels, config, CatDetection)
+        for f in frames:
+            for l, s in f:
+                e.add_record(l, s)
+
+    def framewise(config, frames):
+        e = VectorEvaluation(labels, config, CatDetection)
+        for f in frames:
+            e.add_records([l for l, _ in f], [s for _, s in f])
+
+    def batched(config, frames):
+        flat = [r for f in frames for r in f]
+        VectorEvaluation(labels, config, CatDetection).add_records([l for l, _ in flat], [s for _, s in flat])
+
+    for name, func in (('Evaluation.add_record', legacy), ('VectorEvaluation.add_record', single),
+                       ('VectorEvaluation.add_records per frame', framewise), ('VectorEvaluation.add_records per stream', batched)):
+        print(f"{name:42s} {timed(func):6.2f}us per record")
+
+    # A new evaluation for each episode, from the JSON or from the table compiled when it was loaded
+    table = ThresholdTable(labels, configs[0], CatDetection)
+    for name, func in (('from the config', lambda: VectorEvaluation(labels, configs[0], CatDetection)),
+                       ('from a ThresholdTable', table.evaluation)):
+        start = time.perf_counter()
+        for _ in range(2000):
+            func()
+        print(f"VectorEvaluation {name:26s} {(time.perf_counter() - start) / 2000 * 1e6:6.2f}us per episode")
+    return 0
+
 
 if __name__ == "__main__":
-    main()
+    import sys
+    sys.exit(main())
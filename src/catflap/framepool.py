@@ -0,0 +1,201 @@
+'''A small pool of frame buffers for the main loop, so capturing a frame does not
+allocate a new 640x480x3 array every time.
+
+    pool = FramePool(6)
+    frame = pool.recycle(img_src.get_image(out=pool.acquire()))
+    pool.hold(frame)
+    ...
+    pool.release(frame)
+
+The capture writes straight into the buffer, so one is only handed out again when
+nothing holds it. Whatever keeps a frame past the iteration it was captured in holds
+it and releases it when done - the event queue of GlobalData, and the inference
+futures until their result has been used. The recorders and the website copy or
+scale the frame straight away and hold nothing. When every buffer is held the source
+allocates, and that frame joins the pool if there is room. Holding or releasing a
+frame that is not in the pool does nothing.
+
+python framepool.py, and the test in tests/, check with tracemalloc that the idle
+main loop allocates no frame sized buffers once it is running.
+'''
+import sys
+from threading import Lock
+import numpy as np
+
+
+class FramePool():
+    def __init__(self, size:int=6) -> None:
+        self._size = size
+        self._frames = []
+        # How many holders each buffer has, by id - released from the inference threads too
+        self._holds = {}
+        self._lock = Lock()
+        # Counters
+        self._reused = 0
+        self._allocated = 0
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__} {len(self._frames)} of {self._size} buffers, {self.held} held, reused {self._reused} allocated {self._allocated}"
+
+    '''Counters'''
+    @property
+    def reused(self) -> int:
+        return self._reused
+
+    @property
+    def allocated(self) -> int:
+        '''Frames the source had to allocate because no buffer was free'''
+        return self._allocated
+
+    @property
+    def held(self) -> int:
+        '''Buffers something holds'''
+        with self._lock:
+            return sum(1 for count in self._holds.values() if count > 0)
+
+    def acquire(self) -> np.ndarray:
+        '''A buffer nothing holds, or None if they are all in use'''
+        with self._lock:
+            for frame in self._frames:
+                if self._holds[id(frame)] == 0:
+                    return frame
+        return None
+
+    def recycle(self, frame:np.ndarray) -> np.ndarray:
+        '''Count the frame the source returned and keep it if it is new and there is
+            room. Returns the frame'''
+        if frame is None:
+            return frame
+        with self._lock:
+            if id(frame) in self._holds:
+                self._reused += 1
+            else:
+                self._allocated += 1
+                if len(self._frames) < self._size:
+                    self._frames.append(frame)
+                    self._holds[id(frame)] = 0
+        return frame
+
+    def hold(self, frame:np.ndarray) -> None:
+        '''The frame must not be handed out again until it is released'''
+        with self._lock:
+            if frame is not None and id(frame) in self._holds:
+                self._holds[id(frame)] += 1
+
+    def release(self, frame:np.ndarray) -> None:
+        '''Done with a frame that was held'''
+        with self._lock:
+            if frame is not None and self._holds.get(id(frame), 0) > 0:
+                self._holds[id(frame)] -= 1
+
+
+def idle_loop_allocations(frames:int=200, video:str=None, trigger:str='210,180,250,280', use_pool:bool=True) -> dict:
+    '''Run the idle main loop - capture, motion detection, state machine - over a
+        quiet scene and count the iterations that allocate a frame sized buffer'''
+    import json
+    import tempfile
+    import tracemalloc
+    from argparse import Namespace
+    from os import path
+    from abstractimagesource import AbstractImageSource
+    from imgsrcmp4 import ImageSourceMP4Video
+    from states import CatFlapFSM
+    from statetypes import GlobalData, Event
+    from replay import FakeCatFlapControl, StubDetector
+
+    class NoisySource(AbstractImageSource):
+        '''A still scene with sensor noise, written into the given buffer'''
+        def __init__(self, **kwargs):
+            super(NoisySource, self).__init__(**kwargs)
+            rng = np.random.default_rng(0)
+            self._scene = rng.integers(0, 250, (480, 640, 3), np.uint8)
+            self._noise = [rng.integers(0, 4, (480, 640, 3), np.uint8) for _ in range(4)]
+            self._count = 0
+
+        @staticmethod
+        def can_supply_images(source: str) -> bool:
+            return False
+
+        def open(self) -> int:
+            self._isopen = True
+            return 0
+
+        def close(self) -> int:
+            self._isopen = False
+            return 0
+
+        def get_image(self, out=None):
+            if out is None:
+                out = np.empty_like(self._scene)
+            self._count += 1
+            np.add(self._scene, self._noise[self._count % len(self._noise)], out=out)
+            return out
+
+    here = path.dirname(path.abspath(__file__))
+    args = Namespace(trigger=trigger, headless=True, idle_min_interval=0, idle_max_interval=0,
+                     label_json=path.join(here, 'labels.json'),
+                     trigger_json=path.join(here, 'trigger_config.json'),
+                     eval_json=path.join(here, 'eval_config.json'),
+                     record_path=tempfile.mkdtemp(prefix='framepool'))
+
+    img_src = ImageSourceMP4Video(source=video) if video != None else NoisySource(source='noise')
+    img_src.open()
+    pool = FramePool()
+    with open(args.label_json) as j:
+        detector = StubDetector('Background', 0.5, json.load(j)['labels'])
+    data = GlobalData(args, event=Event(pool.recycle(img_src.get_image())), tflite=detector,
+                      frame_pool=pool if use_pool == True else None)
+    fsm = CatFlapFSM(data, FakeCatFlapControl())
+
+    def iteration():
+        frame = img_src.get_image(pool.acquire() if use_pool == True else None)
+        if frame is None:
+            return False
+        pool.recycle(frame)
+        fsm.event_handle(Event(frame))
+        return True
+
+    # Warm up so the pool and the motion detector buffers exist
+    for _ in range(20):
+        iteration()
+
+    frame_bytes = data.get_images(1)[0].nbytes
+    tracemalloc.start()
+    worst = 0
+    frame_sized = 0
+    measured = 0
+    for _ in range(frames):
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        if iteration() == False:
+            break
+        _, peak = tracemalloc.get_traced_memory()
+        measured += 1
+        worst = max(worst, peak - before)
+        if peak - before >= frame_bytes:
+            frame_sized += 1
+    tracemalloc.stop()
+    fsm.exit()
+    img_src.close()
+    return {'frames': measured, 'frame_bytes': frame_bytes, 'worst': worst, 'frame_sized': frame_sized, 'pool': str(pool)}
+
+
+def main():
+    '''Check no iteration of the idle main loop allocates a frame sized buffer'''
+    import argparse
+    parser = argparse.ArgumentParser(description="Check the idle main loop does not allocate frames")
+    parser.add_argument('--video', help="Video of a quiet scene, a synthetic one is used without it", type=str)
+    parser.add_argument('--frames', help="Frames to measure", type=int, default=200)
+    parser.add_argument('--trigger', help="Trigger area x,y,w,h", type=str, default='210,180,250,280')
+    parser.add_argument('--no_pool', help="Capture without the pool, to compare", action='store_true')
+    args = parser.parse_args()
+
+    result = idle_loop_allocations(args.frames, args.video, args.trigger, args.no_pool == False)
+    print(f"{result['frames']} frames of {result['frame_bytes']} bytes, largest allocation peak in one iteration {result['worst']} bytes")
+    print(f"{result['frame_sized']} iterations allocated a frame sized buffer, {result['pool']}")
+    print("PASS" if result['frame_sized'] == 0 else "FAIL")
+    return 0 if result['frame_sized'] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
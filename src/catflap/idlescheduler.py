@@ -0,0 +1,70 @@
+import time
+
+from base_logger import logger
+
+
+class IdleScheduler():
+    '''Decides how long the idle state sleeps between frames, instead of a flat second.
+        - Small motion in the trigger area drops straight to the fastest poll rate
+        - With nothing moving the interval grows step by step up to max_interval
+        - For hold_time after a trigger the cat is probably still around, so the
+          ceiling only ramps back up to max_interval slowly
+        - The interval never drops so low that idle uses more than cpu_budget of a core
+        max_interval is the worst case latency before a cat is noticed.'''
+    def __init__(self, min_interval:float=0.05, max_interval:float=1.0, cpu_budget:float=0.25,
+                 motion_energy:float=0.002, hold_time:float=30, growth:float=1.5) -> None:
+        assert 0 < cpu_budget <= 1
+        self._min_interval = min_interval
+        self._max_interval = max(min_interval, max_interval)
+        self._cpu_budget = cpu_budget
+        self._motion_energy = motion_energy
+        self._hold_time = hold_time
+        self._growth = growth
+
+        self._interval = self._max_interval
+        self._energy = 0
+        self._last_trigger = None
+        self._motion_start = None
+        self._last_poll = None
+
+    @property
+    def interval(self) -> float:
+        return self._interval
+
+    def next_interval(self, energy:float, frame_cost:float) -> float:
+        '''Called once per idle frame with the motion energy of the frame (fraction of
+            pixels changed) and the seconds it took to process. Returns seconds to sleep.'''
+        now = time.monotonic()
+        self._last_poll = now
+        # Smooth the energy a little so a single noisy frame does not count as motion
+        self._energy = 0.5 * self._energy + 0.5 * energy
+
+        if self._energy >= self._motion_energy:
+            if self._motion_start == None:
+                self._motion_start = now
+            self._interval = self._min_interval
+        else:
+            self._motion_start = None
+            ceiling = self._max_interval
+            if self._last_trigger != None and now - self._last_trigger < self._hold_time:
+                ceiling = max(self._min_interval, self._max_interval * (now - self._last_trigger) / self._hold_time)
+            self._interval = min(self._interval * self._growth, ceiling)
+
+        # Stay inside the CPU budget - cost / (cost + interval) <= budget
+        floor = frame_cost * (1 / self._cpu_budget - 1)
+        return max(self._interval, floor)
+
+    def triggered(self) -> None:
+        '''Idle has triggered, log how long it took from the first sign of motion'''
+        now = time.monotonic()
+        if self._motion_start != None:
+            latency = now - self._motion_start
+        elif self._last_poll != None:
+            # Motion started some time during the last sleep
+            latency = now - self._last_poll
+        else:
+            latency = 0
+        logger.info(f"{self.__class__.__name__} trigger latency {latency * 1000:.0f}ms, poll interval {self._interval * 1000:.0f}ms")
+        self._last_trigger = now
+        self._motion_start = None
+        self._interval = self._min_interval
@@ -1,40 +1,154 @@
+
 from datetime import datetime
-from os import path
+from os import path, makedirs
 from array import array
+from queue import Queue, Empty, Full
+from threading import Thread
 import cv2 as cv
+import time
 
+from base_logger import logger
 
-def image_recorder(out_path: str) -> callable:
 
-    record_path = out_path
+class ImageRecorder():
+    '''Records images in the background, so a slow SD card never delays the caller.
+    Calling the recorder copies the image into a bounded queue and returns. A writer
+    thread takes everything waiting in the queue, JPEG encodes and writes it.
+    When the queue is full the image is either dropped straight away (policy 'drop')
+    or the caller waits up to timeout seconds for space (policy 'block').'''
+    def __init__(self, out_path: str, quality: int = 90, queue_size: int = 8,
+                 policy: str = 'drop', timeout: float = 0.1) -> None:
+        self._record_path = out_path
+        # check path exists and is writeable
+        if not path.exists(self._record_path):
+            # try to create the directory
+            try:
+                makedirs(self._record_path)
+            except OSError:
+                raise ValueError(f"Path {self._record_path} does not exist and could not be created")
+        if not path.isdir(self._record_path):
+            raise ValueError(f"Path {self._record_path} is not a directory")
+        assert policy in ('drop', 'block')
 
-    # check path exists and is writeable
-    if not path.exists(record_path):
-        # try to create the directory
-        try:
-            path.mkdir(record_path)
-        except OSError:
-            raise ValueError(f"Path {record_path} does not exist and could not be created")
-    if not path.isdir(record_path):
-        raise ValueError(f"Path {record_path} is not a directory")  
+        self._quality = quality
+        self._policy = policy
+        self._timeout = timeout
+        self._queue = Queue(maxsize=queue_size)
+
+        # Counters
+        self._queued = 0
+        self._written = 0
+        self._dropped = 0
+        self._failed = 0
+        self._latency_total = 0
+        self._latency_max = 0
+
+        self._thread = Thread(target=self._writer, name="imagerecorder", daemon=True)
+        self._thread.start()
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__} queued {self._queued} written {self._written} dropped {self._dropped} failed {self._failed} " \
+               f"depth {self.depth} latency avg {self.write_latency * 1000:.1f}ms max {self._latency_max * 1000:.1f}ms"
+
+    '''Counters'''
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    @property
+    def written(self) -> int:
+        return self._written
 
+    @property
+    def dropped(self) -> int:
+        return self._dropped
 
+    @property
+    def failed(self) -> int:
+        '''Images that could not be encoded or written'''
+        return self._failed
+
+    @property
+    def depth(self) -> int:
+        '''Images waiting to be written'''
+        return self._queue.qsize()
+
+    @property
+    def write_latency(self) -> float:
+        '''Average seconds from an image being recorded to it being on disk'''
+        return self._latency_total / self._written if self._written > 0 else 0
+
+    @staticmethod
     def _make_outfile_name(record_path, label, prob):
         datestr = datetime.now().strftime("%Y%m%d-%H%M%S.%f")[:-3]
         prob = int(prob * 100)
         outfile = path.join(record_path, f"{label}-{str(prob)}-{datestr}_catcam.jpg")
         return outfile
 
+    def __call__(self, image: array, event: str) -> bool:
+        '''Queue an image for recording. Returns False if it was dropped'''
+        # The name is made now so it has the time of the event, not of the write
+        item = (self._make_outfile_name(self._record_path, event, 1), image.copy(), time.monotonic())
+        try:
+            if self._policy == 'block':
+                self._queue.put(item, timeout=self._timeout)
+            else:
+                self._queue.put_nowait(item)
+        except Full:
+            self._dropped += 1
+            logger.warning(f"{self.__class__.__name__} queue full, dropped {item[0]}")
+            return False
+        self._queued += 1
+        return True
+
+    def close(self) -> None:
+        '''Write whatever is still queued and stop the writer thread'''
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+        logger.info(f"{self}")
+
+    def _write(self, item) -> None:
+        '''Encode and write one image, it only counts as written once it is in the file'''
+        outfile, image, queued = item
+        success, buffer = cv.imencode('.jpg', image, [cv.IMWRITE_JPEG_QUALITY, self._quality])
+        if success == False:
+            raise ValueError("JPEG encoding failed")
+        with open(outfile, 'wb') as f:
+            f.write(buffer)
+        latency = time.monotonic() - queued
+        self._written += 1
+        self._latency_total += latency
+        self._latency_max = max(self._latency_max, latency)
+
+    def _writer(self) -> None:
+        '''The writer thread - wait for an image, then write everything that is waiting'''
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            for item in batch:
+                if item == None:
+                    return
+                try:
+                    self._write(item)
+                except Exception as e:
+                    self._failed += 1
+                    logger.error(f"{self.__class__.__name__} failed to write {item[0]} - {e}")
+            logger.debug("%s", self)
 
-    def record_image(image: array, event: str):
-        cv.imwrite(_make_outfile_name(record_path, event, 1), image)
 
-    return record_image
+def image_recorder(out_path: str, **kwargs) -> callable:
+    '''Create an image recorder - call it with an image and a label'''
+    return ImageRecorder(out_path, **kwargs)
 
 
 if __name__ == "__main__":
     # create a test image with opencv
-    import  numpy as np   
+    import  numpy as np
     img = np.zeros((480, 640, 3), np.uint8)
     recorder = image_recorder('.')
     recorder(img, 'test')
+    recorder.close()
@@ -4,6 +4,7 @@ HOST_OS = os.uname().sysname
 
 from imgsrcmp4 import ImageSourceMP4Video
 from imgsrcimg import ImageSourceSingleImage
+from imgsrcthreaded import ThreadedImageSource
 if HOST_OS == "Darwin":
     # ie. Desktop, Intel
     from imgsrcwebcam import ImageSourceWebCam
@@ -31,12 +32,16 @@ class ImageSourceFactory():
             yield x
 
     @staticmethod
-    def create_source(source: str):
+    def create_source(source: str, capture_policy: str = None, ring_size: int = 4):
+        '''Create the image source for the given source string. With a capture_policy
+            the source is wrapped so capture runs on its own thread into a frame ring'''
         retval = None
         for c in ImageSourceFactory.__classlist__:
             if c.can_supply_images(source) == True:
                 retval = c(source=source)
                 break
+        if retval != None and capture_policy != None:
+            retval = ThreadedImageSource(image_source=retval, policy=capture_policy, ring_size=ring_size)
         return retval
 
 
@@ -35,14 +35,14 @@ class ImageSourceSingleImage(AbstractImageSource):
         self._isopen = False
         return 0
 
-    def get_image(self) -> array:
+    def get_image(self, out=None) -> array:
         '''Gets the next image from an image source
         Returns the image, or None when there are no more'''
         frame = None
         if self._isopen == True:
             frame = cv.imread(self.source)
             self._isopen = False
-        return frame
+        return self._into(frame, out)
     
 
 
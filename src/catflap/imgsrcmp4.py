@@ -30,9 +30,15 @@ class ImageSourceMP4Video(AbstractImageSource):
             return 1
         self.size = (int(self.cap.get(cv.CAP_PROP_FRAME_WIDTH)),
             int(self.cap.get(cv.CAP_PROP_FRAME_HEIGHT)))
+        self._frame_rate = self.cap.get(cv.CAP_PROP_FPS)
         self._isopen = True
         return 0
 
+    @property
+    def frame_rate(self) -> float:
+        '''Recorded videos are played back at the rate they were recorded'''
+        return getattr(self, '_frame_rate', 0)
+
     def close(self) -> int:
         '''Closes an image source
         Returns 0 for success, or anything else for an error'''
@@ -40,10 +46,10 @@ class ImageSourceMP4Video(AbstractImageSource):
         self._isopen = False
         return 0
 
-    def get_image(self) -> array:
-        '''Gets the next image from an image source
+    def get_image(self, out=None) -> array:
+        '''Gets the next image from an image source, decoded into out if given
         Returns the image, or None when there are no more'''
-        _, frame = self.cap.read()
+        _, frame = self.cap.read(out)
         if type(frame) == type(None):
             self._isopen = False
         return frame
@@ -1,23 +1,30 @@
 from abstractimagesource import AbstractImageSource
+from pixelformat import PixelFormat
 from array import array
 
-from picamera2 import Picamera2
-import libcamera
-
 from base_logger import logger
 
-Picamera2.set_logging(Picamera2.INFO)
-
 class ImageSourcePiCamera(AbstractImageSource):
     def __init__(self, **kwargs):
         super(ImageSourcePiCamera, self).__init__(**kwargs)
 
+        # Imported here, it takes a while and the model is loading at the same time
+        from picamera2 import Picamera2
+        import libcamera
+        Picamera2.set_logging(Picamera2.INFO)
+
         self.picam2 = Picamera2()
         config = self.picam2.create_still_configuration(main={"size": (640, 480), "format": "RGB888"}, 
                                             transform=libcamera.Transform(hflip=1, vflip=1))
         self.picam2.configure(config)
         self.picam2.still_configuration.align()
 
+    @property
+    def pixel_format(self) -> PixelFormat:
+        '''libcamera names formats by the order in a 32 bit word, so "RGB888" is
+        B, G, R in memory - the same as OpenCV uses'''
+        return PixelFormat.BGR
+
     @staticmethod
     def can_supply_images(source: str) -> bool:
         '''Returns True if this class can supply images from the source'''
@@ -40,13 +47,14 @@ class ImageSourcePiCamera(AbstractImageSource):
         self._isopen = False
         return 0
 
-    def get_image(self) -> array:
-        '''Gets the next image from an image source
+    def get_image(self, out=None) -> array:
+        '''Gets the next image from an image source. Picamera2 always hands out
+        a new array, so with out it is copied in
         Returns the image, or None when there are no more'''
         frame = self.picam2.capture_array()
         if type(frame) == type(None):
             frame = None
-        return frame
+        return self._into(frame, out)
 
 
 
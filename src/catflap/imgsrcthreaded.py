@@ -0,0 +1,218 @@
+from abstractimagesource import AbstractImageSource
+from array import array
+from collections import deque
+from enum import Enum
+from threading import Thread, Condition
+import numpy as np
+import time
+
+from base_logger import logger
+
+
+class CapturePolicy(str, Enum):
+    '''What to hand out when the consumer is slower than the camera
+        LATEST - only the newest frame is kept, everything older is dropped
+        DROP_OLDEST - frames are handed out in order, when the ring is full
+                      the oldest waiting frame is dropped'''
+    LATEST = 'latest'
+    DROP_OLDEST = 'drop_oldest'
+
+
+class ThreadedImageSource(AbstractImageSource):
+    '''Wraps any other image source and runs its capture on a background thread.
+    Frames are copied into a fixed ring of preallocated buffers so a slow consumer
+    (ie. inference) never stalls the sensor. The ring is allocated from the shape
+    of the first frame, after that the source captures straight into a free slot.
+    get_image() hands out a copy of a ring slot - into the caller's buffer if one
+    is given - so the slot can be reused as soon as the copy is done.'''
+    def __init__(self, **kwargs):
+        '''Needs image_source=<an AbstractImageSource>, optional policy, ring_size
+        and stale_age (seconds, frames older than this when handed out are stale)'''
+        image_source = kwargs['image_source']
+        kwargs.setdefault('source', image_source.source)
+        kwargs.setdefault('policy', CapturePolicy.LATEST)
+        kwargs.setdefault('ring_size', 4)
+        kwargs.setdefault('stale_age', 0.5)
+        super(ThreadedImageSource, self).__init__(**kwargs)
+        self.policy = CapturePolicy(self.policy)
+        assert self.ring_size >= 2
+
+        self._lock = Condition()
+        self._thread = None
+        self._running = False
+        self._eof = False
+
+        # The ring itself, allocated when the first frame arrives
+        self._slots = None
+        self._stamps = array('d', [0.0] * self.ring_size)
+        self._ready = deque(maxlen=self.ring_size)  # Slot indices waiting to be handed out
+        self._next_slot = 0
+
+        # Counters
+        self._captured = 0
+        self._delivered = 0
+        self._dropped = 0
+        self._stale = 0
+
+    @staticmethod
+    def can_supply_images(source: str) -> bool:
+        '''Only ever created explicitly as a wrapper, never by the factory'''
+        return False
+
+    @property
+    def frame_rate(self) -> float:
+        return self.image_source.frame_rate
+
+    @property
+    def pixel_format(self):
+        return self.image_source.pixel_format
+
+    @property
+    def isopen(self) -> bool:
+        with self._lock:
+            return self._isopen and (self._eof == False or len(self._ready) > 0)
+
+    '''Counters'''
+    @property
+    def captured(self) -> int:
+        '''Frames read from the wrapped source'''
+        return self._captured
+
+    @property
+    def delivered(self) -> int:
+        '''Frames handed out by get_image'''
+        return self._delivered
+
+    @property
+    def dropped(self) -> int:
+        '''Frames captured but never handed out'''
+        return self._dropped
+
+    @property
+    def stale(self) -> int:
+        '''Frames handed out that were older than stale_age'''
+        return self._stale
+
+    def open(self) -> int:
+        '''Opens the wrapped source and starts the capture thread
+        Returns 0 for success, or anything else for an error'''
+        retval = self.image_source.open()
+        if retval != 0:
+            return retval
+        self._isopen = True
+        self._running = True
+        self._eof = False
+        self._thread = Thread(target=self._capture_loop, name="capture", daemon=True)
+        self._thread.start()
+        logger.info(f"{self.__class__.__name__} capturing from {self.source} policy {self.policy.value} ring {self.ring_size}")
+        return 0
+
+    def close(self) -> int:
+        '''Stops the capture thread and closes the wrapped source
+        Returns 0 for success, or anything else for an error'''
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        if self._thread != None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        self._isopen = False
+        logger.info(f"{self.__class__.__name__} closed - captured {self._captured} delivered {self._delivered} dropped {self._dropped} stale {self._stale}")
+        return self.image_source.close()
+
+    def get_image(self, out=None) -> array:
+        '''Gets the next image from the ring, waiting for one if none is ready
+        Returns a copy of the image, in out if given, or None when there are no more'''
+        with self._lock:
+            while len(self._ready) == 0:
+                if self._eof == True or self._running == False:
+                    return None
+                self._lock.wait()
+            index = self._ready.popleft()
+            frame = self._into(self._slots[index], out)
+            if frame is self._slots[index]:
+                frame = frame.copy()
+            age = time.monotonic() - self._stamps[index]
+            self._delivered += 1
+            if age > self.stale_age:
+                self._stale += 1
+        return frame
+
+    def _reserve_slot(self, frame) -> int:
+        '''Pick a slot that is not waiting to be handed out, dropping the oldest
+        waiting frame when the ring is full. Called with the lock held.'''
+        if self._slots == None or self._slots[0].shape != frame.shape or self._slots[0].dtype != frame.dtype:
+            logger.debug(f"{self.__class__.__name__} allocating ring of {self.ring_size} x {frame.shape}")
+            self._slots = [np.empty_like(frame) for _ in range(self.ring_size)]
+            self._dropped += len(self._ready)
+            self._ready.clear()
+        if len(self._ready) == self.ring_size:
+            self._ready.popleft()
+            self._dropped += 1
+        while self._next_slot in self._ready:
+            self._next_slot = (self._next_slot + 1) % self.ring_size
+        index = self._next_slot
+        self._next_slot = (self._next_slot + 1) % self.ring_size
+        return index
+
+    def _capture_loop(self) -> None:
+        '''The capture thread - read, copy into the ring, publish'''
+        interval = 1.0 / self.frame_rate if self.frame_rate > 0 else 0
+        next_time = time.monotonic()
+        while self._running == True:
+            # Once the ring exists capture straight into a reserved slot. The reserved
+            # slot is not in the ready queue, so the consumer cannot be reading it. When
+            # the ring is full the oldest waiting frame gives up its slot
+            index = None
+            with self._lock:
+                if self._slots != None:
+                    index = self._reserve_slot(self._slots[0])
+            frame = self.image_source.get_image(None if index == None else self._slots[index])
+            if type(frame) == type(None):
+                break
+            stamp = time.monotonic()
+            if index == None or frame is not self._slots[index]:
+                with self._lock:
+                    index = self._reserve_slot(frame)
+                np.copyto(self._slots[index], frame)
+            with self._lock:
+                self._captured += 1
+                self._stamps[index] = stamp
+                if self.policy == CapturePolicy.LATEST:
+                    self._dropped += len(self._ready)
+                    self._ready.clear()
+                self._ready.append(index)
+                self._lock.notify_all()
+
+            # Recorded sources are paced to their native rate, live sources pace themselves
+            if interval > 0:
+                next_time += interval
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_time = time.monotonic()
+
+        with self._lock:
+            self._eof = True
+            self._lock.notify_all()
+        logger.debug(f"{self.__class__.__name__} capture thread ended")
+
+
+
+def main():
+    import sys
+    from imgsrcfactory import ImageSourceFactory
+    logger.info("Hello world")
+    test = ImageSourceFactory.create_source(sys.argv[1], capture_policy=CapturePolicy.LATEST)
+    test.open()
+    while True:
+        img = test.get_image()
+        if type(img) == type(None):
+            test.close()
+            break
+        time.sleep(0.1)     # A slow consumer
+    print(f"captured {test.captured} delivered {test.delivered} dropped {test.dropped} stale {test.stale}")
+
+if __name__ == "__main__":
+    main()
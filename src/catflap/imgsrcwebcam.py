@@ -13,20 +13,24 @@ class ImageSourceWebCam(AbstractImageSource):
         frameWidth = 640
         frameHeight = 480
 
-        success = False
-        max_retries = 10
-        while success == False:
-            self.cap = cv2.VideoCapture(int(kwargs["source"]))
-            self.cap.set(3, frameWidth)
-            self.cap.set(4, frameHeight)
+        # A camera that has just been opened can take a moment to deliver the first
+        # frame. Wait briefly and try again, opening it again only if it is not open
+        self.cap = None
+        delay = 0.01
+        deadline = time.monotonic() + 3
+        while True:
+            if self.cap == None or self.cap.isOpened() == False:
+                self.cap = cv2.VideoCapture(int(kwargs["source"]))
+                self.cap.set(3, frameWidth)
+                self.cap.set(4, frameHeight)
             success, frame = self.cap.read()
-            if type(frame) == type(None) or success == False:
-                max_retries -= 1
-                if max_retries == 0:
-                    logger.error('Failed to open web cam image source.')
-                    sys.exit(1)
-                self.cap.release()
-                time.sleep(0.2)
+            if success == True and type(frame) != type(None):
+                break
+            if time.monotonic() > deadline:
+                logger.error('Failed to open web cam image source.')
+                sys.exit(1)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
 
         # self.cap.set(10,150)
 
@@ -51,10 +55,10 @@ class ImageSourceWebCam(AbstractImageSource):
         self.cap.release()
         return 0
 
-    def get_image(self) -> array:
-        '''Gets the next image from an image source
+    def get_image(self, out=None) -> array:
+        '''Gets the next image from an image source, read into out if given
         Returns the image, or None when there are no more'''
-        success, frame = self.cap.read()
+        success, frame = self.cap.read(out)
         if type(frame) == type(None) or success == False:
             frame = None
         return frame
@@ -1,87 +1,258 @@
-import cv2 as cv
-import time
+# First, so the startup is timed from as early as possible where /proc cannot tell
+from startup_clock import startup
+import copy
+import os
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event as StopEvent
 
-from base_logger import logger
-from states import CatFlapFSM, Event
-from imgsrcfactory import ImageSourceFactory
-from statetypes import GlobalData
+from base_logger import logger, configure_logging, bind_camera
+from pipeline_metrics import metrics
 
-import socketio
-import base64
+# The rest is imported where it is used, the model and the cameras load meanwhile
 
-# Shut off noisy messages -
-# connectionpool(292):DEBUG Resetting dropped connection: 10.0.0.38
-# connectionpool(546):DEBUG http://10.0.0.38:5000 "POST /socket.io/?transport=polling&EIO=4&sid=4BN7BycU05USNayrAAGE HTTP/1.1" 200 None
-import logging
-logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+def camera_args(args) -> list:
+    '''The arguments of each camera. Without --camera it is the one camera of --stream and
+        --trigger. Each --camera [name=]stream,x,y,w,h,pin gets a copy of the other arguments,
+        and records to its own directory. Several cameras run headless, the windows can
+        only be shown from the main thread'''
+    if args.camera == None:
+        return [args]
+    cameras = []
+    for n, spec in enumerate(args.camera):
+        match = re.match(r"(\w+)=(.*)", spec)
+        name, spec = (match.group(1), match.group(2)) if match != None else (f"camera{n}", spec)
+        fields = spec.rsplit(',', 5)
+        if len(fields) != 6:
+            raise ValueError(f"--camera {spec} is not stream,x,y,w,h,pin")
+        camera = copy.copy(args)
+        camera.camera_name = name
+        camera.stream = fields[0]
+        camera.trigger = ','.join(fields[1:5])
+        camera.gpio_pin = int(fields[5])
+        if len(args.camera) > 1:
+            camera.record_path = os.path.join(args.record_path, name)
+            camera.headless = True
+        cameras.append(camera)
+    if len(set(c.camera_name for c in cameras)) != len(cameras) or len(set(c.gpio_pin for c in cameras)) != len(cameras):
+        raise ValueError("Each --camera needs its own name and GPIO pin")
+    return cameras
 
-def emit_image_to_web(sio, frame1):
-    '''Emit an image to the website'''    
-    # Convert the frame to JPEG format
-    _, buffer = cv.imencode('.jpg', frame1)
-    jpeg_bytes = base64.b64encode(buffer.tobytes()).decode('utf-8')
-    # Send the frame to the server, this does crash sometimes, so we catch it
+
+def open_camera(args, capture_policy:str, ring_size:int):
+    '''Create and open the image source of a camera, on a startup thread'''
+    from imgsrcfactory import ImageSourceFactory
+    img_src = ImageSourceFactory.create_source(args.stream, capture_policy, ring_size)
+    img_src.open()
+    # The detector and motion detection convert from the layout of the camera only when needed
+    logger.info(f"Image source {args.stream} delivers {img_src.pixel_format.value} frames")
+    return img_src
+
+
+def load_detector(args, num_threads:int):
+    '''Load the model and warm it up, on a startup thread'''
+    from tflite_detect import TFLiteDetect
+    input_size = tuple(int(x) for x in args.model_input.split(',')) if args.model_input != None else None
+    tflite = TFLiteDetect(args.model, args.enable_edgetpu, num_threads, input_size)
+    tflite.warmup(args.warmup, args.frameWidth, args.frameHeight)
+    startup.mark('detector_ready')
+    return tflite
+
+
+def run_camera(args, img_src, tflite, inference, config_store, publisher, stop) -> int:
+    '''Capture from one camera and run its state machine, until the stream ends or stop is set'''
+    from framepool import FramePool
+    from states import CatFlapFSM, Event
+    from statetypes import GlobalData, States
+    from stage_timing import timings
+    from inference_executor import InferenceClient
+    # A camera in these states has a cat at its flap, the shared model looks at it first
+    urgent_states = (States.TRIGGERING, States.MOVEMENT_LOCKED, States.MOUSE_LOCKED)
+
+    exit_code = 0
+    state_machine = None
+    pool = None
+    labels = {}
+    if getattr(args, 'camera_name', None) != None:
+        # Everything counted and logged on this thread is for this camera
+        labels = {'camera': args.camera_name}
+        metrics.bind(**labels)
+        bind_camera(args.camera_name)
     try:
-        sio.emit('image_data', {'image': jpeg_bytes})
-    except Exception as e:
-        logger.error(f"Error sending image to web: {e}")
+        # Frames are captured into a small pool of buffers, reused once the event queue and
+        # the inference have released them
+        pool = FramePool(args.frame_pool + args.inference_queue)
+        global_data = GlobalData(args, event=Event(pool.recycle(img_src.get_image())), tflite=tflite, inference=inference,
+                                 pixel_format=img_src.pixel_format, config_store=config_store,
+                                 frame_pool=pool)
+        state_machine = CatFlapFSM(global_data)
+        if isinstance(tflite, InferenceClient) == True:
+            tflite.urgent = lambda: state_machine.current_state.name in urgent_states
 
+        # Metrics are added up here and sent to the website every --metrics_interval seconds
+        if hasattr(img_src, 'dropped') == True:
+            metrics.sample('frames_dropped', lambda: img_src.dropped, 'counter', **labels)
+        metrics.sample('recorder_queue_depth', lambda: global_data.recorder.depth, **labels)
+        metrics.sample('recorder_dropped', lambda: global_data.recorder.dropped, 'counter', **labels)
+        metrics.sample('recorder_failed', lambda: global_data.recorder.failed, 'counter', **labels)
+        if inference != None:
+            metrics.sample('inference_pending', lambda: inference.pending, **labels)
 
+        # Main loop - here we go
+        while img_src.isopen == True and stop.is_set() == False:
+            with timings.span('capture'):
+                event = Event(pool.recycle(img_src.get_image(pool.acquire())))
+            if event.payload is None:
+                break
+            metrics.inc('frames_captured')
+            if publisher != None:
+                with timings.span('web_publish'):
+                    publisher.publish(event.payload)
+            if global_data.clip_recorder != None:
+                global_data.clip_recorder.add_frame(event.payload)
+            state_machine.event_handle(event)
+            startup.mark('first_frame')
+            if global_data.idle_sleep > 0:
+                with timings.span('idle_sleep'):
+                    stop.wait(global_data.idle_sleep)
+                global_data.idle_sleep = 0
+            if args.startup_benchmark == True and startup.reached('first_frame', 'detector_ready') == True:
+                break
+    except (Exception, SystemExit) as e:
+        logger.exception(f"Caught exception {e.__class__} - {e}")
+        exit_code = 1
+    finally:
+        if state_machine != None:
+            state_machine.exit()
+        if pool != None:
+            logger.info(f"{pool}")
+    return exit_code
 
 
 ''' The main loop entry point
 '''
 def main_loop(args):
-    img_src = ImageSourceFactory.create_source(args.stream)
-    img_src.open()
+    cameras = camera_args(args)
+
+    # The model loads and the cameras open at the same time, on startup threads. The
+    # cameras start as soon as they are open - idle needs no model - and the first
+    # detection waits for the model if it is not ready yet
+    capture_policy = None if args.capture_policy == 'none' else args.capture_policy
+    workers = 1 if len(cameras) == 1 else args.inference_workers
+    # With several copies of the model the cores are shared out between them
+    num_threads = args.num_threads if len(cameras) == 1 else max(1, args.num_threads // workers)
+    loader = ThreadPoolExecutor(max_workers=workers + len(cameras), thread_name_prefix='startup')
+    models = [loader.submit(load_detector, args, num_threads) for _ in range(workers)]
+    opening = [loader.submit(open_camera, camera, capture_policy, args.capture_ring) for camera in cameras]
+    loader.shutdown(wait=False)
 
-    # Connect to the Flask server using socketio
-    sio = None
+    import cv2 as cv
+    from tflite_detect import PendingDetector
+    from inference_executor import InferenceExecutor, InferencePool
+    from webpublisher import WebPublisher
+    from stage_timing import timings
+    from evalconfig import ConfigStore
+    from statetypes import CatDetection
+
+    # Stage timings are logged on SIGUSR1, and every --timing_report seconds
+    timings.resize(args.timing_window)
+    timings.install_signal()
+    timings.start_periodic(args.timing_report)
+
+    # Frames go to the Flask server on a background thread
+    publisher = None
     if hasattr(args, 'web') and args.web is not None:
-        logger.info(f"Connecting to web server at {args.web}")
-        sio = socketio.Client()
-        try:
-            sio.connect(args.web)
-        except:
-            logger.error(f"Connection to {args.web} failed")
-            delattr(args, 'web')
-        else:
-            logger.info(f"Connected to web server")
+        logger.info(f"Publishing to web server at {args.web}")
+        publisher = WebPublisher(args.web, args.web_fps, (args.web_width, args.web_height), args.web_quality)
 
     exit_code = 0
+    inference = None
+    config_store = None
+    sources = []
+    threads = []
+    stop = StopEvent()
+
+    def model_loaded(future):
+        '''Found out now, not when the first cat arrives'''
+        if future.exception() != None:
+            logger.error(f"Loading the model {args.model} failed - {future.exception()}")
+            stop.set()
+    for model in models:
+        model.add_done_callback(model_loaded)
+
     try:
-        logger.info("Started cat flap control")
-        state_machine = CatFlapFSM(GlobalData(args, event=Event(img_src.get_image())))
+        # The labels and thresholds are reloaded when the files change, or on SIGHUP
+        config_store = ConfigStore(args.label_json, args.trigger_json, args.eval_json, CatDetection)
+        config_store.install_signal()
+        config_store.start_watching(args.config_poll)
 
-        # Main loop - here we go
-        while img_src.isopen == True:
-            event = Event(img_src.get_image())
-            if event.payload is None:
-                break
-            if hasattr(args, 'web'):
-                # copy the image in event.payload
-                # apply overlay text with a small font size
-                # get current time hour, minute, second
-                
-                current_time = time.localtime() 
-                hour = current_time.tm_hour
-                minute = current_time.tm_min
-                second = current_time.tm_sec
-                frame_copy = event.payload.copy()
-                frame_copy = cv.putText(frame_copy, f'{hour:02}:{minute:02}:{second:02}', (10, 30), cv.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-                emit_image_to_web(sio, frame_copy)
-            state_machine.event_handle(event)
-    except Exception as e:
+        sources = [camera.result() for camera in opening]
+        startup.mark('cameras_open')
+
+        if len(cameras) == 1:
+            tflite = PendingDetector(models[0], sources[0].pixel_format)
+            if args.async_inference == True:
+                inference = InferenceExecutor(tflite, args.inference_queue)
+            detectors = [(tflite, inference)]
+        else:
+            # The cameras share the model
+            inference = InferencePool([PendingDetector(m) for m in models], args.inference_queue, args.inference_max_wait)
+            clients = [inference.client(c.camera_name, s.pixel_format) for c, s in zip(cameras, sources)]
+            detectors = [(c, c if args.async_inference == True else None) for c in clients]
+
+        if publisher != None:
+            metrics.start_push(lambda delta: publisher.emit('metrics', delta), args.metrics_interval)
+
+        if len(cameras) == 1:
+            exit_code = run_camera(cameras[0], sources[0], *detectors[0], config_store, publisher, stop)
+        else:
+            # A thread per camera, the first one is shown on the website
+            results = [0] * len(cameras)
+            def run(n):
+                results[n] = run_camera(cameras[n], sources[n], *detectors[n], config_store, publisher if n == 0 else None, stop)
+                if results[n] != 0:
+                    # Stop them all, to be restarted together
+                    stop.set()
+            threads = [Thread(target=run, args=(n,), name=c.camera_name) for n, c in enumerate(cameras)]
+            for t in threads:
+                t.start()
+            # Joined with a timeout so Ctrl-C still gets through
+            for t in threads:
+                while t.is_alive() == True:
+                    t.join(0.5)
+            exit_code = max(results)
+        if any(m.done() == True and m.exception() != None for m in models):
+            exit_code = 1
+    except (Exception, SystemExit) as e:
         logger.exception(f"Caught exception {e.__class__} - {e}")
-        time.sleep(2)
         exit_code = 1
     finally:
         # Goodbye, world
-        cv.destroyAllWindows()
-        state_machine.exit()
-        img_src.close()
+        stop.set()
+        for t in threads:
+            t.join()
+        if inference != None:
+            inference.shutdown()
+        if config_store != None:
+            config_store.stop_watching()
+            logger.info(f"{config_store}")
+        if publisher != None:
+            publisher.close()
+        for camera in opening:
+            if camera.done() == True and camera.exception() == None:
+                camera.result().close()
+        timings.stop_periodic()
+        metrics.stop_push()
+        timings.log_report()
+        if args.startup_benchmark == True:
+            logger.info(f"{startup}")
+        # Last, a headless OpenCV build raises here
+        try:
+            cv.destroyAllWindows()
+        except cv.error as e:
+            logger.debug(f"No windows to close - {e}")
         return exit_code
 
 
@@ -94,11 +265,57 @@ def main():
         default='./recording', # See copy_recordings.sh
         required=False,
         type=str, action='store',)
+    parser.add_argument('--record_quality', 
+        help="JPEG quality of recorded images, 0-100",
+        default=90,
+        required=False,
+        type=int, action='store',)
+    parser.add_argument('--record_queue', 
+        help="Number of images that can wait to be written",
+        default=8,
+        required=False,
+        type=int, action='store',)
+    parser.add_argument('--record_policy', 
+        help="When the record queue is full drop the image, or block for up to --record_timeout seconds",
+        default='drop',
+        choices=['drop', 'block'],
+        required=False,
+        type=str, action='store',)
+    parser.add_argument('--record_timeout', 
+        help="Seconds to wait for space in the record queue with --record_policy block",
+        default=0.1,
+        required=False,
+        type=float, action='store',)
+    parser.add_argument('--record_clips', 
+        help="Record a video clip of every episode, starting --preroll seconds before the trigger",
+        required=False,
+        action='store_true',)
+    parser.add_argument('--preroll', 
+        help="Seconds of video kept in memory to record before each trigger",
+        default=5,
+        required=False,
+        type=float, action='store',)
+    parser.add_argument('--clip_memory', 
+        help="Maximum MB of compressed video held in memory for a clip",
+        default=32,
+        required=False,
+        type=float, action='store',)
+    parser.add_argument('--clip_scale', 
+        help="Downscale factor for recorded clips",
+        default=0.5,
+        required=False,
+        type=float, action='store',)
     parser.add_argument(
         '--trigger', 
         help="Define the trigger area coordinates x,y,w,h",
         action='store', 
-        required=True)
+        required=False)
+    parser.add_argument(
+        '--camera', 
+        help="A camera and its cat flap as [name=]stream,x,y,w,h,pin - the stream, trigger area and GPIO pin of the relay. "
+             "Repeat for each flap, they share one model. Replaces --stream and --trigger, only the first is shown on the website",
+        action='append', 
+        required=False)
     parser.add_argument(
         '--record_overlays', 
         help="Record overlays in the video stream",
@@ -120,6 +337,41 @@ def main():
         action='store', 
         type=str, 
         required=False)
+    parser.add_argument(
+        '--web_fps', 
+        help="Maximum frames per second sent to the monitoring website",
+        action='store', 
+        type=float, 
+        default=5,
+        required=False)
+    parser.add_argument(
+        '--web_width', 
+        help="Width of the frames sent to the monitoring website",
+        action='store', 
+        type=int, 
+        default=640,
+        required=False)
+    parser.add_argument(
+        '--web_height', 
+        help="Height of the frames sent to the monitoring website",
+        action='store', 
+        type=int, 
+        default=480,
+        required=False)
+    parser.add_argument(
+        '--web_quality', 
+        help="JPEG quality of the frames sent to the monitoring website, 0-100",
+        action='store', 
+        type=int, 
+        default=80,
+        required=False)
+    parser.add_argument(
+        '--metrics_interval', 
+        help="Seconds between metrics updates sent to the monitoring website",
+        action='store', 
+        type=float, 
+        default=5,
+        required=False)
     parser.add_argument(
         '--label-json', 
         help="JSON file containing the detection labels",
@@ -141,6 +393,49 @@ def main():
         required=False, 
         type=str,   
         default='./eval_config.json')
+    parser.add_argument(
+        '--config_poll', 
+        help="Seconds between looking for changes to the label, trigger and eval JSON files, which are then reloaded. 0 only reloads on SIGHUP",
+        action='store', 
+        required=False, 
+        type=float,   
+        default=2)
+    parser.add_argument(
+        '--motion_mode', 
+        help="Motion detection in idle - running background model, or the original two frame difference",
+        choices=['background', 'diff'],
+        required=False, 
+        default='background')
+    parser.add_argument(
+        '--motion_scale', 
+        help="Downscale factor for the trigger area in background motion detection",
+        required=False, 
+        type=float,
+        default=0.5)
+    parser.add_argument(
+        '--motion_alpha', 
+        help="How quickly the background model follows the scene, 0-1",
+        required=False, 
+        type=float,
+        default=0.05)
+    parser.add_argument(
+        '--idle_min_interval', 
+        help="Shortest sleep in seconds between idle frames, used when there is small motion",
+        required=False, 
+        type=float,
+        default=0.05)
+    parser.add_argument(
+        '--idle_max_interval', 
+        help="Longest sleep in seconds between idle frames, ie. the worst case trigger latency",
+        required=False, 
+        type=float,
+        default=1.0)
+    parser.add_argument(
+        '--idle_cpu_budget', 
+        help="Fraction of a CPU core idle motion detection may use, 0-1",
+        required=False, 
+        type=float,
+        default=0.25)
     #  ML Parameters
     parser.add_argument(
         '--model',
@@ -154,6 +449,24 @@ def main():
         required=False, 
         type=str, 
         default='0')
+    parser.add_argument(
+        '--capture_policy',
+        help='Capture on a background thread - latest frame wins, drop oldest - or none to capture inline, the default.',
+        required=False,
+        choices=['latest', 'drop_oldest', 'none'],
+        default='none')
+    parser.add_argument(
+        '--capture_ring',
+        help='Number of preallocated frame buffers in the capture ring.',
+        required=False,
+        type=int,
+        default=4)
+    parser.add_argument(
+        '--frame_pool',
+        help='Number of frame buffers reused by the main loop, the inference queue is added to this.',
+        required=False,
+        type=int,
+        default=6)
     parser.add_argument(
         '--frameWidth',
         help='Width of frame to capture from camera.',
@@ -172,6 +485,114 @@ def main():
         required=False,
         type=int,
         default=4)
+    parser.add_argument(
+        '--model_input',
+        help='Model input size w,h. Images are cropped and resized to it in one step, ie. 320,320 for efficientdet_lite0.',
+        required=False,
+        type=str,
+        default=None)
+    parser.add_argument(
+        '--inference_roi',
+        help='Part of the image the model sees - the whole frame, the trigger area, or the motion that triggered.',
+        required=False,
+        choices=['full', 'trigger', 'motion'],
+        default='full')
+    parser.add_argument(
+        '--roi_padding',
+        help='Pixels added around the trigger area or motion boxes for the model.',
+        required=False,
+        type=int,
+        default=32)
+    parser.add_argument(
+        '--warmup',
+        help='Number of warm up inferences to run when the model is loaded.',
+        required=False,
+        type=int,
+        default=2)
+    parser.add_argument(
+        '--async_inference',
+        help='Run the model on its own thread so capture and motion detection never wait for it.',
+        action='store_true',
+        required=False,
+        default=False)
+    parser.add_argument(
+        '--inference_queue',
+        help='Maximum number of frames waiting for the model, older frames are dropped.',
+        required=False,
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--inference_workers',
+        help='With several cameras, number of copies of the model run in parallel. --num_threads is shared out between them.',
+        required=False,
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--inference_max_wait',
+        help='With several cameras, seconds a frame of a camera without a cat waits before it goes ahead of the others.',
+        required=False,
+        type=float,
+        default=0.5)
+    parser.add_argument(
+        '--startup_benchmark',
+        help='Exit as soon as the detector is ready and the first frame is processed, and log how long each took.',
+        action='store_true',
+        required=False,
+        default=False)
+    parser.add_argument(
+        '--timing_window',
+        help='Number of recent runs of each stage kept for the timing report.',
+        required=False,
+        type=int,
+        default=512)
+    parser.add_argument(
+        '--timing_report',
+        help='Seconds between timing reports in the log, 0 to only report on SIGUSR1.',
+        required=False,
+        type=float,
+        default=0)
+    parser.add_argument(
+        '--result_cache',
+        help='Number of recent detections kept to reuse for unchanged frames in the locked and unlocked states, 0 is off.',
+        required=False,
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--result_cache_age',
+        help='Seconds a detection can be reused for.',
+        required=False,
+        type=float,
+        default=2.0)
+    parser.add_argument(
+        '--result_cache_distance',
+        help='Bits of the 192 bit frame hash that may differ for frames to count as unchanged.',
+        required=False,
+        type=int,
+        default=4)
+    parser.add_argument(
+        '--log_dir',
+        help='Directory of the log file.',
+        required=False,
+        type=str,
+        default='./log/')
+    parser.add_argument(
+        '--log_max_mb',
+        help='Size in MB the log grows to before it is rotated and compressed.',
+        required=False,
+        type=float,
+        default=10)
+    parser.add_argument(
+        '--log_backups',
+        help='Number of compressed logs kept, 0 keeps them all.',
+        required=False,
+        type=int,
+        default=50)
+    parser.add_argument(
+        '--log_json',
+        help='Also write transitions and detections as JSON lines to catflap.jsonl.',
+        action='store_true',
+        required=False,
+        default=False)
     parser.add_argument(
         '--enable_edgetpu',
         help='Whether to run the model on EdgeTPU.',
@@ -180,8 +601,18 @@ def main():
         default=False)
     
     args = parser.parse_args()
+    if args.camera == None and args.trigger == None:
+        parser.error("--trigger or --camera is required")
+    try:
+        camera_args(args)
+    except ValueError as e:
+        parser.error(str(e))
 
+    # Logs are written by a listener thread from here on, never on the control loop
+    configure_logging(args.log_dir, max_bytes=int(args.log_max_mb * 1024 * 1024),
+                      backups=args.log_backups, json_lines=args.log_json)
     logger.info("Started cat flap control")
+    startup.mark('main')
     sys.exit(main_loop(args))
     
 
@@ -0,0 +1,175 @@
+import cv2 as cv
+import numpy as np
+from enum import Enum
+
+from base_logger import logger
+from pixelformat import PixelFormat, to_gray
+
+
+class MotionMode(str, Enum):
+    DIFF = 'diff'
+    BACKGROUND = 'background'
+
+
+class FrameDiffMotion():
+    '''The original motion detector - difference of the last two frames in the
+        trigger area, blurred, thresholded and dilated before looking for contours'''
+    def __init__(self, trigger:tuple, pixel_format:PixelFormat=PixelFormat.BGR, **kwargs) -> None:
+        self._bc, self._br, self._bcw, self._brh = trigger
+        self._pixel_format = pixel_format
+        self._energy = 0
+
+    @property
+    def energy(self) -> float:
+        '''Fraction of the trigger area that changed in the last frame'''
+        return self._energy
+
+    def reset(self) -> None:
+        pass
+
+    def detect(self, frame1, frame2) -> list:
+        '''Returns a list of (x, y, w, h, area) for each moving contour, relative
+            to the trigger area'''
+        cp1 = frame1[self._br:self._brh, self._bc:self._bcw]
+        cp2 = frame2[self._br:self._brh, self._bc:self._bcw]
+
+        diff = cv.absdiff(cp1, cp2)
+        diff_gray = to_gray(diff, self._pixel_format)
+        blur = cv.GaussianBlur(diff_gray, (5, 5), 0)
+        _, thresh = cv.threshold(blur, 20, 255, cv.THRESH_BINARY)
+        self._energy = cv.countNonZero(thresh) / thresh.size
+        dilated = cv.dilate(thresh, None, iterations=3)
+        contours, _ = cv.findContours(dilated, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+
+        return [cv.boundingRect(c) + (cv.contourArea(c),) for c in contours]
+
+
+class BackgroundMotion():
+    '''Motion against a running background model. The trigger area is downscaled into
+        a grayscale buffer, compared to the background and the background is updated
+        (accumulateWeighted). All buffers are allocated once and reused. Contours are only
+        searched for when enough pixels changed, most idle frames stop before that.'''
+    def __init__(self, trigger:tuple, scale:float=0.5, alpha:float=0.05, threshold:int=20,
+                 min_changed:int=25, pixel_format:PixelFormat=PixelFormat.BGR, **kwargs) -> None:
+        self._bc, self._br, self._bcw, self._brh = trigger
+        self._pixel_format = pixel_format
+        self._scale = scale
+        self._alpha = alpha
+        self._threshold = threshold
+        self._min_changed = min_changed
+        self._size = (max(1, int((self._bcw - self._bc) * scale)), max(1, int((self._brh - self._br) * scale)))
+        self._kernel = np.ones((3, 3), np.uint8)
+        self._energy = 0
+
+        w, h = self._size
+        self._small = None      # Allocated on the first frame, when the channel count is known
+        self._gray = np.empty((h, w), np.uint8)
+        self._background = np.empty((h, w), np.float32)
+        self._background_u8 = np.empty((h, w), np.uint8)
+        self._diff = np.empty((h, w), np.uint8)
+        self._mask = np.empty((h, w), np.uint8)
+        self._dilated = np.empty((h, w), np.uint8)
+        self._has_background = False
+
+    @property
+    def energy(self) -> float:
+        '''Fraction of the trigger area that differs from the background'''
+        return self._energy
+
+    def reset(self) -> None:
+        '''Forget the background, ie. after an episode it is probably out of date'''
+        self._has_background = False
+
+    def _to_gray(self, frame) -> np.ndarray:
+        '''Downscale the trigger area of the frame into the reused grayscale buffer'''
+        crop = frame[self._br:self._brh, self._bc:self._bcw]
+        if crop.ndim == 2:
+            cv.resize(crop, self._size, dst=self._gray, interpolation=cv.INTER_AREA)
+        else:
+            if self._small is None or self._small.shape[2] != crop.shape[2]:
+                self._small = np.empty((self._size[1], self._size[0], crop.shape[2]), np.uint8)
+            cv.resize(crop, self._size, dst=self._small, interpolation=cv.INTER_AREA)
+            to_gray(self._small, self._pixel_format, dst=self._gray)
+        return self._gray
+
+    def detect(self, frame1, frame2) -> list:
+        '''Returns a list of (x, y, w, h, area) for each moving contour, relative
+            to the trigger area. Only the newest frame (frame2) is used.'''
+        gray = self._to_gray(frame2)
+        if self._has_background == False:
+            self._background[:] = gray
+            self._has_background = True
+            self._energy = 0
+            return []
+
+        cv.convertScaleAbs(self._background, dst=self._background_u8)
+        cv.absdiff(gray, self._background_u8, dst=self._diff)
+        cv.threshold(self._diff, self._threshold, 255, cv.THRESH_BINARY, dst=self._mask)
+        cv.accumulateWeighted(gray, self._background, self._alpha)
+        changed = cv.countNonZero(self._mask)
+        self._energy = changed / self._mask.size
+        if changed < self._min_changed:
+            return []
+
+        cv.dilate(self._mask, self._kernel, dst=self._dilated, iterations=2)
+        contours, _ = cv.findContours(self._dilated, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+        # Back to full resolution trigger area coordinates
+        s = self._scale
+        retval = []
+        for c in contours:
+            x, y, w, h = cv.boundingRect(c)
+            retval.append((int(x / s), int(y / s), int(w / s), int(h / s), cv.contourArea(c) / (s * s)))
+        return retval
+
+
+def create_motion_detector(mode:str, trigger:tuple, **kwargs):
+    '''Create the motion detector for the given mode'''
+    if MotionMode(mode) == MotionMode.DIFF:
+        return FrameDiffMotion(trigger, **kwargs)
+    return BackgroundMotion(trigger, **kwargs)
+
+
+
+def main():
+    '''Benchmark - CPU time per idle frame for each motion detector.
+        Uses a video if one is given, otherwise a synthetic quiet scene with sensor noise'''
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="Motion detector benchmark")
+    parser.add_argument('--video', help="Video to run the detectors over", required=False, type=str)
+    parser.add_argument('--trigger', help="Trigger area x,y,w,h", default='210,180,250,280', type=str)
+    parser.add_argument('--frames', help="Number of synthetic frames", default=500, type=int)
+    args = parser.parse_args()
+
+    bc, br, bw, bh = [int(x) for x in args.trigger.split(',')]
+    trigger = (bc, br, bc + bw, br + bh)
+
+    frames = []
+    if args.video != None:
+        cap = cv.VideoCapture(args.video)
+        success, frame = cap.read()
+        while success == True:
+            frames.append(frame)
+            success, frame = cap.read()
+        cap.release()
+    else:
+        rng = np.random.default_rng(0)
+        base = rng.integers(0, 255, (480, 640, 3), np.uint8)
+        for _ in range(args.frames):
+            noise = rng.integers(-4, 5, base.shape)
+            frames.append(np.clip(base + noise, 0, 255).astype(np.uint8))
+
+    for mode in MotionMode:
+        detector = create_motion_detector(mode, trigger)
+        triggers = 0
+        start = time.process_time()
+        for i in range(1, len(frames)):
+            boxes = detector.detect(frames[i-1], frames[i])
+            if any(w * h > 2000 for x, y, w, h, a in boxes):
+                triggers += 1
+        cpu = time.process_time() - start
+        print(f"{mode.value:12} {len(frames) - 1} frames, {cpu / (len(frames) - 1) * 1e6:8.1f}us CPU per frame, {triggers} triggers")
+
+
+if __name__ == "__main__":
+    main()
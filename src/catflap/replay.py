@@ -0,0 +1,258 @@
+'''Headless replay benchmark. Runs the real CatFlapFSM over a directory of recorded
+*_catcam.mp4 clips as fast as possible, with a fake cat flap, and reports how long
+each stage of the pipeline takes, the end to end frame rate, and what was decided
+for each clip. Without a model a stub detector is used.
+
+python replay.py --clips ./recordings --trigger 210,180,250,280 --model cats.tflite --output replay.json
+'''
+import argparse
+import glob
+import json
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from os import path
+
+import numpy as np
+
+from base_logger import logger
+from states import CatFlapFSM
+from statetypes import GlobalData, Event
+from imgsrcmp4 import ImageSourceMP4Video
+from tflite_detect import TFLDetection, BoundingRect
+import evaluation
+
+
+class StageTimes():
+    '''Collects every sample for each stage, replays are short enough to keep them all'''
+    def __init__(self) -> None:
+        self._samples = defaultdict(list)
+
+    def add(self, stage:str, seconds:float) -> None:
+        self._samples[stage].append(seconds)
+
+    def timed(self, stage:str, func, *args):
+        '''Call func(*args) and time it as the stage'''
+        start = time.perf_counter()
+        retval = func(*args)
+        self._samples[stage].append(time.perf_counter() - start)
+        return retval
+
+    def summary(self) -> dict:
+        retval = {}
+        for stage, samples in self._samples.items():
+            ms = np.array(samples) * 1000
+            retval[stage] = {
+                'count': len(ms),
+                'mean_ms': round(float(ms.mean()), 3),
+                'p50_ms': round(float(np.percentile(ms, 50)), 3),
+                'p95_ms': round(float(np.percentile(ms, 95)), 3),
+                'p99_ms': round(float(np.percentile(ms, 99)), 3),
+                'total_s': round(float(ms.sum() / 1000), 3)}
+        return retval
+
+
+class FakeCatFlapControl():
+    '''Stands in for the GPIO cat flap control and counts what it is asked to do'''
+    def __init__(self) -> None:
+        self._locked = False
+        self.locks = 0
+        self.unlocks = 0
+
+    @property
+    def locked(self) -> bool:
+        return self._locked
+
+    @property
+    def gpio_state(self) -> int:
+        return 1 if self._locked == True else 0
+
+    def lock(self) -> None:
+        self._locked = True
+        self.locks += 1
+
+    def unlock(self) -> None:
+        self._locked = False
+        self.unlocks += 1
+
+    def exit(self) -> None:
+        self.unlock()
+
+
+class StubDetector():
+    '''Used when there is no model - every frame gets the same detection'''
+    def __init__(self, label:str, score:float, labels:list) -> None:
+        self._detection = TFLDetection(label, labels.index(label) if label in labels else 0, score, BoundingRect(0, 0, 1, 1))
+
+    def detect(self, image, roi=None):
+        yield self._detection
+
+    def create_overlays(self, frame, detections=None):
+        return frame
+
+
+class TimedDetector():
+    '''Times each detection as the detect stage'''
+    def __init__(self, detector, times:StageTimes) -> None:
+        self._detector = detector
+        self._times = times
+
+    def detect(self, image, roi=None) -> list:
+        return self._times.timed('detect', lambda i, r: list(self._detector.detect(i, r)), image, roi)
+
+    def __getattr__(self, name):
+        return getattr(self._detector, name)
+
+
+class TimedMotion():
+    '''Times the idle motion detection'''
+    def __init__(self, motion, times:StageTimes) -> None:
+        self._motion = motion
+        self._times = times
+
+    def detect(self, frame1, frame2) -> list:
+        return self._times.timed('motion', self._motion.detect, frame1, frame2)
+
+    def __getattr__(self, name):
+        return getattr(self._motion, name)
+
+
+class ReplayFSM(CatFlapFSM):
+    '''The real state machine, that also times the transitions and remembers the states visited'''
+    def __init__(self, global_data, cat_flap_control, times:StageTimes) -> None:
+        self._times = times
+        self._transition_start = None
+        self.visited = []
+        super(ReplayFSM, self).__init__(global_data, cat_flap_control)
+
+    def before_transition(self, event, state):
+        self._transition_start = time.perf_counter()
+
+    def after_transition(self, event, state):
+        if self._transition_start != None:
+            self._times.add('transition', time.perf_counter() - self._transition_start)
+            self._transition_start = None
+        if len(self.visited) == 0 or self.visited[-1] != state.id:
+            self.visited.append(state.id)
+
+
+def decision(visited:list) -> str:
+    '''What the cat flap ended up deciding for a clip'''
+    if 'mouseLockedState' in visited:
+        return 'mouse_locked'
+    if 'unlockedState' in visited:
+        return 'unlocked'
+    if 'movementLockedState' in visited:
+        return 'movement_locked'
+    if 'triggeringState' in visited:
+        return 'false_trigger'
+    return 'idle'
+
+
+def replay_clip(clip:str, args, detector, times:StageTimes) -> dict:
+    '''Run one clip through a fresh state machine'''
+    img_src = ImageSourceMP4Video(source=clip)
+    if img_src.open() != 0:
+        return {'clip': clip, 'error': 'could not open'}
+
+    first = times.timed('capture', img_src.get_image)
+    data = GlobalData(args, event=Event(first), tflite=TimedDetector(detector, times))
+    data.motion_detector = TimedMotion(data.motion_detector, times)
+    control = FakeCatFlapControl()
+    fsm = ReplayFSM(data, control, times)
+
+    frames = 1
+    start = time.perf_counter()
+    try:
+        while img_src.isopen == True:
+            frame = times.timed('capture', img_src.get_image)
+            if type(frame) == type(None):
+                break
+            frames += 1
+            times.timed('event_handle', fsm.event_handle, Event(frame))
+    finally:
+        elapsed = time.perf_counter() - start
+        fsm.exit()
+        img_src.close()
+
+    return {'clip': path.basename(clip), 'frames': frames, 'seconds': round(elapsed, 3),
+            'fps': round(frames / elapsed, 1) if elapsed > 0 else 0,
+            'states': fsm.visited, 'locks': control.locks, 'unlocks': control.unlocks,
+            'decision': decision(fsm.visited)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded clips through the cat flap state machine")
+    parser.add_argument('--clips', help="Directory of *_catcam.mp4 recordings", required=True, type=str)
+    parser.add_argument('--trigger', help="Define the trigger area coordinates x,y,w,h", required=True, type=str)
+    parser.add_argument('--model', help="Path of the object detection model, without it a stub detector is used", type=str)
+    parser.add_argument('--num_threads', help="Number of CPU threads to run the model", type=int, default=4)
+    parser.add_argument('--enable_edgetpu', help="Run the model on EdgeTPU", action='store_true')
+    parser.add_argument('--stub_label', help="Label the stub detector returns", type=str, default='Cat-alone')
+    parser.add_argument('--stub_score', help="Score the stub detector returns", type=float, default=0.6)
+    parser.add_argument('--motion_mode', help="Idle motion detection", choices=['background', 'diff'], default='background')
+    parser.add_argument('--result_cache', help="Detections kept to reuse for unchanged frames, 0 is off", type=int, default=0)
+    parser.add_argument('--result_cache_age', help="Seconds a detection can be reused for", type=float, default=2.0)
+    parser.add_argument('--inference_roi', help="Part of the image the model sees", choices=['full', 'trigger', 'motion'], default='full')
+    parser.add_argument('--roi_padding', help="Pixels added around the region of interest", type=int, default=32)
+    parser.add_argument('--model_input', help="Model input size w,h to resize to before inference", type=str)
+    parser.add_argument('--label-json', help="JSON file containing the detection labels", type=str, default='./labels.json')
+    parser.add_argument('--trigger-json', help="JSON file with the triggering state evaluation", type=str, default='./trigger_config.json')
+    parser.add_argument('--eval-json', help="JSON file with the motion locked state evaluation", type=str, default='./eval_config.json')
+    parser.add_argument('--record_path', help="Where decision images go, a temporary directory by default", type=str)
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout", type=str)
+    args = parser.parse_args()
+
+    # Replay as fast as possible - no idle sleeping, no windows
+    args.headless = True
+    args.idle_min_interval = 0
+    args.idle_max_interval = 0
+    # All of a core, or the scheduler still sleeps to keep idle inside its CPU budget
+    args.idle_cpu_budget = 1.0
+    if args.record_path == None:
+        args.record_path = tempfile.mkdtemp(prefix='replay')
+
+    clips = sorted(glob.glob(path.join(args.clips, '**', '*_catcam.mp4'), recursive=True))
+    if len(clips) == 0:
+        logger.error(f"No *_catcam.mp4 clips found in {args.clips}")
+        return 1
+
+    times = StageTimes()
+    if args.model != None:
+        from tflite_detect import TFLiteDetect
+        input_size = tuple(int(x) for x in args.model_input.split(',')) if args.model_input != None else None
+        detector = TFLiteDetect(args.model, args.enable_edgetpu, args.num_threads, input_size)
+        detector.warmup(2)
+    else:
+        with open(args.label_json) as j:
+            detector = StubDetector(args.stub_label, args.stub_score, json.load(j)['labels'])
+
+    # Evaluation objects are created inside the states, so time them at the class
+    add_record = evaluation.VectorEvaluation.add_record
+    add_records = evaluation.VectorEvaluation.add_records
+    evaluation.VectorEvaluation.add_record = lambda self, label, value: times.timed('add_record', add_record, self, label, value)
+    evaluation.VectorEvaluation.add_records = lambda self, labels, values, until=(): times.timed('add_records', add_records, self, labels, values, until)
+
+    results = []
+    start = time.perf_counter()
+    for clip in clips:
+        logger.info(f"Replaying {clip}")
+        results.append(replay_clip(clip, args, detector, times))
+    elapsed = time.perf_counter() - start
+    frames = sum(r.get('frames', 0) for r in results)
+
+    report = {'model': args.model if args.model != None else f"stub {args.stub_label} {args.stub_score}",
+              'clips': len(clips), 'frames': frames, 'seconds': round(elapsed, 3),
+              'fps': round(frames / elapsed, 1) if elapsed > 0 else 0,
+              'stages': times.summary(), 'results': results}
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
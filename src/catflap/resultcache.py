@@ -0,0 +1,139 @@
+'''Reuse detections for frames that have not changed. A cat sitting in front of
+the flap gives minutes of nearly identical frames, there is no need to run the
+model on each one.
+
+Each frame gets a difference hash - the frame is shrunk to a tiny grayscale image
+and every pixel is compared with its right neighbour, one bit each. Frames whose
+hashes differ in only a few bits look the same. The detections of recent frames
+are kept in a small LRU cache keyed by the hash, and are reused for up to max_age
+seconds after the model produced them.
+'''
+from collections import OrderedDict
+import time
+
+import cv2 as cv
+import numpy as np
+
+from base_logger import logger
+from pipeline_metrics import metrics
+
+
+class ResultCache():
+    def __init__(self, size:int=8, max_age:float=2.0, max_distance:int=4, hash_size:tuple=(16, 12)) -> None:
+        self._size = size
+        self._max_age = max_age
+        self._max_distance = max_distance
+        # One column more than bits per row, each bit compares two neighbours
+        self._small_size = (hash_size[0] + 1, hash_size[1])
+        self._sample_size = (self._small_size[0] * 4, self._small_size[1] * 4)
+        self._sample = None
+        self._small = None
+        self._gray = np.empty((hash_size[1], hash_size[0] + 1), np.uint8)
+        self._entries = OrderedDict()  # hash bytes -> (bits, detections, time)
+
+        # Counters
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__} hits {self._hits} misses {self._misses} expired {self._expired} hit rate {self.hit_rate * 100:.1f}%"
+
+    '''Counters'''
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def hit_rate(self) -> float:
+        total = self._hits + self._misses
+        return self._hits / total if total > 0 else 0
+
+    def frame_hash(self, image:np.ndarray) -> np.ndarray:
+        '''The difference hash of the image as packed bits. The image is sampled down to
+            4x the hash size first - an area resize straight from the full frame costs
+            30 times as much - and then averaged down to the hash size'''
+        if self._sample is None or self._sample.shape[2:] != image.shape[2:]:
+            self._sample = np.empty((self._sample_size[1], self._sample_size[0]) + image.shape[2:], np.uint8)
+            self._small = np.empty((self._small_size[1], self._small_size[0]) + image.shape[2:], np.uint8)
+        cv.resize(image, self._sample_size, dst=self._sample, interpolation=cv.INTER_LINEAR)
+        if image.ndim == 2:
+            cv.resize(self._sample, self._small_size, dst=self._gray, interpolation=cv.INTER_AREA)
+        else:
+            cv.resize(self._sample, self._small_size, dst=self._small, interpolation=cv.INTER_AREA)
+            # The channel order does not matter for a hash
+            cv.cvtColor(self._small, cv.COLOR_BGR2GRAY, dst=self._gray)
+        return np.packbits(self._gray[:, 1:] > self._gray[:, :-1])
+
+    @staticmethod
+    def distance(a:np.ndarray, b:np.ndarray) -> int:
+        '''Number of bits that differ'''
+        return int(np.unpackbits(np.bitwise_xor(a, b)).sum())
+
+    def lookup(self, bits:np.ndarray) -> list:
+        '''The detections of a cached frame that looks like this one, or None'''
+        now = time.monotonic()
+        retval = None
+        for key in list(self._entries.keys()):
+            cached, detections, stamp = self._entries[key]
+            if now - stamp > self._max_age:
+                del self._entries[key]
+                self._expired += 1
+                continue
+            if retval == None and self.distance(bits, cached) <= self._max_distance:
+                self._entries.move_to_end(key)
+                retval = detections
+        if retval == None:
+            self._misses += 1
+            metrics.inc('result_cache_misses')
+        else:
+            self._hits += 1
+            metrics.inc('result_cache_hits')
+        return retval
+
+    def store(self, bits:np.ndarray, detections:list) -> None:
+        '''Remember the detections the model produced for a frame'''
+        self._entries[bits.tobytes()] = (bits, detections, time.monotonic())
+        self._entries.move_to_end(bits.tobytes())
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        '''Forget everything, ie. at the start of a new episode'''
+        self._entries.clear()
+
+
+def main():
+    '''Hit rate and cost of the cache on a video'''
+    import argparse
+    parser = argparse.ArgumentParser(description="Result cache hit rate on a video")
+    parser.add_argument('--video', help="Video to run over", required=True, type=str)
+    parser.add_argument('--max_age', help="Seconds a result can be reused for", type=float, default=2.0)
+    parser.add_argument('--max_distance', help="Bits the hashes may differ by", type=int, default=4)
+    args = parser.parse_args()
+
+    cache = ResultCache(max_age=args.max_age, max_distance=args.max_distance)
+    cap = cv.VideoCapture(args.video)
+    frame = None
+    frames = 0
+    elapsed = 0
+    while True:
+        success, frame = cap.read(frame)
+        if success == False:
+            break
+        start = time.perf_counter()
+        bits = cache.frame_hash(frame)
+        if cache.lookup(bits) == None:
+            cache.store(bits, [frames])
+        elapsed += time.perf_counter() - start
+        frames += 1
+    cap.release()
+    print(f"{cache}, {elapsed / max(frames, 1) * 1e6:.0f}us per frame")
+
+
+if __name__ == "__main__":
+    main()
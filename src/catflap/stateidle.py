@@ -4,6 +4,7 @@ import time
 
 from statetypes import TState, GlobalData, Event, States
 from base_logger import logger
+from stage_timing import timings
 
 
 class IdleState(TState):
@@ -16,31 +17,27 @@ class IdleState(TState):
         '''When we return to idle we unlock the cat flap, so cats can exit from the inside'''
         data.cat_flap_control.unlock()
         data.timeout_timer.cancel()
+        data.motion_detector.reset()
+        if data.clip_recorder != None:
+            data.clip_recorder.end_episode()
 
     def run(self, event:Event, data:GlobalData) -> States:
         '''
         Detect movement
-        No movement? Sleep 1 second. Return States.IDLE
+        No movement? Leave data.idle_sleep at as long as the idle scheduler says to sleep. Return States.IDLE
         evaluation.add_record(event.label, event.score)
         '''
         retval = States.IDLE
+        start = time.monotonic()
         frame1, frame2 = data.get_images(2) # Get newest 2 images from queue
 
-        cp1 = frame1[data.trigger_br:data.trigger_brh, data.trigger_bc:data.trigger_bcw].copy()
-        cp2 = frame2[data.trigger_br:data.trigger_brh, data.trigger_bc:data.trigger_bcw].copy()
-
-        diff = cv.absdiff(cp1, cp2)
-        diff_gray = cv.cvtColor(diff, cv.COLOR_BGR2GRAY)
-        blur = cv.GaussianBlur(diff_gray, (5, 5), 0)
-        _, thresh = cv.threshold(blur, 20, 255, cv.THRESH_BINARY)
-        dilated = cv.dilate(thresh, None, iterations=3)
-        contours, _ = cv.findContours(dilated, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+        # Each moving area is (x, y, w, h, area) relative to the trigger area
+        moving = data.motion_detector.detect(frame1, frame2)
 
         if data.headless == False:
-            new_image = frame2.copy()
-            for contour in contours:
-                if cv.contourArea(contour) > 200:  # Filter small contours
-                    x, y, w, h = cv.boundingRect(contour)
+            new_image = data.display_image(frame2)
+            for x, y, w, h, area in moving:
+                if area > 200:  # Filter small contours
                     colour = (0, 255, 0)
                     if w * h > 2000:
                         colour = (0, 0, 255)
@@ -50,16 +47,22 @@ class IdleState(TState):
             cv.waitKey(30)
 
         # Check if enough movement is found - is there a big enough rectangle
-        total_area = 0
-        for contour in contours:
-            x, y, w, h = cv.boundingRect(contour)
+        for x, y, w, h, area in moving:
             if w * h > 2000:
                 retval = States.TRIGGERING
+                data.idle_scheduler.triggered()
+                data.trigger_time = time.monotonic()
+                data.motion_boxes = [(x + data.trigger_bc, y + data.trigger_br, w, h) for x, y, w, h, area in moving if w * h > 2000]
+                if data.clip_recorder != None:
+                    data.clip_recorder.start_episode()
                 data.record_image(frame2, "movement")
                 data.timeout_timer.start()
                 break
-        else:
-            time.sleep(1)
+        # The time spent idling is not part of the run
+        frame_cost = time.monotonic() - start
+        timings.add('idle_run', frame_cost)
+        if retval == States.IDLE:
+            data.idle_sleep = data.idle_scheduler.next_interval(data.motion_detector.energy, frame_cost)
         
         return retval
 
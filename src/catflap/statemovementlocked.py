@@ -1,10 +1,10 @@
 import cv2 as cv
 import numpy as np
+import time
 
-from tflite_detect import TFLiteDetect
-from evaluation import Evaluation
 from statetypes import TState, GlobalData, Event, States, CatDetection
-from base_logger import logger
+from base_logger import logger, log_event
+from pipeline_metrics import metrics
 
 
 
@@ -17,8 +17,12 @@ class MovementLockedState(TState):
     def on_enter_state(self, event:Event, data:GlobalData) -> None:
         logger.info(f"PUML movementLockedState --> flapControl: cat-flap-lock")
         data.cat_flap_control.lock()
-        data.tflite = TFLiteDetect(data.args.model, data.args.enable_edgetpu, data.args.num_threads)
-        data.evaluation = Evaluation(data._json_labels, data._json_eval, CatDetection)
+        if data.trigger_time != None:
+            metrics.observe('motion_to_lock_seconds', time.monotonic() - data.trigger_time)
+            data.trigger_time = None
+        data.evaluation = data.config.eval.evaluation()
+        # Results for frames sent to the model while triggering are not part of this evaluation
+        data.discard_detections()
         data.timeout_timer.start()
 
 
@@ -28,24 +32,35 @@ class MovementLockedState(TState):
         timeout if there is no solid determination of either of these.'''
         retval = States.MOVEMENT_LOCKED
     
-        for d in data.tflite.detect(event.payload):
+        # A cat sitting still gives the same frame over and over, recent detections are reused
+        result = data.detect(event.payload, reuse=True)
+        if result == None:
+            # The model is still busy with an earlier image
+            return retval
+        image, detections, reused = result
+
+        # A frame has a few detections, one at a time is cheaper than a batch. Reused ones
+        # were counted when the model ran, a cat sitting still is one result, not many
+        for d in (detections if reused == False else ()):
             eval = data.evaluation.add_record(d.label, d.score)
-            logger.debug(f'{self.__class__.__name__} evaluated {d.label} {d.score:.2f} results {eval.name}')
+            logger.debug('%s evaluated %s %.2f results %s', self.__class__.__name__, d.label, d.score, eval.name)
+            log_event('detection', state='movementLockedState', label=d.label, score=round(float(d.score), 3), result=eval.name,
+                      config=data.config.version)
 
             # Decide next state, after each detection result - first result wins
             if eval == CatDetection.CAT_ALONE:
-                data.record_image(event.payload, "unlock")
+                data.record_image(image, "unlock")
                 retval = States.UNLOCKED
                 break
             elif eval == CatDetection.CAT_WITH_MOUSE:
-                data.record_image(event.payload, "mouselock")
+                data.record_image(image, "mouselock")
                 retval = States.MOUSE_LOCKED
                 break
 
         # Record or show the detection results
         if data.headless == False:
-            new_image = event.payload.copy()
-            cv.imshow(data.window_name, data.tflite.create_overlays(new_image))
+            new_image = data.display_image(image)
+            cv.imshow(data.window_name, data.tflite.create_overlays(new_image, detections))
             cv.waitKey(30)
         # TODO - Record an image with the overlays
         # if(data.args.record_overlays == True):
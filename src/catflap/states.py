@@ -1,7 +1,10 @@
 
 from statemachine import StateMachine
 import sys
-from base_logger import logger
+from base_logger import logger, log_event, bind_camera
+from stage_timing import timings
+from pipeline_metrics import metrics
+import time
 from catflapcontrol import CatFlapControl
 from statetimer import StateTimer
 
@@ -38,25 +41,30 @@ class CatFlapFSM(StateMachine):
     mouseLock = movementLockedState.to(mouseLockedState) | unlockedState.to(mouseLockedState) | mouseLockedState.to.itself(internal=True)
 
 
-    def __init__(self, global_data) -> None:
+    def __init__(self, global_data, cat_flap_control=None) -> None:
         # Initialise the global data. This must be before the state machine init
         # as this init will cause us to call the on_enter_state for idle.
-        # Create the timeout timer, and cat flap control object
+        # Create the timeout timer, and cat flap control object - unless one is given
         self._global_data = global_data
         self._global_data.timeout_timer = StateTimer(self._timeout_handle, interval=5)
-        self._global_data.cat_flap_control = CatFlapControl()
+        self._global_data.cat_flap_control = cat_flap_control if cat_flap_control != None else CatFlapControl(global_data.gpio_pin)
+        self._entered = time.monotonic()
 
-        StateMachine.__init__(self, CatFlapFSM.idleState)
+        # idleState is the initial state. Nothing is passed as the model - a model object
+        # is searched for callbacks too, and the states callbacks need the global data
+        StateMachine.__init__(self)
         
         logger.info("PUML nullState -> idleState: Startup")
 
-        '''Lookups from States ID into the state variables, and the transitions'''
+        '''Lookups from States ID into the state variables, and the transitions.
+            The class level states are used - newer statemachine versions hand out
+            proxies from the instance which hide the methods of the state classes'''
         self.states = {
-            States.IDLE: self.idleState,
-            States.TRIGGERING : self.triggeringState,
-            States.UNLOCKED: self.unlockedState,
-            States.MOVEMENT_LOCKED: self.movementLockedState,
-            States.MOUSE_LOCKED: self.mouseLockedState
+            States.IDLE: CatFlapFSM.idleState,
+            States.TRIGGERING : CatFlapFSM.triggeringState,
+            States.UNLOCKED: CatFlapFSM.unlockedState,
+            States.MOVEMENT_LOCKED: CatFlapFSM.movementLockedState,
+            States.MOUSE_LOCKED: CatFlapFSM.mouseLockedState
         }
         self.transitions = {
             States.IDLE : self.returnIdle,
@@ -72,26 +80,33 @@ class CatFlapFSM(StateMachine):
         '''Handle detection events from the cat AI system
             This is the first step in handling a new event from outside'''
         if type(event.payload) == type(None):
-            logger.debug(f"{self.__class__.__name__} State machine exiting on None event")
+            logger.debug("%s State machine exiting on None event", self.__class__.__name__)
             return
 
-        logger.debug(f"{self.__class__.__name__} Handling incoming event {event} in state {self.current_state.id}")
-        # Run the event handler for the current state with the incoming event and
-        # the global data
-        self._global_data.add_event(event)
-        self._global_data.new_state = self.states[self.current_state.run(event, self._global_data)]
-        if self._return_idle == True:
-            self._global_data.new_state = self.states[States.IDLE]
-            self._return_idle = False
-        # Call the state transition action
-        action = self.transitions[self._global_data.new_state.name]
-        action(self)
-
+        with timings.span('event_handle'):
+            logger.debug("%s Handling incoming event %s in state %s", self.__class__.__name__, event, self.current_state.id)
+            # Run the event handler for the current state with the incoming event and
+            # the global data
+            self._global_data.add_event(event)
+            state = self._state_object(self.current_state)
+            self._global_data.new_state = self.states[state.run(event, self._global_data)]
+            if self._return_idle == True:
+                self._global_data.new_state = self.states[States.IDLE]
+                self._return_idle = False
+            # Call the state transition action
+            action = self.transitions[self._global_data.new_state.name]
+            action(self)
+
+
+    def _state_object(self, state):
+        '''The state class instance for a state, which may be a proxy of it'''
+        return getattr(type(self), state.id)
 
     def _timeout_handle(self, args):
         '''This is a watchdog type timer to ensure the cat flap is always opened
         when a movement sequence ends.
         Note - is called in the Timer thread, so do not change state machine stuff.'''
+        bind_camera(self._global_data.camera)
         logger.info(f"PUML {self.current_state.id} -> idleState: Timeout")
         self._return_idle = True
 
@@ -100,6 +115,7 @@ class CatFlapFSM(StateMachine):
         logger.info(f"Handling state machine exit event")
         self._global_data.timeout_timer.cancel()
         self._global_data.cat_flap_control.unlock()
+        self._global_data.close()
 
     ''' ------------------ Generic Transition Events ------------------
         These are sorted into order, called on specific transitions only
@@ -114,6 +130,10 @@ class CatFlapFSM(StateMachine):
             The state parameter is the current state'''
         # logger.debug(f"{self.__class__.__name__} on_exit_state: event  '{event}', exiting state '{state.id}'.")
         logger.info(f"PUML {self.current_state.id} -> {self._global_data.new_state.id}: {event}")
+        log_event('transition', source=self.current_state.id, target=self._global_data.new_state.id, event=event,
+                  seconds=round(time.monotonic() - self._entered, 3), config=self._global_data.config.version)
+        metrics.inc('state_seconds', time.monotonic() - self._entered, state=state.id)
+        state = self._state_object(state)
         if hasattr(state, "on_exit_state") == True:
             state.on_exit_state(event, self._global_data)
 
@@ -126,7 +146,11 @@ class CatFlapFSM(StateMachine):
     def on_enter_state(self, event, state):
         '''4. Entering the new state - the state parameter here is now the new state
             This will also enter idleState from __initial__'''
-        logger.debug(f"{self.__class__.__name__} on_enter_state: event '{event}', entering state '{state.id}'.")
+        logger.debug("%s on_enter_state: event '%s', entering state '%s'.", self.__class__.__name__, event, state.id)
+        self._entered = time.monotonic()
+        metrics.set('current_state', int(state.name))
+        metrics.inc('state_entries', state=state.id)
+        state = self._state_object(state)
         if hasattr(state, "on_enter_state") == True:
             state.on_enter_state(event, self._global_data)
 
@@ -14,7 +14,7 @@ class StateTimer():
         self._running = False
 
     def _internal_callback(self) -> None:
-        logger.debug(f"{self.__class__.__name__} timer timeout.")
+        logger.debug("%s timer timeout.", self.__class__.__name__)
         self._running = False
         self._callback(args=None)
         self._timer = None
@@ -22,21 +22,21 @@ class StateTimer():
     def start(self) -> None:
         '''Starts the timer if it is not running'''
         if self._running == False:
-            logger.debug(f"{self.__class__.__name__} starting timer.")
+            logger.debug("%s starting timer.", self.__class__.__name__)
             self._timer = Timer(self._interval, self._internal_callback)
             self._timer.start()
             self._running = True
 
     def restart(self) -> None:
         '''Start the timeout again from the beginning'''
-        logger.debug(f"{self.__class__.__name__} timer restarted.")
+        logger.debug("%s timer restarted.", self.__class__.__name__)
         if self._running == True:
             self._timer.cancel()
         self._timer = Timer(self._interval, self._internal_callback)
         self._timer.start()
     
     def cancel(self):
-        logger.debug(f"{self.__class__.__name__} timer canceled.")
+        logger.debug("%s timer canceled.", self.__class__.__name__)
         if self._running == True:
             self._running = False
             self._timer.cancel()
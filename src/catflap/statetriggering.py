@@ -1,10 +1,8 @@
 import cv2 as cv
 import numpy as np
 
-from tflite_detect import TFLiteDetect
-from evaluation import Evaluation
 from statetypes import TState, GlobalData, Event, States, CatDetection
-from base_logger import logger
+from base_logger import logger, log_event
 
 
 
@@ -19,8 +17,12 @@ class TriggeringState(TState):
             reset the evaluation class ready for the next event sequence'''
         # logger.info(f"Entering {self.__class__.__name__} state")
         # logger.info(f"PUML idleState --> flapControl: cat-flap-unlock")
-        data.tflite = TFLiteDetect(data.args.model, data.args.enable_edgetpu, data.args.num_threads)
-        data.evaluation = Evaluation(data._json_labels, data._json_trigger, CatDetection)
+        # A new episode, with the latest config - it is kept to the end of the episode
+        if data.config_store.current is not data.config:
+            data.config = data.config_store.current
+            logger.info(f"{self.__class__.__name__} using config version {data.config.version}")
+        data.evaluation = data.config.trigger.evaluation()
+        data.discard_detections()
 
     def run(self, event:Event, data:GlobalData) -> States:
         '''There was movement in front of the camera. Now we look for any cat
@@ -30,11 +32,19 @@ class TriggeringState(TState):
         '''
         retval = States.TRIGGERING
 
-        for d in data.tflite.detect(event.payload):
+        result = data.detect(event.payload)
+        if result == None:
+            # The model is still busy with an earlier image
+            return retval
+        image, detections, _ = result
+
+        for d in detections:
             eval = data.evaluation.add_record(d.label, d.score)
-            logger.debug(f'{self.__class__.__name__} detection {d.label} {d.score} results {eval.name}')
+            logger.debug('%s detection %s %s results %s', self.__class__.__name__, d.label, d.score, eval.name)
+            log_event('detection', state='triggeringState', label=d.label, score=round(float(d.score), 3), result=eval.name,
+                      config=data.config.version)
 
-        if len(data.tflite) == 0:
+        if len(detections) == 0:
             # This image was not recognised, so treat it as a low certainty background
             # This is done here as we want to return to idle if no cat is seen. We don't
             # want to drop too many images and potentially get stuck here too long
@@ -43,8 +53,8 @@ class TriggeringState(TState):
         else:
             # Record or show the detection results
             if data.headless == False:
-                new_image = event.payload.copy()
-                cv.imshow(data.window_name, data.tflite.create_overlays(new_image))
+                new_image = data.display_image(image)
+                cv.imshow(data.window_name, data.tflite.create_overlays(new_image, detections))
                 cv.waitKey(30)
             # TODO - Record an image with the overlays
             # if(data.args.record_overlays == True):
@@ -54,10 +64,10 @@ class TriggeringState(TState):
 
         # Decide next state once after all evaluations are done
         if eval == CatDetection.BACKGROUND:
-            data.record_image(event.payload, "toidle")
+            data.record_image(image, "toidle")
             retval = States.IDLE
         elif eval != CatDetection.UNDECIDED:
-            data.record_image(event.payload, "locking")
+            data.record_image(image, "locking")
             retval = States.MOVEMENT_LOCKED
 
         return retval
@@ -3,12 +3,18 @@ from statemachine import State
 from enum import Enum
 from collections import deque
 from array import array
-import json
+import numpy as np
 import sys
 from base_logger import logger
+from pixelformat import PixelFormat
 
-from catflapcontrol import CatFlapControl
+from catflapcontrol import CatFlapControl, GPIO_PIN
 import image_recorder
+from motiondetect import create_motion_detector
+from idlescheduler import IdleScheduler
+from videorecorder import ClipRecorder
+from resultcache import ResultCache
+from evalconfig import ConfigStore
 
 
 class States(int, Enum):
@@ -43,7 +49,7 @@ class Event():
 
 class GlobalData():
     '''This has become a bit of a smorsgasbord of everything - not pretty but functional'''
-    def __init__(self, args, event=None) -> None:
+    def __init__(self, args, event=None, tflite=None, inference=None, pixel_format=PixelFormat.BGR, config_store=None, frame_pool=None) -> None:
         self.args = args
         assert(hasattr(args, 'trigger'))
         assert(hasattr(args, 'label_json'))
@@ -56,33 +62,27 @@ class GlobalData():
         self._trigger_bcw = self._trigger_bc + bw
         self._trigger_brh = self._trigger_br + bh
 
-        # Open config files
-        # First, the labels used in the ML models
-        try:
-            with open (args.label_json) as j:
-                self._json_labels = json.load(j)['labels']
-        except Exception as e:
-            logger.error(f"Error opening JSON {args.label_json} - {e.__class__} - {e}")
-            sys.exit(1)
-        # Then, the JSON that defines the triggering evaluation
-        try:
-            with open (args.trigger_json) as j:
-                self._json_trigger = json.load(j)
-        except Exception as e:
-            logger.error(f"Error opening JSON {args.trigger_json} - {e.__class__} - {e}")
-            sys.exit(1)
-        # Finally, the JSON that defines the cat alone / cat with mouse evaluation
-        try:
-            with open (args.eval_json) as j:
-                self._json_eval = json.load(j)
-        except Exception as e:
-            logger.error(f"Error opening JSON {args.eval_json} - {e.__class__} - {e}")
-            sys.exit(1)
-
-        # Create the event queue
+        # The labels and evaluation thresholds, reloaded when the files change. Cameras
+        # running in one process share them. An episode uses the snapshot it started with
+        if config_store == None:
+            try:
+                config_store = ConfigStore(args.label_json, args.trigger_json, args.eval_json, CatDetection)
+            except ValueError as e:
+                logger.error(f"{e}")
+                sys.exit(1)
+        self.config_store = config_store
+        self.config = config_store.current
+
+        # Create the event queue, and the buffer images are copied to for display. With a
+        # frame pool the queue and the inference hold the frames they keep, so the buffers
+        # are not captured into while still in use
+        self.frame_pool = frame_pool
         self._event_queue = deque(maxlen=2)
+        self._display = None
         if event != None:
-            self._event_queue.append(event)
+            self.add_event(event)
+        # The inference result last handed to a state, its image is held until the next
+        self._taken = None
 
         # Settings
         if hasattr(args, "headless") == True:
@@ -90,14 +90,51 @@ class GlobalData():
         else:
             self._headless = False
 
-        # 
-        self.cat_flap_control = CatFlapControl()
+        # The camera, when there are several, and the pin of the relay of its cat flap
+        self.camera = getattr(args, 'camera_name', None)
+        self.gpio_pin = getattr(args, 'gpio_pin', GPIO_PIN)
+        self.cat_flap_control = CatFlapControl(self.gpio_pin)
         self.evaluation = None
         self.timeout_timer = None
-        self.tflite = None
+        # When idle last saw enough movement to trigger, and where - (x, y, w, h) in the frame
+        self.trigger_time = None
+        self.motion_boxes = []
+        # What part of the image the detector looks at
+        self._inference_roi = getattr(args, 'inference_roi', 'full')
+        self._roi_padding = getattr(args, 'roi_padding', 32)
+        # The detector is loaded once at startup and shared by all states
+        self.tflite = tflite
+        # With an inference executor the model runs on its own thread
+        self.inference = inference
+
+        # Detections reused for frames that have not changed, off with a size of 0
+        self.result_cache = None
+        if getattr(args, 'result_cache', 0) > 0:
+            self.result_cache = ResultCache(args.result_cache, getattr(args, 'result_cache_age', 2.0),
+                        getattr(args, 'result_cache_distance', 4))
+
+        # Create the motion detector used in idle
+        self.motion_detector = create_motion_detector(getattr(args, 'motion_mode', 'background'),
+                        (self._trigger_bc, self._trigger_br, self._trigger_bcw, self._trigger_brh),
+                        scale=getattr(args, 'motion_scale', 0.5), alpha=getattr(args, 'motion_alpha', 0.05),
+                        pixel_format=pixel_format)
+        # And how often idle looks at a frame
+        self.idle_scheduler = IdleScheduler(getattr(args, 'idle_min_interval', 0.05),
+                        getattr(args, 'idle_max_interval', 1.0), getattr(args, 'idle_cpu_budget', 0.25))
+        # Seconds idle asked to sleep after its frame, slept by the capture loop so the
+        # wait is not timed as part of handling the frame
+        self.idle_sleep = 0
 
         # Create the image recorder
-        self._image_recorder = image_recorder.image_recorder(self.args.record_path)
+        self._image_recorder = image_recorder.image_recorder(self.args.record_path,
+                        quality=getattr(args, 'record_quality', 90), queue_size=getattr(args, 'record_queue', 8),
+                        policy=getattr(args, 'record_policy', 'drop'), timeout=getattr(args, 'record_timeout', 0.1))
+
+        # And the clip recorder, that keeps a few seconds before each trigger
+        self.clip_recorder = None
+        if getattr(args, 'record_clips', False) == True:
+            self.clip_recorder = ClipRecorder(self.args.record_path, getattr(args, 'preroll', 5),
+                        getattr(args, 'clip_memory', 32), getattr(args, 'clip_scale', 0.5))
 
 
     '''Settings'''
@@ -122,14 +159,114 @@ class GlobalData():
 
     '''Event queue stuff'''
     def add_event(self, event:Event):
+        if self.frame_pool != None:
+            self.frame_pool.hold(event.payload)
+            if len(self._event_queue) == self._event_queue.maxlen:
+                self.frame_pool.release(self._event_queue[0].payload)
         self._event_queue.append(event)
 
     def get_images(self, count=1) -> list:
-        return [e.payload for e in list(self._event_queue)[(-1 * count):]]
+        count = min(count, len(self._event_queue))
+        return [self._event_queue[i].payload for i in range(-count, 0)]
+
+    def display_image(self, image: array) -> array:
+        '''A copy of the image to draw overlays on for the windows, in a buffer
+            that is reused for every frame'''
+        if self._display is None or self._display.shape != image.shape or self._display.dtype != image.dtype:
+            self._display = np.empty_like(image)
+        np.copyto(self._display, image)
+        return self._display
+
+    '''Detection'''
+    def roi(self, image: array) -> tuple:
+        '''The region of the image the detector looks at as (x0, y0, x1, y1), or None for
+            the whole image. Either the trigger area or the union of the motion boxes that
+            triggered, with padding, inside the image'''
+        if self._inference_roi == 'full':
+            return None
+        if self._inference_roi == 'motion' and len(self.motion_boxes) > 0:
+            x0 = min(x for x, y, w, h in self.motion_boxes)
+            y0 = min(y for x, y, w, h in self.motion_boxes)
+            x1 = max(x + w for x, y, w, h in self.motion_boxes)
+            y1 = max(y + h for x, y, w, h in self.motion_boxes)
+        else:
+            x0, y0, x1, y1 = self._trigger_bc, self._trigger_br, self._trigger_bcw, self._trigger_brh
+        height, width = image.shape[:2]
+        p = self._roi_padding
+        return (max(x0 - p, 0), max(y0 - p, 0), min(x1 + p, width), min(y1 + p, height))
+
+    def detect(self, image: array, reuse: bool = False) -> tuple:
+        '''Run the detector on the image. Returns a tuple of the image the detections
+            belong to, the list of TFLDetection and whether they were reused. With an inference executor the image is
+            queued and the newest completed result is returned - which may be for an earlier
+            image - or None when no new result is ready yet. A failed inference raises here,
+            as it does without the executor.
+            With reuse, and a result cache, the detections of a recent frame that looks
+            the same are returned instead of running the model - reused, as they were
+            evaluated when the model ran and are not new evidence.'''
+        roi = self.roi(image)
+        bits = None
+        if reuse == True and self.result_cache != None:
+            bits = self._frame_hash(image, roi)
+            detections = self.result_cache.lookup(bits)
+            if detections != None:
+                return image, detections, True
+        if self.inference == None:
+            detections = list(self.tflite.detect(image, roi))
+            if bits is not None:
+                self.result_cache.store(bits, detections)
+            return image, detections, False
+        if self.frame_pool != None:
+            self.frame_pool.hold(image)
+            self.inference.submit(image, roi, self.frame_pool.release)
+        else:
+            self.inference.submit(image, roi)
+        future = self.inference.take_latest()
+        if future == None:
+            return None
+        # The state is done with the image of the last result by now
+        self._release_taken()
+        self._taken = future
+        if bits is not None:
+            # The result may be for an earlier image, it is cached under that image's hash
+            if future.image is not image:
+                bits = self._frame_hash(future.image, future.roi)
+            self.result_cache.store(bits, future.result())
+        return future.image, future.result(), False
+
+    def _frame_hash(self, image: array, roi: tuple):
+        '''The result cache hash of the part of the image the detector looks at'''
+        x0, y0, x1, y1 = roi if roi != None else (0, 0, image.shape[1], image.shape[0])
+        return self.result_cache.frame_hash(image[y0:y1, x0:x1])
+
+    def _release_taken(self) -> None:
+        if self._taken != None:
+            self._taken.release()
+            self._taken = None
+
+    def discard_detections(self) -> None:
+        '''Forget queued images, results and cached results that belong to an earlier episode'''
+        if self.inference != None:
+            self.inference.discard()
+        self._release_taken()
+        if self.result_cache != None:
+            self.result_cache.clear()
 
     def record_image(self, image: array, label:str):
         self._image_recorder(image, label)
 
+    @property
+    def recorder(self) -> image_recorder.ImageRecorder:
+        return self._image_recorder
+
+    def close(self) -> None:
+        '''Finish off anything still running in the background'''
+        self._image_recorder.close()
+        if self.result_cache != None:
+            logger.info(f"{self.result_cache}")
+        if self.clip_recorder != None:
+            self.clip_recorder.close()
+
     @property
     def window_name(self) -> str:
         return "Cat flap image"
@@ -2,7 +2,7 @@ import cv2 as cv
 import numpy as np
 
 from statetypes import TState, GlobalData, Event, States, CatDetection
-from base_logger import logger
+from base_logger import logger, log_event
 
 
 class UnlockedState(TState):
@@ -18,9 +18,19 @@ class UnlockedState(TState):
         detected or a timeout takes it back to idle'''
         retval = States.UNLOCKED
 
-        for d in data.tflite.detect(event.payload):
+        # A cat sitting still gives the same frame over and over, recent detections are reused
+        result = data.detect(event.payload, reuse=True)
+        if result == None:
+            # The model is still busy with an earlier image
+            return retval
+        image, detections, reused = result
+
+        # Reused detections were counted when the model ran
+        for d in (detections if reused == False else ()):
             eval = data.evaluation.add_record(d.label, d.score)
-            logger.debug(f'{self.__class__.__name__} evaluated {d.label} {d.score} results {eval.name}')
+            logger.debug('%s evaluated %s %s results %s', self.__class__.__name__, d.label, d.score, eval.name)
+            log_event('detection', state='unlockedState', label=d.label, score=round(float(d.score), 3), result=eval.name,
+                      config=data.config.version)
 
             if eval == CatDetection.CAT_ALONE:
                 retval = States.UNLOCKED
@@ -28,8 +38,8 @@ class UnlockedState(TState):
 
         # Record or show the detection results
         if data.headless == False:
-            new_image = event.payload.copy()
-            cv.imshow(data.window_name, data.tflite.create_overlays(new_image))
+            new_image = data.display_image(image)
+            cv.imshow(data.window_name, data.tflite.create_overlays(new_image, detections))
             cv.waitKey(30)
 
         return retval
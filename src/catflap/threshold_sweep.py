@@ -0,0 +1,266 @@
+'''Threshold sweep over trigger_config.json and eval_config.json. The model is run
+once over every frame of every clip and the detections are kept in a cache on
+disk, keyed by the video path and a hash of the model. After that any number of
+threshold combinations are replayed against the cache, through the real
+evaluation, and ranked by how many clips ended in the right decision and
+how many frames the decision took.
+
+The ground truth of a clip is the label in its path, as the recordings are sorted,
+ie. data/incoming/Cat-with-mouse/20230310/20221014-011509_catcam.mp4
+
+python threshold_sweep.py --clips ./data/incoming --model cats.tflite \\
+    --counts 1,2,3,4,5 --thresholds 0.3,0.4,0.5,0.6 --output sweep.json
+'''
+import argparse
+import copy
+import glob
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+
+import cv2 as cv
+import numpy as np
+
+from base_logger import logger
+from evaluation import VectorEvaluation
+from statetypes import CatDetection
+
+
+# What each kind of clip should end in
+EXPECTED = {'Cat-alone': 'unlock', 'Cat-with-mouse': 'mouse_lock', 'Background': 'idle'}
+
+
+def model_hash(model:str) -> str:
+    sha = hashlib.sha256()
+    with open(model, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+class DetectionCache():
+    '''Detections of every frame of a clip, one npz file per clip and model. The
+    detections are stored as flat arrays - frame number, label index and score'''
+    def __init__(self, cache_dir:str, model:str, labels:list) -> None:
+        self._model = model
+        self._labels = labels
+        self._hash = model_hash(model)
+        self._dir = os.path.join(cache_dir, self._hash)
+        os.makedirs(self._dir, exist_ok=True)
+        self._detector = None
+        # Counters
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self, video:str) -> str:
+        key = hashlib.sha1(os.path.abspath(video).encode()).hexdigest()[:16]
+        return os.path.join(self._dir, f"{key}.npz")
+
+    def get(self, video:str) -> list:
+        '''The detections of each frame of the video as a list of [(label, score)],
+            running the model when they are not in the cache'''
+        file = self._file(video)
+        mtime = os.path.getmtime(video)
+        if os.path.exists(file):
+            with np.load(file) as cached:
+                if float(cached['mtime']) == mtime:
+                    self.hits += 1
+                    return self._frames(int(cached['frames']), cached['frame'], cached['label'], cached['score'])
+        self.misses += 1
+        frames, frame, label, score = self._detect(video)
+        np.savez_compressed(file, frames=frames, frame=frame, label=label, score=score,
+                            mtime=mtime, video=os.path.abspath(video), model=self._hash)
+        return self._frames(frames, frame, label, score)
+
+    def _frames(self, frames:int, frame:np.ndarray, label:np.ndarray, score:np.ndarray) -> list:
+        retval = [[] for _ in range(frames)]
+        for f, l, s in zip(frame.tolist(), label.tolist(), score.tolist()):
+            retval[f].append((self._labels[l], s))
+        return retval
+
+    def _detect(self, video:str) -> tuple:
+        if self._detector == None:
+            from tflite_detect import TFLiteDetect
+            self._detector = TFLiteDetect(self._model, False, 4)
+        frame, label, score = [], [], []
+        start = time.perf_counter()
+        cap = cv.VideoCapture(video)
+        frames = 0
+        image = None
+        while True:
+            success, image = cap.read(image)
+            if success == False:
+                break
+            for d in self._detector.detect(image):
+                if d.label in self._labels:
+                    frame.append(frames)
+                    label.append(self._labels.index(d.label))
+                    score.append(d.score)
+            frames += 1
+        cap.release()
+        logger.info(f"{self.__class__.__name__} {frames} frames of {video} in {time.perf_counter() - start:.1f}s")
+        return frames, np.array(frame, np.int32), np.array(label, np.int16), np.array(score, np.float32)
+
+
+def records(frames:list, background:bool) -> tuple:
+    '''The detections of the frames as one stream of labels and scores, and the frame
+        of each record. With background a frame without detections counts as a low
+        certainty background, like TriggeringState does it'''
+    labels, scores, frame = [], [], []
+    for n, detections in enumerate(frames):
+        if len(detections) == 0 and background == True:
+            detections = [('Background', 0.5)]
+        for label, score in detections:
+            labels.append(label)
+            scores.append(score)
+            frame.append(n)
+    return labels, scores, frame
+
+
+def run_triggering(frames:list, labels:list, config:dict) -> tuple:
+    '''Replay the triggering state - returns ('idle' or 'locked', frame number), or
+        ('undecided', None) if the clip ends first'''
+    stream, scores, frame = records(frames, True)
+    results = VectorEvaluation(labels, config, CatDetection).add_records(stream, scores)
+    # The state decides on the result after the last detection of each frame
+    for n, result in enumerate(results):
+        if n + 1 < len(results) and frame[n + 1] == frame[n]:
+            continue
+        if result == CatDetection.BACKGROUND:
+            return 'idle', frame[n]
+        elif result != CatDetection.UNDECIDED:
+            return 'locked', frame[n]
+    return 'undecided', None
+
+
+def run_locked(frames:list, labels:list, config:dict, start:int) -> tuple:
+    '''Replay the movement locked state from the frame after start - returns
+        ('unlock' or 'mouse_lock', frame number) or ('undecided', None)'''
+    stream, scores, frame = records(frames[start + 1:], False)
+    results = VectorEvaluation(labels, config, CatDetection).add_records(stream, scores)
+    # The first decision wins, whatever comes after it
+    for n, result in enumerate(results):
+        if result == CatDetection.CAT_ALONE:
+            return 'unlock', start + 1 + frame[n]
+        elif result == CatDetection.CAT_WITH_MOUSE:
+            return 'mouse_lock', start + 1 + frame[n]
+    return 'undecided', None
+
+
+def with_values(config:dict, values:dict) -> dict:
+    '''A copy of the config with {label: (min_result_count, average_threshold)} set'''
+    config = copy.deepcopy(config)
+    for t in config['thresholds']:
+        if t['label'] in values:
+            t['values']['min_result_count'], t['values']['average_threshold'] = values[t['label']]
+    return config
+
+
+def find_truth(video:str, labels:list) -> str:
+    '''The nearest directory named after a label, or the file name prefix'''
+    parts = os.path.normpath(video).split(os.sep)
+    for part in reversed(parts[:-1]):
+        if part in labels:
+            return part
+    for label in labels:
+        if parts[-1].startswith(label + '-'):
+            return label
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep the evaluation thresholds over cached detections")
+    parser.add_argument('--clips', help="Directory of *_catcam.mp4 clips, sorted into directories by label", required=True, type=str)
+    parser.add_argument('--model', help="Path of the object detection model", default='cats.tflite', type=str)
+    parser.add_argument('--cache', help="Where the detections are cached", default='./detection_cache', type=str)
+    parser.add_argument('--label-json', help="JSON file containing the detection labels", type=str, default='./labels.json')
+    parser.add_argument('--trigger-json', help="JSON file with the triggering state evaluation", type=str, default='./trigger_config.json')
+    parser.add_argument('--eval-json', help="JSON file with the motion locked state evaluation", type=str, default='./eval_config.json')
+    parser.add_argument('--trigger_labels', help="Trigger config labels to sweep", type=str, default='Background')
+    parser.add_argument('--eval_labels', help="Eval config labels to sweep", type=str, default='Cat-alone,Cat-with-mouse')
+    parser.add_argument('--counts', help="min_result_count values to try", type=str, default='1,2,3,4,5')
+    parser.add_argument('--thresholds', help="average_threshold values to try", type=str, default='0.3,0.4,0.5,0.6,0.7')
+    parser.add_argument('--top', help="How many of the best configs to print", type=int, default=10)
+    parser.add_argument('--output', help="Write every ranked config as JSON", type=str)
+    args = parser.parse_args()
+
+    with open(args.label_json) as j:
+        labels = json.load(j)['labels']
+    with open(args.trigger_json) as j:
+        trigger_config = json.load(j)
+    with open(args.eval_json) as j:
+        eval_config = json.load(j)
+
+    # Run the model over the clips, or read the cache
+    cache = DetectionCache(args.cache, args.model, labels)
+    clips = []
+    for video in sorted(glob.glob(os.path.join(args.clips, '**', '*_catcam.mp4'), recursive=True)):
+        truth = find_truth(video, labels)
+        if truth not in EXPECTED:
+            continue
+        clips.append((video, truth, cache.get(video)))
+    if len(clips) == 0:
+        logger.error(f"No labelled clips found in {args.clips}")
+        return 1
+    logger.info(f"{len(clips)} clips, {cache.hits} from the cache, {cache.misses} run through the model")
+
+    # Every value pair for every swept label
+    pairs = list(itertools.product([int(c) for c in args.counts.split(',')], [float(t) for t in args.thresholds.split(',')]))
+    trigger_labels = [l for l in args.trigger_labels.split(',') if l != '']
+    eval_labels = [l for l in args.eval_labels.split(',') if l != '']
+    trigger_grid = [dict(zip(trigger_labels, p)) for p in itertools.product(pairs, repeat=len(trigger_labels))]
+    eval_grid = [dict(zip(eval_labels, p)) for p in itertools.product(pairs, repeat=len(eval_labels))]
+
+    # The states are replayed separately - the triggering result does not depend on the
+    # eval config and the locked result only on where the triggering ended - so each is
+    # run once per distinct input, not once per combination
+    start = time.perf_counter()
+    triggered = [[run_triggering(frames, labels, with_values(trigger_config, t)) for _, _, frames in clips] for t in trigger_grid]
+    locked = {}
+    def locked_result(e:int, c:int, n:int) -> tuple:
+        key = (e, c, n)
+        if key not in locked:
+            locked[key] = run_locked(clips[c][2], labels, with_values(eval_config, eval_grid[e]), n)
+        return locked[key]
+
+    ranked = []
+    for t, e in itertools.product(range(len(trigger_grid)), range(len(eval_grid))):
+        correct = 0
+        latency = []
+        decisions = {}
+        for c, (video, truth, frames) in enumerate(clips):
+            decision, n = triggered[t][c]
+            if decision == 'locked':
+                decision, n = locked_result(e, c, n)
+            decisions[decision] = decisions.get(decision, 0) + 1
+            if decision == EXPECTED[truth]:
+                correct += 1
+                latency.append(n + 1)
+        ranked.append({'correct': correct, 'clips': len(clips),
+                       'mean_latency_frames': round(float(np.mean(latency)), 2) if len(latency) > 0 else None,
+                       'decisions': decisions, 'trigger': trigger_grid[t], 'eval': eval_grid[e]})
+    elapsed = time.perf_counter() - start
+    ranked.sort(key=lambda r: (-r['correct'], r['mean_latency_frames'] if r['mean_latency_frames'] != None else float('inf')))
+    logger.info(f"{len(ranked)} configs over {len(clips)} clips in {elapsed:.1f}s")
+
+    # And how the configs in use now do
+    current = 0
+    for video, truth, frames in clips:
+        decision, n = run_triggering(frames, labels, trigger_config)
+        if decision == 'locked':
+            decision, n = run_locked(frames, labels, eval_config, n)
+        current += 1 if decision == EXPECTED[truth] else 0
+    print(f"current configs {current}/{len(clips)} correct")
+    for r in ranked[:args.top]:
+        print(f"{r['correct']}/{r['clips']} correct, {r['mean_latency_frames']} frames  trigger {r['trigger']} eval {r['eval']}  {r['decisions']}")
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump({'model': args.model, 'clips': [(v, t) for v, t, _ in clips], 'configs': ranked}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,8 +2,12 @@
 # print(sys.path)
 
 from datetime import datetime, timedelta
+from collections import deque
+from queue import Queue, Empty
+from threading import Thread
 import cv2 as cv
 import numpy as np
+import time
 from os import path
 from base_logger import logger
 
@@ -13,9 +17,7 @@ class VideoRecorder(object):
 
     def __init__(self, size, recordpath: str = "./", duration: int = 10):
         if(not path.isdir(recordpath)):
-            import sys
-            logger.error(f"Cannot record video to {recordpath} - not a directory")
-            sys.exit(1)
+            raise NotADirectoryError(f"Cannot record video to {recordpath} - not a directory")
         logger.debug(f"Output directory set to {recordpath}")
         self.recordpath = recordpath
         self.duration = duration
@@ -58,3 +60,171 @@ class VideoRecorder(object):
             retval = False
         return retval
 
+    def write_clip(self, frames, fps: float, start: datetime = None) -> int:
+        '''Write a whole clip in one go, frames is any iterable of images the
+            size of this recorder. Returns the number of frames written'''
+        datestr = (start if start != None else datetime.now()).strftime("%Y%m%d-%H%M%S")
+        outfile = path.join(self.recordpath, f"{datestr}_catcam.mp4")
+        writer = cv.VideoWriter(outfile, self.fourcc, fps, self._size)
+        count = 0
+        for frame in frames:
+            writer.write(frame)
+            count += 1
+        writer.release()
+        logger.info(f"Clip of {count} frames written to {outfile}")
+        return count
+
+
+class ClipRecorder(object):
+    '''Keeps the last preroll seconds of frames in memory, downscaled and JPEG compressed,
+        so when idle triggers the clip can start before the trigger. From start_episode()
+        every frame is kept until end_episode(), then the preroll and the episode are written
+        to one clip by a background thread.
+        add_frame() only downscales into a free buffer and returns, the compression runs on
+        its own thread. If no buffer is free the frame is dropped rather than waiting.
+        Everything kept in memory is limited to memory_mb, when the limit is reached the
+        oldest preroll frames go first, then the rest of the episode is dropped.
+        start_episode() and end_episode() queue behind the frames already offered, so a frame
+        still being compressed when the episode ends goes into that episode, not the next preroll.'''
+    def __init__(self, recordpath: str = "./", preroll: float = 5, memory_mb: float = 32,
+                 scale: float = 0.5, quality: int = 70, buffers: int = 4):
+        self.recordpath = recordpath
+        self._preroll = preroll
+        self._memory_cap = int(memory_mb * 1024 * 1024)
+        self._scale = scale
+        self._quality = quality
+        self._size = None
+
+        self._in_episode = False        # As the caller sees it
+        # Only used by the compression thread
+        self._frames = deque()          # (timestamp, jpeg bytes) - preroll, then the episode
+        self._memory = 0
+        self._episode_start = None      # None when not in an episode
+        self._episode_stamp = None
+
+        self._free = Queue()
+        self._filled = Queue()
+        self._buffer_count = buffers
+        self._clips = Queue()
+
+        # Counters
+        self._dropped = 0
+        self._truncated = 0
+
+        self._compressor = Thread(target=self._compress, name="clipcompress", daemon=True)
+        self._compressor.start()
+        self._muxer = Thread(target=self._mux, name="clipmux", daemon=True)
+        self._muxer.start()
+
+    @property
+    def in_episode(self) -> bool:
+        return self._in_episode
+
+    @property
+    def memory(self) -> int:
+        '''Bytes of compressed frames held in memory'''
+        return self._memory
+
+    def add_frame(self, frame: np.ndarray) -> bool:
+        '''Offer a frame to the recorder. Returns False if it had to be dropped'''
+        if self._size == None:
+            self._size = (int(frame.shape[1] * self._scale), int(frame.shape[0] * self._scale))
+            for _ in range(self._buffer_count):
+                self._free.put(np.empty((self._size[1], self._size[0]) + frame.shape[2:], frame.dtype))
+        try:
+            buffer = self._free.get_nowait()
+        except Empty:
+            self._dropped += 1
+            return False
+        cv.resize(frame, self._size, dst=buffer, interpolation=cv.INTER_AREA)
+        self._filled.put((time.monotonic(), buffer))
+        return True
+
+    def start_episode(self) -> None:
+        '''From now on keep every frame, and the preroll that is already there'''
+        if self._in_episode == True:
+            return
+        self._in_episode = True
+        self._filled.put((time.monotonic(), datetime.now()))
+
+    def end_episode(self) -> None:
+        '''Hand the preroll and the episode to the background writer, once the frames
+            offered before are compressed'''
+        if self._in_episode == False:
+            return
+        self._in_episode = False
+        self._filled.put((time.monotonic(), None))
+
+    def close(self) -> None:
+        '''Write any episode that is still running and stop the threads'''
+        self.end_episode()
+        self._filled.put(None)
+        self._compressor.join(timeout=5)
+        self._clips.put(None)
+        self._muxer.join(timeout=60)
+        logger.info(f"{self.__class__.__name__} closed - dropped {self._dropped} truncated {self._truncated}")
+
+    def _episode(self, stamp: float, start: datetime) -> None:
+        '''Start an episode, or with start None end it and queue it for the writer'''
+        if start != None:
+            self._episode_start = start
+            self._episode_stamp = stamp
+            logger.debug(f"{self.__class__.__name__} episode started with {len(self._frames)} frames of preroll")
+            return
+        frames, self._frames = self._frames, deque()
+        self._memory = 0
+        self._clips.put((self._episode_start, frames))
+        self._episode_start = None
+
+    def _store(self, stamp: float, jpeg: bytes) -> None:
+        '''Add a compressed frame, keeping the preroll and memory limits'''
+        in_episode = self._episode_start != None
+        if in_episode == False:
+            while len(self._frames) > 0 and stamp - self._frames[0][0] > self._preroll:
+                self._memory -= len(self._frames.popleft()[1])
+        while self._memory + len(jpeg) > self._memory_cap and len(self._frames) > 0 and \
+                (in_episode == False or self._frames[0][0] < self._episode_stamp):
+            # Over the limit - give up the oldest preroll
+            self._memory -= len(self._frames.popleft()[1])
+        if self._memory + len(jpeg) > self._memory_cap:
+            self._truncated += 1
+            return
+        self._frames.append((stamp, jpeg))
+        self._memory += len(jpeg)
+
+    def _compress(self) -> None:
+        '''The compression thread'''
+        while True:
+            item = self._filled.get()
+            if item == None:
+                return
+            stamp, buffer = item
+            if not isinstance(buffer, np.ndarray):
+                self._episode(stamp, buffer)
+                continue
+            _, jpeg = cv.imencode('.jpg', buffer, [cv.IMWRITE_JPEG_QUALITY, self._quality])
+            self._free.put(buffer)
+            self._store(stamp, jpeg.tobytes())
+
+    def _mux(self) -> None:
+        '''The writer thread - decode the stored frames and write them to one clip'''
+        while True:
+            item = self._clips.get()
+            if item == None:
+                return
+            start, frames = item
+            if len(frames) < 2:
+                continue
+            duration = frames[-1][0] - frames[0][0]
+            fps = (len(frames) - 1) / duration if duration > 0 else 15.0
+            size = sum(len(jpeg) for _, jpeg in frames)
+            began = time.monotonic()
+            try:
+                recorder = VideoRecorder(self._size, self.recordpath)
+                count = recorder.write_clip((cv.imdecode(np.frombuffer(jpeg, np.uint8), cv.IMREAD_COLOR) for _, jpeg in frames), fps, start)
+            except Exception as e:
+                logger.error(f"{self.__class__.__name__} failed to write clip - {e}")
+                continue
+            took = time.monotonic() - began
+            logger.info(f"{self.__class__.__name__} encoded {count} frames ({duration:.1f}s, {size / 1e6:.1f}MB compressed) "
+                        f"in {took:.2f}s - {count / max(took, 1e-6):.0f} fps, {size / 1e6 / max(took, 1e-6):.1f}MB/s")
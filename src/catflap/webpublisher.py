@@ -0,0 +1,138 @@
+import cv2 as cv
+import numpy as np
+import time
+from threading import Thread, Condition
+
+from base_logger import logger
+from stage_timing import timings
+
+# Shut off noisy messages -
+# connectionpool(292):DEBUG Resetting dropped connection: 10.0.0.38
+# connectionpool(546):DEBUG http://10.0.0.38:5000 "POST /socket.io/?transport=polling&EIO=4&sid=4BN7BycU05USNayrAAGE HTTP/1.1" 200 None
+import logging
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+
+class WebPublisher():
+    '''Sends frames to the monitoring website without ever blocking the caller.
+        publish() drops the frame into a single slot mailbox - downscaled to the output
+        size on the way in - and returns. A background thread takes the newest frame,
+        stamps the time on it, JPEG encodes it and sends the bytes as a binary socket.io
+        message over a websocket. If the website is not there the thread reconnects
+        with a growing backoff, frames published meanwhile are simply replaced.'''
+    def __init__(self, url:str, max_fps:float=5, size:tuple=(640, 480), quality:int=80,
+                 min_backoff:float=1, max_backoff:float=30) -> None:
+        self._url = url
+        self._interval = 1.0 / max_fps if max_fps > 0 else 0
+        self._size = size
+        self._quality = quality
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+
+        self._sio = None
+        self._lock = Condition()
+        self._mailbox = np.empty((size[1], size[0], 3), np.uint8)
+        self._work = np.empty_like(self._mailbox)
+        self._stamp = None          # Time of the frame in the mailbox, None when empty
+        self._last_accepted = 0
+        self._running = True
+
+        # Counters
+        self._published = 0
+        self._skipped = 0
+        self._replaced = 0
+        self._sent = 0
+        self._errors = 0
+
+        self._thread = Thread(target=self._sender, name="webpublisher", daemon=True)
+        self._thread.start()
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__} published {self._published} skipped {self._skipped} replaced {self._replaced} sent {self._sent} errors {self._errors}"
+
+    @property
+    def connected(self) -> bool:
+        return self._sio != None and self._sio.connected
+
+    def emit(self, event:str, data) -> bool:
+        '''Send a small message on the same connection as the frames. Returns False
+            when not connected, the caller can try again later'''
+        if self.connected == False:
+            return False
+        self._sio.emit(event, data)
+        return True
+
+    def publish(self, frame:np.ndarray) -> bool:
+        '''Offer a frame to the website. Returns False when the frame was skipped
+            because of the frame rate cap'''
+        now = time.monotonic()
+        if now - self._last_accepted < self._interval:
+            self._skipped += 1
+            return False
+        self._last_accepted = now
+        with self._lock:
+            if self._stamp != None:
+                self._replaced += 1
+            if frame.ndim == 2:
+                cv.cvtColor(cv.resize(frame, self._size), cv.COLOR_GRAY2BGR, dst=self._mailbox)
+            else:
+                cv.resize(frame, self._size, dst=self._mailbox, interpolation=cv.INTER_AREA)
+            self._stamp = time.localtime()
+            self._published += 1
+            self._lock.notify()
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._running = False
+            self._lock.notify()
+        self._thread.join(timeout=5)
+        if self.connected == True:
+            self._sio.disconnect()
+        logger.info(f"{self}")
+
+    def _connect(self) -> bool:
+        '''Try to connect to the website, using the websocket transport only'''
+        import socketio
+        if self._sio == None:
+            self._sio = socketio.Client(reconnection=False)
+        try:
+            self._sio.connect(self._url, transports=['websocket'])
+        except Exception as e:
+            logger.error(f"{self.__class__.__name__} connection to {self._url} failed - {e}")
+            return False
+        logger.info(f"{self.__class__.__name__} connected to web server at {self._url}")
+        return True
+
+    def _sender(self) -> None:
+        '''The sending thread - connect, wait for a frame, encode, send'''
+        backoff = self._min_backoff
+        while self._running == True:
+            if self.connected == False:
+                if self._connect() == False:
+                    with self._lock:
+                        self._lock.wait(timeout=backoff)
+                    backoff = min(backoff * 2, self._max_backoff)
+                    continue
+                backoff = self._min_backoff
+
+            with self._lock:
+                while self._stamp == None and self._running == True:
+                    self._lock.wait(timeout=1)
+                if self._running == False:
+                    break
+                # Swap the buffers so publish can fill the mailbox while this one is sent
+                self._mailbox, self._work = self._work, self._mailbox
+                stamp, self._stamp = self._stamp, None
+
+            start = time.perf_counter()
+            cv.putText(self._work, f'{stamp.tm_hour:02}:{stamp.tm_min:02}:{stamp.tm_sec:02}', (10, 30), cv.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+            _, buffer = cv.imencode('.jpg', self._work, [cv.IMWRITE_JPEG_QUALITY, self._quality])
+            # Send the frame to the server, this does crash sometimes, so we catch it
+            try:
+                self._sio.emit('image_frame', buffer.tobytes())
+                self._sent += 1
+                timings.add('web_send', time.perf_counter() - start)
+            except Exception as e:
+                self._errors += 1
+                logger.error(f"Error sending image to web: {e}")
@@ -1,40 +1,256 @@
 '''A hacky logging wrapper to log both to the console and a file
+
+Until configure_logging() is called everything only goes to the console, so tools
+and worker processes importing this never touch the log file. configure_logging()
+moves the writing onto a listener thread - a logging call on the control loop only
+creates the record and puts it on a queue, the console and the SD card are written
+by the listener.
+
+The log file is rotated when it reaches max_bytes, and a log left over from the last
+run is rotated at startup. Rotated logs are renamed catflap_<date>_<time>.log and
+compressed with gzip, only the newest backups are kept.
+
+Structured records go through log_event(), and are written as JSON lines to
+catflap.jsonl when that is turned on - otherwise they cost one level check.
+
+With several cameras in one process each camera thread calls bind_camera(name), and
+everything it logs starts with [name] - and has a camera field in the JSON lines - so
+the state machines of the cameras can be told apart in the one log.
 '''
+import atexit
+import glob
+import gzip
+import json
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import shutil
 from datetime import datetime
+from enum import Enum
+from threading import Thread, local
+
+
+_format_string = '%(asctime)s %(module)s(%(lineno)d):%(levelname)s %(camera_tag)s%(message)s'
+
+# The camera of the thread, put on each record where it is made - the listener thread
+# that formats the records does not know it
+_context = local()
+_record_factory = logging.getLogRecordFactory()
+
+
+def _camera_record(*args, **kwargs) -> logging.LogRecord:
+    record = _record_factory(*args, **kwargs)
+    record.camera = getattr(_context, 'camera', None)
+    record.camera_tag = f"[{record.camera}] " if record.camera != None else ""
+    return record
+
+
+logging.setLogRecordFactory(_camera_record)
 
 
-_format_string = '%(asctime)s %(module)s(%(lineno)d):%(levelname)s %(message)s'
-logger = logging.NullHandler()
+def bind_camera(name:str) -> None:
+    '''Everything logged from this thread is for the camera name, None for no camera'''
+    _context.camera = name
 
-logging.basicConfig(format=_format_string, 
+
+logging.basicConfig(format=_format_string,
         level=logging.DEBUG,
         datefmt='%Y%m%d %H:%M:%S')
 logger = logging.getLogger(__name__)
-
-directory_path = './log/'
-file_name = 'catflap.log'
-
-if not os.path.exists(directory_path):
-        try:
-                os.makedirs(directory_path)
-                print(f"Directory '{directory_path}' created successfully.")
-        except OSError as e:
-                print(f"Error creating directory '{directory_path}': {e}")
-elif os.path.exists(os.path.join(directory_path, file_name)):
-       current_datetime = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-       base, ext = os.path.splitext(file_name)
-       new_filename = f"{base}_{current_datetime}{ext}"
-       os.rename(os.path.join(directory_path, file_name), os.path.join(directory_path, new_filename))
-
-filelogger = logging.FileHandler(filename=directory_path + file_name)
-filelogger.setFormatter(logging.Formatter(_format_string))
-
-filelogger.setLevel(logging.INFO)
 logger.setLevel(logging.INFO)
 
-logger.addHandler(filelogger)
+# Structured records, off until configure_logging turns on JSON lines
+events = logger.getChild('events')
+events.propagate = False
+events.setLevel(logging.CRITICAL + 1)
+
+_listener = None
+_handlers = []
+
+# Arguments of these types cannot change before the listener formats the message
+_IMMUTABLE = (str, int, float, bool, bytes, type(None), Enum)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    '''Puts records on the queue as they are. The standard handler formats each message
+        before queueing it - on the calling thread, which is what is being avoided'''
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+        args = record.args
+        if args:
+            values = args.values() if isinstance(args, dict) else args
+            if all(isinstance(a, _IMMUTABLE) for a in values) == False:
+                # A mutable argument could change before the listener gets to it
+                record.msg = record.getMessage()
+                record.args = None
+        return record
+
+
+class JsonLinesFormatter(logging.Formatter):
+    '''One JSON object per record - the time, the message as the type, and the fields
+        passed to log_event'''
+    def format(self, record:logging.LogRecord) -> str:
+        line = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                'type': record.getMessage()}
+        if getattr(record, 'camera', None) != None:
+            line['camera'] = record.camera
+        line.update(getattr(record, 'fields', {}))
+        return json.dumps(line, default=str)
+
+
+class CompressingFileHandler(logging.handlers.RotatingFileHandler):
+    '''Rotates the file when it reaches max_bytes - see rotate_log. Runs on the listener
+        thread, so the compression does not hold up anything else'''
+    def __init__(self, file_name:str, max_bytes:int, backups:int) -> None:
+        super(CompressingFileHandler, self).__init__(file_name, maxBytes=max_bytes, backupCount=backups)
+
+    def doRollover(self) -> None:
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        compress_log(rename_log(self.baseFilename), self.backupCount)
+        self.stream = self._open()
+
+
+def rename_log(file_name:str) -> str:
+    '''Rename the log to <name>_<date>_<time><ext>. Returns the new name, or None if
+        there is nothing to rotate'''
+    if os.path.exists(file_name) == False or os.path.getsize(file_name) == 0:
+        return None
+    base, ext = os.path.splitext(file_name)
+    stamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    new_filename = f"{base}_{stamp}{ext}"
+    count = 1
+    while os.path.exists(new_filename) or os.path.exists(new_filename + '.gz'):
+        new_filename = f"{base}_{stamp}-{count}{ext}"
+        count += 1
+    os.rename(file_name, new_filename)
+    return new_filename
+
+
+def compress_log(file_name:str, backups:int) -> None:
+    '''gzip a renamed log, and delete the oldest compressed ones beyond backups - 0
+        keeps them all'''
+    if file_name == None:
+        return
+    with open(file_name, 'rb') as f, gzip.open(file_name + '.gz', 'wb') as out:
+        shutil.copyfileobj(f, out)
+    os.remove(file_name)
+    if backups > 0:
+        base, ext = os.path.splitext(file_name)
+        pattern = f"{glob.escape(base.rsplit('_', 2)[0])}_*{ext}.gz"
+        for old in sorted(glob.glob(pattern), key=os.path.getmtime)[:-backups]:
+            os.remove(old)
+
+
+def log_event(kind:str, **fields) -> None:
+    '''A structured record, ie. log_event('transition', source='idleState', target='triggeringState')
+        Only written with JSON lines on'''
+    if events.isEnabledFor(logging.INFO):
+        events.info(kind, extra={'fields': fields})
+
+
+def configure_logging(directory:str='./log/', file_name:str='catflap.log', max_bytes:int=10*1024*1024,
+                      backups:int=50, json_lines:bool=False) -> logging.handlers.QueueListener:
+    '''Start logging to the file, through a queue and a listener thread. Only the main
+        process does this - worker processes log to the console, and never rotate the
+        log of the process that started them'''
+    global _listener, _handlers
+    if _listener != None or multiprocessing.current_process().name != 'MainProcess':
+        return _listener
+    os.makedirs(directory, exist_ok=True)
+
+    # The renames are quick, the compression is left to a thread
+    files = [(os.path.join(directory, file_name), logging.Formatter(_format_string))]
+    if json_lines == True:
+        files.append((os.path.join(directory, os.path.splitext(file_name)[0] + '.jsonl'), JsonLinesFormatter()))
+    previous = [rename_log(f) for f, _ in files]
+    Thread(target=lambda: [compress_log(p, backups) for p in previous], name="logrotate").start()
+
+    text = lambda record: record.name != events.name
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(_format_string, datefmt='%Y%m%d %H:%M:%S'))
+    console.addFilter(text)
+    _handlers = [console]
+    for f, formatter in files:
+        handler = CompressingFileHandler(f, max_bytes, backups)
+        handler.setFormatter(formatter)
+        handler.addFilter(text if formatter.__class__ != JsonLinesFormatter else lambda record: record.name == events.name)
+        _handlers.append(handler)
+
+    # The format has no thread or process, do not look them up for every record
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    logging.logAsyncioTasks = False
+
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, *_handlers, respect_handler_level=True)
+    _listener.start()
+    # The console is written by the listener as well now
+    logger.propagate = False
+    logger.addHandler(_QueueHandler(records))
+    if json_lines == True:
+        events.addHandler(_QueueHandler(records))
+        events.setLevel(logging.INFO)
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging() -> None:
+    '''Write out whatever is still queued and close the files'''
+    global _listener
+    if _listener == None:
+        return
+    _listener.stop()
+    _listener = None
+    for h in _handlers:
+        h.close()
+    for l in (logger, events):
+        for h in list(l.handlers):
+            l.removeHandler(h)
+    logger.propagate = True
+
+
+def main():
+    """What a logging call costs the calling thread, written straight to a file and
+        through the queue. The thread's own CPU time leaves out the listener, which
+        shares the GIL with it in a burst like this but has time in between on the
+        control loop"""
+    import argparse
+    import tempfile
+    import time
+    parser = argparse.ArgumentParser(description="Time logging calls")
+    parser.add_argument('--count', help="Records to log", type=int, default=20000)
+    args = parser.parse_args()
+
+    def timed(call) -> tuple:
+        wall, cpu = time.perf_counter(), time.thread_time()
+        for n in range(args.count):
+            call(n)
+        return (time.perf_counter() - wall) / args.count * 1e6, (time.thread_time() - cpu) / args.count * 1e6
+
+    directory = tempfile.mkdtemp(prefix='logbench')
+    logger.propagate = False
+    direct = logging.FileHandler(os.path.join(directory, 'direct.log'))
+    direct.setFormatter(logging.Formatter(_format_string))
+    logger.addHandler(direct)
+    timings = {'FileHandler info': timed(lambda n: logger.info(f"PUML idleState -> triggeringState: frame {n}"))}
+    logger.removeHandler(direct)
+    direct.close()
+
+    configure_logging(directory, json_lines=True)
+    # Keep the console quiet, this is about the calling thread
+    _handlers[0].setLevel(logging.CRITICAL)
+    timings['queued info'] = timed(lambda n: logger.info(f"PUML idleState -> triggeringState: frame {n}"))
+    timings['disabled debug'] = timed(lambda n: logger.debug("%s evaluated %s %.2f", 'MovementLockedState', 'Cat-alone', 0.5))
+    timings['log_event'] = timed(lambda n: log_event('detection', state='movementLockedState', label='Cat-alone', score=0.5, result='UNDECIDED'))
+    stop_logging()
+    for name, (wall, cpu) in timings.items():
+        print(f"{name:18s} {wall:6.2f}us per call, {cpu:6.2f}us of the calling thread's CPU")
+    print(f"logs in {directory}")
 
 
-logger.debug("Logging started")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
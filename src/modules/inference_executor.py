@@ -0,0 +1,419 @@
+from concurrent.futures import Future
+from collections import deque
+from threading import Thread, Condition
+import time
+
+from base_logger import logger
+from pipeline_metrics import metrics
+
+
+class InferenceFuture(Future):
+    '''A future for a list of TFLDetection, that also remembers the image
+        it was run on and when it was submitted. release, if given, is called with the
+        image once nothing needs it any more - by the executor for a future that is
+        cancelled or replaced before it is taken, by the taker after that'''
+    def __init__(self, image, roi=None, release=None) -> None:
+        super(InferenceFuture, self).__init__()
+        self.image = image
+        self.roi = roi
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        # Which episode of the executor the future belongs to, see discard()
+        self.epoch = 0
+        self._release = release
+
+    def release(self) -> None:
+        '''Hand the image back, only the first call does anything'''
+        release, self._release = self._release, None
+        if release != None:
+            release(self.image)
+
+    def drop(self) -> None:
+        '''Cancel the future if it has not run, and hand the image back'''
+        self.cancel()
+        self.release()
+
+
+class InferenceExecutor():
+    '''Runs the detector on a dedicated thread so the caller never waits for the model.
+        Frames are submitted and a future is returned. At most max_pending frames wait
+        for the model, when a new frame arrives and the queue is full the oldest waiting
+        frame is cancelled - there is no point running inference on an old frame.
+        The TFLite interpreter releases the GIL while it runs, so a thread is enough.'''
+    def __init__(self, detector, max_pending:int=1, report_every:int=100) -> None:
+        assert max_pending >= 1
+        self._detector = detector
+        self._max_pending = max_pending
+        self._report_every = report_every
+        self._pending = deque()
+        self._latest_done = None
+        self._epoch = 0
+        self._lock = Condition()
+        self._running = True
+
+        # Metrics
+        self._submitted = 0
+        self._completed = 0
+        self._dropped = 0
+        self._failed = 0
+        self._queue_latency = deque(maxlen=report_every)
+        self._compute_latency = deque(maxlen=report_every)
+
+        self._thread = Thread(target=self._worker, name="inference", daemon=True)
+        self._thread.start()
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__} submitted {self._submitted} completed {self._completed} dropped {self._dropped} failed {self._failed} " \
+               f"queue {self.queue_latency * 1000:.1f}ms compute {self.compute_latency * 1000:.1f}ms"
+
+    '''Metrics'''
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def submitted(self) -> int:
+        return self._submitted
+
+    @property
+    def completed(self) -> int:
+        return self._completed
+
+    @property
+    def dropped(self) -> int:
+        '''Frames that were replaced by a newer frame before the model saw them'''
+        return self._dropped
+
+    @property
+    def failed(self) -> int:
+        '''Inferences that raised, the exception is raised again by result() of the future'''
+        return self._failed
+
+    @property
+    def queue_latency(self) -> float:
+        '''Average seconds a frame waited before inference started'''
+        return sum(self._queue_latency) / len(self._queue_latency) if len(self._queue_latency) > 0 else 0
+
+    @property
+    def compute_latency(self) -> float:
+        '''Average seconds an inference took'''
+        return sum(self._compute_latency) / len(self._compute_latency) if len(self._compute_latency) > 0 else 0
+
+    def submit(self, image, roi=None, release=None) -> InferenceFuture:
+        '''Queue an image for inference, optionally only the region of interest.
+            The image must not be changed by the caller until it is released.'''
+        future = InferenceFuture(image, roi, release)
+        with self._lock:
+            while len(self._pending) >= self._max_pending:
+                self._pending.popleft().drop()
+                self._dropped += 1
+            future.epoch = self._epoch
+            self._pending.append(future)
+            self._submitted += 1
+            self._lock.notify()
+        return future
+
+    def take_latest(self) -> InferenceFuture:
+        '''Return the newest completed inference that has not been taken yet, or None'''
+        with self._lock:
+            retval, self._latest_done = self._latest_done, None
+        return retval
+
+    def discard(self) -> None:
+        '''Forget any waiting frames and untaken results, ie. at the start of a new episode.
+            A frame that is being run now is let go when it finishes'''
+        with self._lock:
+            self._epoch += 1
+            while len(self._pending) > 0:
+                self._pending.popleft().drop()
+                self._dropped += 1
+            if self._latest_done != None:
+                self._latest_done.release()
+            self._latest_done = None
+
+    def _publish(self, future:InferenceFuture) -> None:
+        '''Make the future the one take_latest returns. Called with the lock held'''
+        if self._running == False or future.epoch != self._epoch:
+            # Discarded or shut down while it ran, nobody is going to take it
+            future.release()
+            return
+        # A result nobody took is not going to be
+        if self._latest_done != None:
+            self._latest_done.release()
+        self._latest_done = future
+
+    def shutdown(self) -> None:
+        '''Stop the worker thread, waiting frames are cancelled'''
+        self.discard()
+        with self._lock:
+            self._running = False
+            self._lock.notify()
+        self._thread.join(timeout=5)
+        logger.info(f"{self}")
+
+    def _worker(self) -> None:
+        '''The inference thread'''
+        while True:
+            with self._lock:
+                while len(self._pending) == 0 and self._running == True:
+                    self._lock.wait()
+                if self._running == False:
+                    break
+                future = self._pending.popleft()
+            if future.set_running_or_notify_cancel() == False:
+                continue
+
+            future.started = time.monotonic()
+            try:
+                detections = list(self._detector.detect(future.image, future.roi))
+            except Exception as e:
+                # Taken like a result, so the exception is raised on the thread that takes it
+                logger.exception(f"{self.__class__.__name__} inference failed - {e}")
+                future.finished = time.monotonic()
+                future.set_exception(e)
+                metrics.inc('inference_failures')
+                with self._lock:
+                    self._failed += 1
+                    self._publish(future)
+                continue
+            future.finished = time.monotonic()
+            future.set_result(detections)
+
+            with self._lock:
+                self._completed += 1
+                self._queue_latency.append(future.started - future.submitted)
+                self._compute_latency.append(future.finished - future.started)
+                self._publish(future)
+
+            if self._completed % self._report_every == 0:
+                logger.info(f"{self}")
+
+
+
+class InferenceClient():
+    '''One camera of an InferencePool. Has the interface of InferenceExecutor, and detect()
+        which waits for the result - for cameras without async inference - so either can
+        be given to GlobalData. urgent is called by the pool to ask if the camera has a
+        cat at its flap, and should go first'''
+    def __init__(self, pool, name:str, max_pending:int, pixel_format=None) -> None:
+        self.name = name
+        self.pixel_format = pixel_format
+        self.urgent = lambda: False
+        self._pool = pool
+        self._max_pending = max_pending
+        self._pending = deque()
+        self._latest_done = None
+        self._epoch = 0
+        # Since when the camera has been waiting - newer frames replacing older ones keep it
+        self._waiting = None
+
+        # Metrics
+        self._submitted = 0
+        self._completed = 0
+        self._dropped = 0
+        self._failed = 0
+        self._queue_latency = deque(maxlen=pool.report_every)
+        self._compute_latency = deque(maxlen=pool.report_every)
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__} {self.name} submitted {self._submitted} completed {self._completed} dropped {self._dropped} failed {self._failed} " \
+               f"queue {self.queue_latency * 1000:.1f}ms compute {self.compute_latency * 1000:.1f}ms"
+
+    '''Metrics'''
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def submitted(self) -> int:
+        return self._submitted
+
+    @property
+    def completed(self) -> int:
+        return self._completed
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    @property
+    def failed(self) -> int:
+        return self._failed
+
+    @property
+    def queue_latency(self) -> float:
+        return sum(self._queue_latency) / len(self._queue_latency) if len(self._queue_latency) > 0 else 0
+
+    @property
+    def compute_latency(self) -> float:
+        return sum(self._compute_latency) / len(self._compute_latency) if len(self._compute_latency) > 0 else 0
+
+    def submit(self, image, roi=None, release=None) -> InferenceFuture:
+        '''Queue an image for inference, the oldest waiting image of this camera is dropped
+            when the queue is full'''
+        future = InferenceFuture(image, roi, release)
+        with self._pool._lock:
+            while len(self._pending) >= self._max_pending:
+                self._pending.popleft().drop()
+                self._dropped += 1
+            future.epoch = self._epoch
+            self._pending.append(future)
+            self._submitted += 1
+            if self._waiting == None:
+                self._waiting = future.submitted
+            self._pool._lock.notify()
+        return future
+
+    def detect(self, image, roi=None) -> list:
+        '''Run the detector on the image and wait for the result'''
+        return self.submit(image, roi).result()
+
+    def take_latest(self) -> InferenceFuture:
+        '''Return the newest completed inference that has not been taken yet, or None'''
+        with self._pool._lock:
+            retval, self._latest_done = self._latest_done, None
+        return retval
+
+    def discard(self) -> None:
+        '''Forget any waiting frames and untaken results of this camera. A frame that is
+            being run now is let go when it finishes'''
+        with self._pool._lock:
+            self._epoch += 1
+            while len(self._pending) > 0:
+                self._pending.popleft().drop()
+                self._dropped += 1
+            self._waiting = None
+            if self._latest_done != None:
+                self._latest_done.release()
+            self._latest_done = None
+
+    def create_overlays(self, frame, detections=None):
+        return self._pool.detectors[0].create_overlays(frame, detections)
+
+    def _done(self, future:InferenceFuture) -> None:
+        '''A finished or failed inference, called by the pool with its lock held'''
+        if future.exception() != None:
+            self._failed += 1
+        else:
+            self._completed += 1
+            self._queue_latency.append(future.started - future.submitted)
+            self._compute_latency.append(future.finished - future.started)
+        if self._pool._running == False or future.epoch != self._epoch:
+            # Discarded or shut down while it ran, nobody is going to take it
+            future.release()
+            return
+        if self._latest_done != None:
+            self._latest_done.release()
+        self._latest_done = future
+
+
+class InferencePool():
+    '''Runs the model for several cameras, so it is loaded once and the cameras do not fight
+        over the cores. Each detector gets a worker thread - TFLite interpreters cannot be
+        shared between threads - and each camera a client with its own queue.
+        A free worker takes the next frame of an urgent camera, one with a cat at its flap,
+        before any other. Cameras that are equally urgent take turns, and a frame that has
+        waited max_wait seconds counts as urgent - even if newer frames have replaced it -
+        so a quiet camera is never shut out.'''
+    def __init__(self, detectors:list, max_pending:int=1, max_wait:float=0.5, report_every:int=100) -> None:
+        assert max_pending >= 1 and len(detectors) >= 1
+        self.detectors = detectors
+        self.report_every = report_every
+        self._max_pending = max_pending
+        self._max_wait = max_wait
+        self._clients = []
+        self._next = 0
+        self._lock = Condition()
+        self._running = True
+
+        self._threads = [Thread(target=self._worker, args=(d,), name=f"inference{n}", daemon=True)
+                         for n, d in enumerate(detectors)]
+        for t in self._threads:
+            t.start()
+
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__} {len(self._threads)} workers " + ", ".join(str(c) for c in self._clients)
+
+    def client(self, name:str, pixel_format=None) -> InferenceClient:
+        '''A new camera'''
+        client = InferenceClient(self, name, self._max_pending, pixel_format)
+        with self._lock:
+            self._clients.append(client)
+        return client
+
+    def shutdown(self) -> None:
+        '''Stop the workers, waiting frames are cancelled'''
+        for c in self._clients:
+            c.discard()
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        for t in self._threads:
+            t.join(timeout=5)
+        for c in self._clients:
+            logger.info(f"{c}")
+
+    def _take(self) -> tuple:
+        '''The client and frame to run next, or None. Called with the lock held'''
+        now = time.monotonic()
+        chosen = None
+        count = len(self._clients)
+        for i in range(count):
+            n = (self._next + i) % count
+            client = self._clients[n]
+            if len(client._pending) == 0:
+                continue
+            if now - client._waiting >= self._max_wait or client.urgent() == True:
+                chosen = n
+                break
+            if chosen == None:
+                chosen = n
+        if chosen == None:
+            return None
+        # The next search starts after this camera
+        self._next = (chosen + 1) % count
+        client = self._clients[chosen]
+        future = client._pending.popleft()
+        client._waiting = client._pending[0].submitted if len(client._pending) > 0 else None
+        return client, future
+
+    def _worker(self, detector) -> None:
+        '''An inference thread'''
+        while True:
+            with self._lock:
+                job = self._take()
+                while job == None and self._running == True:
+                    self._lock.wait()
+                    job = self._take()
+                if self._running == False:
+                    if job != None:
+                        job[1].drop()
+                    break
+            client, future = job
+            if future.set_running_or_notify_cancel() == False:
+                continue
+
+            # What the detector counts is for the camera of the frame
+            metrics.bind(camera=client.name)
+            future.started = time.monotonic()
+            try:
+                detections = list(detector.detect(future.image, future.roi, client.pixel_format))
+            except Exception as e:
+                # Taken like a result, so the exception is raised on the camera's thread
+                logger.exception(f"{self.__class__.__name__} inference for {client.name} failed - {e}")
+                future.finished = time.monotonic()
+                future.set_exception(e)
+                metrics.inc('inference_failures')
+                with self._lock:
+                    client._done(future)
+                continue
+            future.finished = time.monotonic()
+            future.set_result(detections)
+            metrics.observe('inference_queue_seconds', future.started - future.submitted)
+
+            with self._lock:
+                client._done(future)
+
+            if client.completed % self.report_every == 0:
+                logger.info(f"{client}")
@@ -0,0 +1,139 @@
+'''Counters and gauges for the monitoring website. Everything is added up here in
+the catflap process and only the changes are sent, a small message every few
+seconds, never one per frame.
+
+    from pipeline_metrics import metrics
+    metrics.inc('frames_captured')
+    metrics.set('current_state', 1)
+    metrics.observe('motion_to_lock_seconds', 0.4)
+    metrics.sample('recorder_queue_depth', lambda: recorder.depth)
+
+Labels are given as keyword arguments, metrics.inc('state_seconds', 2.5, state='idleState')
+Labels bound to a thread are added to everything recorded on it - each camera
+thread binds its camera, metrics.bind(camera='front')
+'''
+import time
+from threading import Lock, Event, Thread, local
+
+from base_logger import logger
+
+
+class PipelineMetrics():
+    '''Counters only hold what was added since the last take(). Gauges hold the
+    latest value. Sampled metrics are read when the changes are taken - a sampled
+    counter is a function returning a running total, only its increase is sent'''
+    def __init__(self) -> None:
+        self._counters = {}
+        self._gauges = {}
+        self._sampled = []
+        self._sampled_last = {}
+        self._lock = Lock()
+        self._last_take = time.monotonic()
+        self._stop = None
+        self._bound = local()
+
+    def bind(self, **labels) -> None:
+        '''Labels added to every metric recorded by the calling thread'''
+        self._bound.labels = labels
+
+    def _key(self, name:str, labels:dict) -> str:
+        bound = getattr(self._bound, 'labels', None)
+        if bound:
+            labels = {**bound, **labels}
+        if len(labels) == 0:
+            return name
+        return name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+    def inc(self, name:str, value:float=1, **labels) -> None:
+        self._add(self._key(name, labels), value)
+
+    def _add(self, key:str, value:float) -> None:
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name:str, value:float, **labels) -> None:
+        self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name:str, value:float, **labels) -> None:
+        '''A measurement like a latency - counted, summed and the last one kept'''
+        self.inc(name + '_count', 1, **labels)
+        self.inc(name + '_sum', value, **labels)
+        self.set(name + '_last', value, **labels)
+
+    def sample(self, name:str, func, kind:str='gauge', **labels) -> None:
+        '''Read func() whenever the changes are taken'''
+        assert kind in ('gauge', 'counter')
+        self._sampled.append((self._key(name, labels), func, kind))
+
+    def take(self) -> dict:
+        '''The changes since the last take, and resets them'''
+        for key, func, kind in self._sampled:
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning(f"{self.__class__.__name__} could not sample {key} - {e}")
+                continue
+            if kind == 'gauge':
+                self._gauges[key] = value
+            else:
+                self._add(key, value - self._sampled_last.get(key, 0))
+                self._sampled_last[key] = value
+        now = time.monotonic()
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            interval, self._last_take = now - self._last_take, now
+        return {'interval': interval, 'counters': counters, 'gauges': dict(self._gauges)}
+
+    def restore(self, delta:dict) -> None:
+        '''Put back changes that could not be sent, they go with the next ones'''
+        with self._lock:
+            for key, value in delta['counters'].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            self._last_take -= delta['interval']
+
+    def start_push(self, send, interval:float=5) -> None:
+        '''Every interval seconds take the changes and send(delta) them from a
+        background thread. When send returns False they are kept for next time'''
+        if interval <= 0 or self._stop != None:
+            return
+        self._stop = Event()
+        def _pusher():
+            while self._stop.wait(interval) == False:
+                self.push(send)
+        Thread(target=_pusher, name="metricspusher", daemon=True).start()
+
+    def push(self, send) -> bool:
+        delta = self.take()
+        try:
+            sent = send(delta)
+        except Exception as e:
+            logger.warning(f"{self.__class__.__name__} could not send metrics - {e}")
+            sent = False
+        if sent == False:
+            self.restore(delta)
+        return sent
+
+    def stop_push(self) -> None:
+        if self._stop != None:
+            self._stop.set()
+            self._stop = None
+
+
+# The one shared by the whole process
+metrics = PipelineMetrics()
+
+
+if __name__ == "__main__":
+    m = PipelineMetrics()
+    total = [0]
+    m.sample('frames_dropped', lambda: total[0], 'counter')
+    for i in range(100):
+        m.inc('frames_captured')
+        total[0] += i % 2
+    m.observe('motion_to_lock_seconds', 0.25)
+    m.inc('state_seconds', 12.5, state='idleState')
+    m.bind(camera='front')
+    m.inc('frames_captured')
+    print(m.take())
+    m.push(lambda delta: False)
+    print(m.take())
@@ -0,0 +1,40 @@
+'''Pixel layouts of the frames passed around, and conversions that only run when
+the frame is not already in the layout that is needed.'''
+import cv2 as cv
+import numpy as np
+from enum import Enum
+
+
+class PixelFormat(str, Enum):
+    '''The order of the channels in memory'''
+    BGR = 'bgr'     # OpenCV
+    RGB = 'rgb'     # TFLite models
+    GRAY = 'gray'   # Luma only
+
+
+_TO_RGB = {PixelFormat.BGR: cv.COLOR_BGR2RGB, PixelFormat.GRAY: cv.COLOR_GRAY2RGB}
+_TO_BGR = {PixelFormat.RGB: cv.COLOR_RGB2BGR, PixelFormat.GRAY: cv.COLOR_GRAY2BGR}
+_TO_GRAY = {PixelFormat.BGR: cv.COLOR_BGR2GRAY, PixelFormat.RGB: cv.COLOR_RGB2GRAY}
+
+
+def _convert(frame:np.ndarray, pixel_format:PixelFormat, codes:dict, dst:np.ndarray=None) -> np.ndarray:
+    code = codes.get(PixelFormat(pixel_format))
+    if code == None:
+        # Already in the wanted layout, the frame itself is returned
+        return frame
+    if dst is None:
+        return cv.cvtColor(frame, code)
+    cv.cvtColor(frame, code, dst=dst)
+    return dst
+
+
+def to_rgb(frame:np.ndarray, pixel_format:PixelFormat, dst:np.ndarray=None) -> np.ndarray:
+    return _convert(frame, pixel_format, _TO_RGB, dst)
+
+
+def to_bgr(frame:np.ndarray, pixel_format:PixelFormat, dst:np.ndarray=None) -> np.ndarray:
+    return _convert(frame, pixel_format, _TO_BGR, dst)
+
+
+def to_gray(frame:np.ndarray, pixel_format:PixelFormat, dst:np.ndarray=None) -> np.ndarray:
+    return _convert(frame, pixel_format, _TO_GRAY, dst)
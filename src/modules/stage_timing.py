@@ -0,0 +1,177 @@
+'''Always-on timing of the stages of the frame pipeline. Each stage keeps the
+durations of its last few hundred runs in a fixed size ring, so the memory and
+the cost per sample never grow, and the report shows the percentiles and a
+histogram of the recent window.
+
+    from stage_timing import timings
+    with timings.span('detect'):
+        ...
+    timings.add('idle_run', seconds)
+
+The report is logged on SIGUSR1 (kill -USR1 <pid>) and, if asked for, periodically.
+'''
+import signal
+import time
+from threading import Lock, Thread, Event
+
+import numpy as np
+
+from base_logger import logger
+
+
+class RollingHistogram():
+    '''The durations of the last size samples of one stage, plus totals since start'''
+    # Bucket edges in milliseconds for the report
+    EDGES_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self, size:int=512) -> None:
+        self._samples = np.zeros(size, np.float64)
+        self._next = 0
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._lock = Lock()
+
+    '''Counters'''
+    @property
+    def count(self) -> int:
+        '''Samples since start'''
+        return self._count
+
+    @property
+    def total(self) -> float:
+        '''Seconds since start'''
+        return self._total
+
+    @property
+    def max(self) -> float:
+        return self._max
+
+    def add(self, seconds:float) -> None:
+        with self._lock:
+            self._samples[self._next] = seconds
+            self._next = (self._next + 1) % len(self._samples)
+            self._count += 1
+            self._total += seconds
+            if seconds > self._max:
+                self._max = seconds
+
+    def window(self) -> np.ndarray:
+        '''A copy of the samples in the window, in seconds'''
+        with self._lock:
+            return self._samples[:min(self._count, len(self._samples))].copy()
+
+    def summary(self) -> dict:
+        '''Percentiles and bucket counts of the window, in milliseconds'''
+        ms = self.window() * 1000
+        if len(ms) == 0:
+            return {'count': self._count}
+        p50, p95, p99 = np.percentile(ms, (50, 95, 99))
+        buckets = np.bincount(np.searchsorted(self.EDGES_MS, ms), minlength=len(self.EDGES_MS) + 1)
+        return {'count': self._count, 'window': len(ms), 'mean': float(ms.mean()),
+                'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': self._max * 1000,
+                'buckets': buckets.tolist()}
+
+
+class Span():
+    '''Context manager timing one run of a stage'''
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram:RollingHistogram) -> None:
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._histogram.add(time.perf_counter() - self._start)
+
+
+class StageTimings():
+    '''A rolling histogram per named stage, created on first use'''
+    def __init__(self, size:int=512) -> None:
+        self._size = size
+        self._stages = {}
+        self._lock = Lock()
+        self._stop = None
+
+    def histogram(self, stage:str) -> RollingHistogram:
+        retval = self._stages.get(stage)
+        if retval == None:
+            with self._lock:
+                retval = self._stages.setdefault(stage, RollingHistogram(self._size))
+        return retval
+
+    def span(self, stage:str) -> Span:
+        return Span(self.histogram(stage))
+
+    def add(self, stage:str, seconds:float) -> None:
+        self.histogram(stage).add(seconds)
+
+    def resize(self, size:int) -> None:
+        '''Set the window size, this throws away what has been measured so far'''
+        with self._lock:
+            self._size = size
+            self._stages = {}
+
+    def summary(self) -> dict:
+        return {stage: h.summary() for stage, h in sorted(self._stages.items())}
+
+    def report(self) -> str:
+        '''One line per stage, times in milliseconds'''
+        edges = '/'.join(str(e) for e in RollingHistogram.EDGES_MS)
+        lines = [f"{self.__class__.__name__} window {self._size}, buckets <{edges}/more ms"]
+        for stage, s in self.summary().items():
+            if 'window' not in s:
+                continue
+            lines.append(f"  {stage:<14} n {s['count']:>7} mean {s['mean']:8.2f} p50 {s['p50']:8.2f} "
+                         f"p95 {s['p95']:8.2f} p99 {s['p99']:8.2f} max {s['max']:8.2f} "
+                         f"[{' '.join(str(b) for b in s['buckets'])}]")
+        return '\n'.join(lines)
+
+    def log_report(self, *args) -> None:
+        '''Log the report - also the SIGUSR1 handler'''
+        logger.info(self.report())
+
+    def install_signal(self, signum=signal.SIGUSR1) -> None:
+        '''Log the report whenever the signal arrives. Only from the main thread'''
+        signal.signal(signum, self.log_report)
+
+    def start_periodic(self, interval:float) -> None:
+        '''Log the report every interval seconds from a background thread'''
+        if interval <= 0 or self._stop != None:
+            return
+        self._stop = Event()
+        def _reporter():
+            while self._stop.wait(interval) == False:
+                self.log_report()
+        Thread(target=_reporter, name="stagetimings", daemon=True).start()
+
+    def stop_periodic(self) -> None:
+        if self._stop != None:
+            self._stop.set()
+            self._stop = None
+
+
+# The one shared by the whole process
+timings = StageTimings()
+
+
+def main():
+    '''How much does a span cost?'''
+    count = 100000
+    t = StageTimings()
+    start = time.perf_counter()
+    for _ in range(count):
+        with t.span('empty'):
+            pass
+    elapsed = time.perf_counter() - start
+    for i in range(1000):
+        t.add('sleep', (i % 100) / 1000)
+    print(t.report())
+    print(f"{elapsed / count * 1e6:.2f}us per span")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+'''How long after the process started the cat flap was ready. Until the detector is
+loaded and the first frame is through the state machine a cat can come in with a
+mouse, so after every restart this window is measured and logged.
+
+    from startup_clock import startup
+    startup.mark('detector_ready')
+
+The process start comes from /proc where there is one, so the time the interpreter
+takes to start and import everything is included. Elsewhere it is when this module
+was imported - import it first.
+'''
+import os
+import time
+
+from base_logger import logger, log_event
+from pipeline_metrics import metrics
+
+
+def process_age() -> float:
+    '''Seconds since the process started, or None if it cannot be told'''
+    try:
+        with open('/proc/self/stat') as f:
+            # The command can contain spaces, the fields after it cannot
+            start_ticks = int(f.read().rpartition(')')[2].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(uptime - start_ticks / os.sysconf('SC_CLK_TCK'), 0)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupClock():
+    '''The seconds from the process start to each named point of the startup, the
+        first time each is reached'''
+    def __init__(self) -> None:
+        age = process_age()
+        self._start = time.monotonic() - (age if age != None else 0)
+        self._marks = {}
+
+    def __str__(self) -> str:
+        return "Startup " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self._marks.items())
+
+    @property
+    def marks(self) -> dict:
+        return dict(self._marks)
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._start
+
+    def mark(self, name:str) -> float:
+        '''Note the time name was reached, only the first time. Returns the seconds since
+            the process started'''
+        if name in self._marks:
+            return self._marks[name]
+        seconds = self.elapsed()
+        self._marks[name] = seconds
+        logger.info(f"Startup {name} after {seconds:.2f}s")
+        log_event('startup', stage=name, seconds=round(seconds, 3))
+        metrics.set('startup_seconds', seconds, stage=name)
+        return seconds
+
+    def reached(self, *names) -> bool:
+        return all(name in self._marks for name in names)
+
+
+# The one shared by the whole process
+startup = StartupClock()
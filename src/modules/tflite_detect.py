@@ -1,9 +1,11 @@
-from tflite_support.task import core
-from tflite_support.task import processor
-from tflite_support.task import vision
-
 import cv2 as cv
+import numpy as np
+import time
 
+from base_logger import logger
+from stage_timing import timings
+from pipeline_metrics import metrics
+from pixelformat import PixelFormat, to_rgb
 
 from datetime import datetime
 from os import path
@@ -59,12 +61,27 @@ class TFLDetection():
 class TFLiteDetect(object):
 
 
-    def __init__(self, model, use_coral, num_threads):
+    def __init__(self, model, use_coral, num_threads, input_size=None, pixel_format=PixelFormat.BGR):
+        '''Loads the model and creates the interpreter. This is expensive, so
+            create one of these at startup and share it. With input_size (width, height)
+            images are resized straight to the model input here, in one step with the crop.
+            pixel_format is the layout of the images given to detect, the model wants RGB'''
         self.file_name=model
         self.use_coral=use_coral
         self.num_threads=num_threads
+        self.input_size = input_size
+        self.pixel_format = PixelFormat(pixel_format)
+        self._inference_count = 0
+        self._last_transform = None
+
+        # Imported here so the detection classes can be used without tflite_support
+        from tflite_support.task import core
+        from tflite_support.task import processor
+        from tflite_support.task import vision
+        self._vision = vision
 
         # Initialize the object detection model
+        start = time.monotonic()
         self.base_options = core.BaseOptions(
             file_name=self.file_name, use_coral=use_coral, num_threads=num_threads)
         self.detection_options = processor.DetectionOptions(
@@ -72,45 +89,112 @@ class TFLiteDetect(object):
         self.options = vision.ObjectDetectorOptions(
             base_options=self.base_options, detection_options=self.detection_options)
         self.detector = vision.ObjectDetector.create_from_options(self.options)
+        logger.info(f"{self.__class__.__name__} loaded model {self.file_name} in {(time.monotonic() - start) * 1000:.1f}ms")
+
+        self._last_result = []
 
+    def warmup(self, count:int, width:int=640, height:int=480) -> None:
+        '''Run some inferences on a blank frame so the first real detection
+            does not pay for the lazy initialisation inside the interpreter'''
+        if count <= 0:
+            return
+        image, _ = self._prepare(np.zeros((height, width, 3), np.uint8))
+        times = []
+        for _ in range(count):
+            start = time.monotonic()
+            self.__detection(image)
+            times.append(time.monotonic() - start)
         self._last_result = []
+        logger.info(f"{self.__class__.__name__} warm up {count} inferences, first {times[0] * 1000:.1f}ms, last {times[-1] * 1000:.1f}ms")
 
-    def __detection(self, image):
+    def __detection(self, image, pixel_format=None):
         '''Returns an array of tuples of label, probability score
         ['label', 0.55]
         '''
-        # Convert the image from BGR to RGB as required by the TFLite model.
-        rgb_image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
+        # Convert the image to RGB as required by the TFLite model - if it is not already
+        rgb_image = to_rgb(image, self.pixel_format if pixel_format == None else pixel_format)
 
         # Create a TensorImage object from the RGB image.
-        input_tensor = vision.TensorImage.create_from_array(rgb_image)
+        input_tensor = self._vision.TensorImage.create_from_array(rgb_image)
 
         # Run object detection estimation using the model.
+        start = time.monotonic()
         self._last_result = self.detector.detect(input_tensor).detections
+        self._inference_count += 1
+        if self._inference_count == 1:
+            logger.info(f"{self.__class__.__name__} first inference took {(time.monotonic() - start) * 1000:.1f}ms")
         return self._last_result
 
 
     def __len__(self):
         return len(self._last_result)
 
-    def detect(self, image) -> TFLDetection:
-        self.__detection(image)
-        for d in self._last_result:
-            rect = BoundingRect(d.bounding_box.origin_x, d.bounding_box.origin_y, 
-                                        d.bounding_box.width, d.bounding_box.height )
+    def detect(self, image, roi=None, pixel_format=None) -> TFLDetection:
+        '''Detect on the whole image, or only the region of interest (x0, y0, x1, y1).
+            The boxes are always in the coordinates of the whole image. pixel_format is
+            the layout of this image, if it is not the one the detector was created for'''
+        with timings.span('detect'):
+            model_image, transform = self._prepare(image, roi)
+            self.__detection(model_image, pixel_format)
+        self._last_transform = transform
+        metrics.inc('inferences')
+        yield from self._to_detections(self._last_result, transform)
+
+    def _prepare(self, image, roi=None):
+        '''Crop to the region of interest and resize to the model input. Returns the image
+            for the model and the (x, y, x scale, y scale) that maps its boxes back'''
+        x0, y0 = 0, 0
+        if roi != None:
+            x0, y0, x1, y1 = roi
+            image = image[y0:y1, x0:x1]
+        if self.input_size == None:
+            return image, (x0, y0, 1.0, 1.0)
+        height, width = image.shape[:2]
+        image = cv.resize(image, self.input_size, interpolation=cv.INTER_AREA)
+        return image, (x0, y0, width / self.input_size[0], height / self.input_size[1])
+
+    @staticmethod
+    def _to_detections(result, transform=None):
+        x0, y0, sx, sy = transform if transform != None else (0, 0, 1.0, 1.0)
+        for d in result:
+            b = d.bounding_box
+            rect = BoundingRect(int(x0 + b.origin_x * sx), int(y0 + b.origin_y * sy),
+                                int(b.width * sx), int(b.height * sy))
             for c in d.categories:
                 yield TFLDetection(c.category_name, c.index, c.score, rect)
 
 
-    def create_overlays(self, frame):
-        for d in self._last_result:
-            bounds = d.bounding_box
-            for c in d.categories:
-                name, score = c.category_name, c.score
-                cv.rectangle(frame, (bounds.origin_x, bounds.origin_y), 
-                            (bounds.origin_x+bounds.width, bounds.origin_y+bounds.height), (255, 55, 0), 2)
-                text_location = (bounds.origin_x, bounds.origin_y)
-                text = f"{name} {score:.2f}"
-                cv.putText(frame, text, text_location, cv.FONT_HERSHEY_PLAIN,
-                            font_size, text_color, font_thickness)
+    def create_overlays(self, frame, detections=None):
+        '''Draw detections onto the frame - either the given list of TFLDetection,
+            or the result of the last detection'''
+        if detections == None:
+            detections = self._to_detections(self._last_result, self._last_transform)
+        for d in detections:
+            bounds = d.box
+            cv.rectangle(frame, (bounds.origin_x, bounds.origin_y), 
+                        (bounds.origin_x+bounds.width, bounds.origin_y+bounds.height), (255, 55, 0), 2)
+            text_location = (bounds.origin_x, bounds.origin_y)
+            text = f"{d.label} {d.score:.2f}"
+            cv.putText(frame, text, text_location, cv.FONT_HERSHEY_PLAIN,
+                        font_size, text_color, font_thickness)
         return frame
+
+
+class PendingDetector():
+    '''Stands in for a TFLiteDetect that is still being loaded on another thread, so the
+        cameras can start while the model loads. The first detection waits for it.
+        pixel_format is the layout of the images, the detector is loaded before the
+        camera says what it delivers'''
+    def __init__(self, future, pixel_format=None) -> None:
+        self._future = future
+        self.pixel_format = pixel_format
+
+    @property
+    def ready(self) -> bool:
+        return self._future.done()
+
+    def detect(self, image, roi=None, pixel_format=None):
+        return self._future.result().detect(image, roi, self.pixel_format if pixel_format == None else pixel_format)
+
+    def __getattr__(self, name):
+        return getattr(self._future.result(), name)
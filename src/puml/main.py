@@ -1,13 +1,32 @@
 '''
+Create a PlantUML sequence diagram from the cat flap logs
+
+The live log and all its rotated siblings - catflap_<date>_<time>.log, gzipped or
+not - are read in one pass each and merged in time order. Only the PUML lines are
+parsed, with patterns compiled once.
+
+With --incremental the byte offset reached in the live log and the last timestamp
+are kept next to the diagram, in <outputfile>.state. The next run appends only the
+new transitions to the existing diagram, reading the live log from that offset and
+skipping rotated logs that are older than the last transition.
+
+A log of several cameras has [name] before each of their lines. --camera picks the
+camera the diagram is drawn for, without it only the lines without a camera are
+used - the log of a single camera.
+
 TODO
 
-DONE 
+DONE
 Log this - nullState -> idleState: Startup
 Log cat flap lock-unlock messages
 '''
 
 import time
 import argparse
+import glob
+import gzip
+import heapq
+import json
 import re
 
 from datetime import datetime, timedelta
@@ -17,11 +36,28 @@ import sys, os
 # from base_logger import logger
 
 
+# 2023-11-13 08:43:27,787 states(131):INFO PUML newpage
+LOG_LINE = re.compile(r"(\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d),(\d\d\d) (\w+)\((\d+)\):(\w+?) (.+)")
+TRANSITION = re.compile(r"PUML (\w+) -+> (\w+): (.+)")
+# 2023-11-13 08:43:27,787 states(131):INFO [flap2] PUML idleState -> triggeringState: triggering
+CAMERA_TAG = re.compile(r"\[([^\]]+)\] (.*)")
+PUML_MARK = b"PUML "
+
+
 def process_line(l:str):
-    match = re.search("(\d\d\d\d-\d\d-\d\d) (\d\d:\d\d:\d\d,\d\d\d) (\w+)\((\d+)\):(\w+?) (.+)", l)
-    ldate, ltime, lfname, lline, llevel, lmessage = (match.group(1), match.group(2), match.group(3), match.group(4), match.group(5), match.group(6))  #
-    ltimestamp = datetime.strptime(f"{ldate} {ltime}", '%Y-%m-%d %H:%M:%S,%f')
-    return ltimestamp, lmessage
+    match = LOG_LINE.match(l)
+    if match == None:
+        return None, None
+    stamp, ms, _, _, _, message = match.groups()
+    return datetime.fromisoformat(f"{stamp}.{ms}"), message
+
+
+def split_camera(message:str) -> tuple:
+    '''The camera a message is for, or None, and the message without it'''
+    match = CAMERA_TAG.match(message)
+    if match == None:
+        return None, message
+    return match.group(1), match.group(2)
 
 
 def timestring(dtime: datetime) -> str:
@@ -61,77 +97,210 @@ def timestring(dtime: datetime) -> str:
         retval = f""
     return retval
 
-def process_log(inputfile: str, outputfile: str) -> bool:
-    print(f"Processing {inputfile}")
 
+class LogReader():
+    '''The PUML lines of one log file for one camera as (timestamp, message), read from
+        offset on and only those after the timestamp after, if given. After the lines run
+        out offset is where the next read should start - a last line still being written
+        is left for then'''
+    def __init__(self, filename:str, offset:int=0, after:datetime=None, camera:str=None) -> None:
+        self.filename = filename
+        self.offset = offset
+        self.after = after
+        self.camera = camera
+        self.others = set()     # The other cameras that have lines in the file
+        self.first = None   # Timestamp of the first line of the file
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rb') as f:
+            self.first, _ = process_line(f.readline().decode('utf-8', 'replace'))
 
-    try:
-        out = open(outputfile, 'w')
-        out.write("@startuml\n")
-        out.write("participant nullState\n")
-        out.write("participant idleState\n")
-        out.write("participant unlockedState\n")
-        out.write("participant movementLockedState\n")
-        out.write("participant mouseLockedState\n")
-        out.write("participant flapControl\n")
-
-        with open(inputfile, 'r') as f:
-            # 2023-11-13 08:43:27,787 states(131):INFO PUML newpage
-            lprevious = f.readline()
-            ts, _ = process_line(lprevious)
-            out.write(f"note left of nullState: {ts:%Y-%m-%d %H:%M:%S}\n\n")
-
-            for l in f:
-                if re.search("INFO PUML", l) == None:
+    def __iter__(self):
+        opener = gzip.open if self.filename.endswith('.gz') else open
+        with opener(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            for raw in f:
+                if raw.endswith(b'\n') == False:
+                    break
+                self.offset += len(raw)
+                if PUML_MARK not in raw:
                     continue
-                tprevious, _ = process_line(lprevious)
-                t, msg = process_line(l)
-                dt = t - tprevious
-                lprevious = l
-
-                if dt.microseconds > 100000:
-                    timestr = timestring(dt)
-                    # Pull the states from and to so we can determine the print format
-                    match = re.search("PUML (\w+) -+> (\w+): (.+)", msg)
-                    fromstate, tostate, message = (match.group(1), match.group(2), match.group(3))
-                    # Print the message
-                    if timestr != "":
-                        if fromstate == "idleState" and tostate != "idleState":
-                            # Leaving idle gets formatted as a separator
-                            out.write(f"== {timestr} later ==\n")
-                            out.write(f"note left of nullState: {t:%Y-%m-%d %H:%M:%S}\n\n")
-                        else:
-                            # Other messages as notes
-                            out.write(f"note over {fromstate}: {timestr} later\n")
-                out.write(msg.lstrip("PUML ") + "\n")
-        out.write("@enduml\n")
+                t, msg = process_line(raw.decode('utf-8', 'replace'))
+                if t == None:
+                    continue
+                camera, msg = split_camera(msg)
+                if msg.startswith("PUML ") == False:
+                    continue
+                if camera != self.camera:
+                    self.others.add(camera)
+                    continue
+                if self.after == None or t > self.after:
+                    yield t, msg
+
+
+def log_files(inputfile:str) -> list:
+    '''The log and its rotated siblings'''
+    base, ext = path.splitext(inputfile)
+    pattern = f"{glob.escape(base)}_*{ext}"
+    names = glob.glob(pattern) + glob.glob(pattern + '.gz')
+    if path.isfile(inputfile):
+        names.append(inputfile)
+    return names
+
+
+def rotation_time(filename:str) -> datetime:
+    '''When a rotated log was rotated, from its name - everything in it is older'''
+    match = re.search(r"_(\d{4}-\d\d-\d\d_\d\d-\d\d-\d\d)(-\d+)?\.", path.basename(filename))
+    return datetime.strptime(match.group(1), "%Y-%m-%d_%H-%M-%S") if match != None else None
+
+
+class PumlWriter():
+    '''Turns the transitions into PlantUML, written as utf-8 to a binary file so the
+        position of the end can be kept for appending'''
+    def __init__(self, out, previous:datetime=None) -> None:
+        self._out = out
+        self.previous = previous
+
+    def write(self, text:str) -> None:
+        self._out.write(text.encode('utf-8'))
+
+    def header(self, ts:datetime) -> None:
+        self.write("@startuml\n")
+        for p in ("nullState", "idleState", "unlockedState", "movementLockedState", "mouseLockedState", "flapControl"):
+            self.write(f"participant {p}\n")
+        self.write(f"note left of nullState: {ts:%Y-%m-%d %H:%M:%S}\n\n")
+        self.previous = ts
+
+    def add(self, t:datetime, msg:str) -> None:
+        dt = t - self.previous
+        self.previous = t
+
+        if dt.microseconds > 100000:
+            timestr = timestring(dt)
+            # Pull the states from and to so we can determine the print format
+            match = TRANSITION.search(msg)
+            # Print the message
+            if timestr != "" and match != None:
+                fromstate, tostate = match.group(1), match.group(2)
+                if fromstate == "idleState" and tostate != "idleState":
+                    # Leaving idle gets formatted as a separator
+                    self.write(f"== {timestr} later ==\n")
+                    self.write(f"note left of nullState: {t:%Y-%m-%d %H:%M:%S}\n\n")
+                else:
+                    # Other messages as notes
+                    self.write(f"note over {fromstate}: {timestr} later\n")
+        self.write(msg.lstrip("PUML ") + "\n")
+
+    def footer(self) -> int:
+        '''Ends the diagram, returns where the footer starts'''
+        end = self._out.tell()
+        self.write("@enduml\n")
+        return end
+
+
+def process_log(inputfile: str, outputfile: str, incremental:bool=False, camera:str=None) -> bool:
+    '''Writes the diagram of the log and its rotated logs, for the camera - None for the
+        lines without one. Incremental appends what is new since the last incremental
+        run, if there was one. Returns True if there was anything to do'''
+    statefile = outputfile + '.state'
+    state = None
+    if incremental == True and path.isfile(statefile) and path.isfile(outputfile):
+        with open(statefile) as f:
+            state = json.load(f)
+        if state.get('camera') != camera:
+            # The diagram is of another camera, start again
+            state = None
+    start = time.perf_counter()
+
+    readers = []
+    if state == None:
+        print(f"Processing {inputfile} and its rotated logs")
+        names = log_files(inputfile)
+    else:
+        # Rotated logs older than the last transition were read already, and so was
+        # the live log up to the offset - unless it was rotated since
+        last = datetime.fromisoformat(state['last'])
+        names = [n for n in log_files(inputfile) if rotation_time(n) == None or rotation_time(n) >= last.replace(microsecond=0)]
+        print(f"Appending to {outputfile} from {len(names)} logs")
+    for name in names:
+        reader = LogReader(name, camera=camera)
+        if reader.first == None:
+            continue
+        if state != None:
+            # The inode of a rotated log can be reused for the new one, so its first line is checked too
+            if name == inputfile and os.stat(name).st_ino == state['inode'] and reader.first.isoformat() == state['first'] \
+                    and os.path.getsize(name) >= state['offset']:
+                reader.offset = state['offset']
+            else:
+                # Rotated since, parts of it may have been read already
+                reader.after = last
+        readers.append(reader)
+    if len(readers) == 0:
+        return False
+    readers.sort(key=lambda r: r.first)
+
+    merged = heapq.merge(*readers, key=lambda x: x[0])
+    count = 0
+    out = open(outputfile, 'wb' if state == None else 'r+b')
+    try:
+        if state == None:
+            writer = PumlWriter(out)
+            writer.header(readers[0].first)
+        else:
+            # Take the footer off and carry on from the last transition
+            out.seek(state['end'])
+            out.truncate()
+            writer = PumlWriter(out, last)
+        for t, msg in merged:
+            writer.add(t, msg)
+            count += 1
+        end = writer.footer()
     except Exception as e:
         print(f"Crash - \n{e}")
+        return False
     finally:
         out.close()
 
-    return False
+    print(f"{count} transitions from {len(readers)} logs in {time.perf_counter() - start:.2f}s")
+    others = set().union(*(r.others for r in readers))
+    if len(others) > 0:
+        print("Left out the transitions of " + ", ".join(c if c != None else "no camera" for c in sorted(others, key=str))
+              + " - pick one with --camera")
+    if incremental == True:
+        live = [r for r in readers if r.filename == inputfile]
+        with open(statefile, 'w') as f:
+            json.dump({'last': writer.previous.isoformat(), 'end': end, 'camera': camera,
+                       'inode': os.stat(inputfile).st_ino if len(live) > 0 else None,
+                       'first': live[0].first.isoformat() if len(live) > 0 else None,
+                       'offset': live[0].offset if len(live) > 0 else 0}, f)
+    return True
 
 
 
-def main(): 
+def main():
     parser = argparse.ArgumentParser(description="PUML - Create a Plant UML representation from a log")
-    parser.add_argument('--inputfile', 
-        help="The log to read",
+    parser.add_argument('--inputfile',
+        help="The log to read, its rotated logs are read as well",
         default='./log/catflap.log',
         required=False,
         type=str, action='store',)
-    parser.add_argument('--outputfile', 
+    parser.add_argument('--outputfile',
         help="The PUML file to write",
         default='./log/catflap.puml',
         required=False,
         type=str, action='store',)
-    
+    parser.add_argument('--incremental',
+        help="Append only what is new since the last incremental run",
+        action='store_true',)
+    parser.add_argument('--camera',
+        help="With several cameras in the log, the one to draw - by default the lines without a camera",
+        required=False,
+        type=str, action='store',)
+
     args = parser.parse_args()
-    if os.path.isfile(args.inputfile) == True:
-        process_log(args.inputfile, args.outputfile)
+    if len(log_files(args.inputfile)) > 0:
+        process_log(args.inputfile, args.outputfile, args.incremental, args.camera)
+
 
-  
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,14 +1,206 @@
-from flask import Flask, render_template
-from flask_socketio import SocketIO
+from flask import Flask, render_template, Response
+from flask_socketio import SocketIO, emit
 from collections import deque
+from threading import Lock, Condition
 import base64
+import os
+import time
 
 app = Flask(__name__)
 socketio = SocketIO(app)
 log_file_name = None
+log_tail = None
+tail_started = False
+tail_lock = Lock()
 
-# Initialize deque to store the last 20 lines
-log_buffer = deque(maxlen=20)
+
+class ViewerQueue():
+    '''A small bounded queue of JPEG frames for one viewer. When the viewer is too
+    slow the oldest frame is skipped, the viewer always gets the newest frames'''
+    def __init__(self, depth=2):
+        self._frames = deque(maxlen=depth)
+        self._lock = Condition()
+        self.started = time.monotonic()
+        self.sent = 0
+        self.skipped = 0
+
+    def put(self, frame):
+        with self._lock:
+            if len(self._frames) == self._frames.maxlen:
+                self.skipped += 1
+            self._frames.append(frame)
+            self._lock.notify()
+
+    def get(self, timeout=None):
+        '''The next frame, or None after the timeout'''
+        with self._lock:
+            if len(self._frames) == 0:
+                self._lock.wait(timeout)
+            if len(self._frames) == 0:
+                return None
+            self.sent += 1
+            return self._frames.popleft()
+
+    @property
+    def fps(self):
+        return self.sent / max(time.monotonic() - self.started, 1e-3)
+
+
+class FrameHub():
+    '''Fans each incoming frame out to the queues of all the viewers. Publishing
+    only appends a reference to the same bytes to each queue, it never waits
+    for a viewer'''
+    def __init__(self, depth=2):
+        self._depth = depth
+        self._viewers = set()
+        self._lock = Lock()
+
+    def subscribe(self):
+        viewer = ViewerQueue(self._depth)
+        with self._lock:
+            self._viewers.add(viewer)
+        return viewer
+
+    def unsubscribe(self, viewer):
+        with self._lock:
+            self._viewers.discard(viewer)
+
+    def publish(self, frame):
+        with self._lock:
+            viewers = list(self._viewers)
+        for v in viewers:
+            v.put(frame)
+
+    @property
+    def viewers(self):
+        with self._lock:
+            return list(self._viewers)
+
+
+frame_hub = FrameHub()
+
+
+class MetricsStore():
+    '''Adds up the metrics changes sent by the catflap process, and shows them in
+    the Prometheus text format. Counters are the totals since the website started,
+    each counter also gets a per second rate over the last update'''
+    def __init__(self, prefix='catflap_'):
+        self._prefix = prefix
+        self._counters = {}
+        self._rates = {}
+        self._gauges = {}
+        self._updated = None
+        self._lock = Lock()
+
+    def update(self, delta):
+        interval = max(float(delta.get('interval', 0)), 1e-3)
+        with self._lock:
+            for key, value in delta.get('counters', {}).items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            # A counter that did not change is not sent, so its rate is now zero
+            self._rates = {key: value / interval for key, value in delta.get('counters', {}).items()}
+            self._rates.update({key: 0 for key in self._counters if key not in self._rates})
+            self._gauges.update(delta.get('gauges', {}))
+            self._updated = time.time()
+
+    @staticmethod
+    def _rename(key, suffix):
+        '''Add the suffix to the name part of name{labels}'''
+        name, brace, labels = key.partition('{')
+        return name + suffix + brace + labels
+
+    def render(self):
+        with self._lock:
+            series = [(self._rename(k, '_total'), v, 'counter') for k, v in self._counters.items()] + \
+                     [(self._rename(k, '_per_second'), v, 'gauge') for k, v in self._rates.items()] + \
+                     [(k, v, 'gauge') for k, v in self._gauges.items()]
+            if self._updated != None:
+                series.append(('last_update_seconds', self._updated, 'gauge'))
+        lines = []
+        typed = set()
+        for key, value, kind in sorted(series):
+            name = self._prefix + key.partition('{')[0]
+            if name not in typed:
+                lines.append(f'# TYPE {name} {kind}')
+                typed.add(name)
+            lines.append(f'{self._prefix}{key} {value:.6g}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics_store = MetricsStore()
+
+
+class LogTail():
+    '''Follows the log file like tail -f. Only the end of the file is ever read - the
+    last lines by reading blocks backwards from the end, after that only what was
+    appended since the last poll, once for all the clients. A different file under
+    the name, or a shorter one, means the log was rotated, and is read from the start'''
+    def __init__(self, file_name, lines=20, block=8192):
+        self._file_name = file_name
+        self._lines = deque(maxlen=lines)
+        self._block = block
+        self._lock = Lock()
+        self._inode = None
+        self._position = 0
+        self._partial = b''
+
+    def last_lines(self):
+        with self._lock:
+            return list(self._lines)
+
+    def _read(self, f, start, end):
+        '''The bytes from start to end - or when that is more than the lines kept, only
+            enough blocks from the end for them. Also returns whether start was reached'''
+        data = []
+        newlines = 0
+        position = end
+        while position > start and newlines <= self._lines.maxlen:
+            block = max(position - self._block, start)
+            f.seek(block)
+            chunk = f.read(position - block)
+            newlines += chunk.count(b'\n')
+            data.insert(0, chunk)
+            position = block
+        return b''.join(data), position == start
+
+    def poll(self):
+        '''The complete lines added since the last poll'''
+        with self._lock:
+            try:
+                f = open(self._file_name, 'rb')
+            except OSError:
+                # In the middle of being rotated
+                return []
+            with f:
+                info = os.fstat(f.fileno())
+                if info.st_ino != self._inode or info.st_size < self._position:
+                    self._inode = info.st_ino
+                    self._position = 0
+                    self._partial = b''
+                if info.st_size == self._position:
+                    return []
+                data, whole = self._read(f, self._position, info.st_size)
+            self._position = info.st_size
+            lines = data.split(b'\n')
+            if whole == True:
+                lines[0] = self._partial + lines[0]
+            else:
+                # Cut off in the middle of a line
+                lines.pop(0)
+            # A line still being written is finished on the next poll
+            self._partial = lines.pop()
+            new = [l.decode('utf-8', 'replace').rstrip('\r') for l in lines[-self._lines.maxlen:]]
+            self._lines.extend(new)
+            return new
+
+
+def tail_log(interval=1.0):
+    '''Pushes the new lines of the log to all the clients'''
+    while True:
+        lines = log_tail.poll()
+        if len(lines) > 0:
+            socketio.emit('new_lines', {'lines': lines})
+        socketio.sleep(interval)
 
 @app.route('/')
 def index():
@@ -17,39 +209,53 @@ def index():
 @app.route('/log')
 def index_log():
     # Get initial log data
-    log_data = '\n'.join(log_buffer)
+    log_data = '\n'.join(log_tail.last_lines())
     return render_template('index_log.html', log_data=log_data)
 
 @app.route('/stream')
 def index_image():
     return render_template('index_image.html')
 
+@app.route('/video_feed')
+def video_feed():
+    '''MJPEG stream of the camera - every viewer reads from its own queue'''
+    def generate(viewer):
+        try:
+            while True:
+                frame = viewer.get(timeout=5)
+                if frame == None:
+                    continue
+                yield b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(frame)).encode() + b'\r\n\r\n' + frame + b'\r\n'
+        finally:
+            frame_hub.unsubscribe(viewer)
+    return Response(generate(frame_hub.subscribe()), mimetype='multipart/x-mixed-replace; boundary=frame')
 
-@socketio.on('update_list')
-def update_list():
-    # Get the latest log data
-    log_data = get_last_lines_from_log(20)
-    socketio.emit('new_element', {'element': log_data})
+@app.route('/viewers')
+def viewers():
+    '''Frames per second and skipped frames for each connected viewer'''
+    return {'viewers': [{'fps': round(v.fps, 2), 'sent': v.sent, 'skipped': v.skipped} for v in frame_hub.viewers]}
 
-def get_last_lines_from_log(num_lines):
-    try:
-        # Read the entire log file and split it into lines
-        with open(log_file_name, 'r') as log_file:
-            lines = log_file.readlines()
+@app.route('/metrics')
+def metrics():
+    '''Counters and gauges from the catflap process, in the Prometheus text format'''
+    return Response(metrics_store.render(), mimetype='text/plain; version=0.0.4')
 
-        # Update the log buffer with the latest lines
-        log_buffer.extend(lines[-num_lines:])
 
-        # Return the latest log data
-        return ''.join(lines[-num_lines:])
-    except Exception as e:
-        print(f"Error reading log file: {e}")
-        return "Error reading log file"
+@socketio.on('update_list')
+def update_list():
+    '''The last lines, to the client that asked - after that it gets new_lines pushed'''
+    emit('new_element', {'element': '\n'.join(log_tail.last_lines())})
 
 
 @socketio.on('connect')
 def handle_connect():
+    global tail_started
     print('Client connected')
+    # One tail for all the clients, started with the first one
+    with tail_lock:
+        if tail_started == False:
+            tail_started = True
+            socketio.start_background_task(tail_log)
 
 @socketio.on('disconnect')
 def handle_disconnect():
@@ -57,18 +263,27 @@ def handle_disconnect():
 
 @socketio.on('image_data')
 def handle_image(data):
+    '''Base64 JPEG frames - decoded once here, not once per viewer'''
     try:
-        # Save the image to a file (optional)
-        # Decode base64 image data
-        # image_data = base64.b64decode(data['image'])
-        # with open('received_image.png', 'wb') as f:
-        #    f.write(image_data)
+        frame_hub.publish(base64.b64decode(data['image']))
+    except Exception as e:
+        print(f"Error handling image data: {e}")
 
-        # Broadcast the image to all clients
-        socketio.emit('display_image', {'image': data['image']})
+@socketio.on('image_frame')
+def handle_image_frame(data):
+    '''Binary JPEG frames from the catflap WebPublisher'''
+    try:
+        frame_hub.publish(bytes(data))
+    except Exception as e:
+        print(f"Error handling image frame: {e}")
 
+@socketio.on('metrics')
+def handle_metrics(data):
+    '''Metrics changes from the catflap process, a few seconds worth at a time'''
+    try:
+        metrics_store.update(data)
     except Exception as e:
-        print(f"Error handling image data: {e}")
+        print(f"Error handling metrics: {e}")
 
 
 if __name__ == '__main__':
@@ -82,6 +297,8 @@ if __name__ == '__main__':
             log_file_name = l
             break
     assert log_file_name != None, print("Error: Could not find a log file to tail")
+    log_tail = LogTail(log_file_name)
+    log_tail.poll()
 
     # Go, go, go!
     socketio.run(app, host='0.0.0.0', debug=True)
@@ -0,0 +1,94 @@
+'''Load test for the monitoring website. Streams a video to the server like
+videotest.py does, opens many MJPEG viewers on /video_feed, and reports the
+frames per second each viewer got and the CPU the server used.
+
+python loadtest.py --video clip.mp4 --viewers 30 --server_pid $(pgrep -f app.py)
+'''
+import argparse
+import os
+import threading
+import time
+import urllib.request
+import socketio
+
+from videotest import send_frames
+
+
+def server_cpu_seconds(pid):
+    '''User + system CPU seconds used by a process so far, Linux only'''
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class Viewer(threading.Thread):
+    '''Reads the multipart MJPEG stream and counts the frames'''
+    def __init__(self, url, stop, slow=0):
+        super(Viewer, self).__init__(daemon=True)
+        self.url = url
+        self.stop = stop
+        self.slow = slow
+        self.frames = 0
+        self.error = None
+
+    def run(self):
+        try:
+            with urllib.request.urlopen(self.url, timeout=10) as stream:
+                while self.stop.is_set() == False:
+                    line = stream.readline()
+                    if line == b'':
+                        break
+                    if line.lower().startswith(b'content-length:'):
+                        length = int(line.split(b':')[1])
+                        stream.readline()
+                        stream.read(length)
+                        self.frames += 1
+                        if self.slow > 0:
+                            time.sleep(self.slow)
+        except Exception as e:
+            self.error = e
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the monitoring website")
+    parser.add_argument('--url', help="The website", default='http://localhost:5000', type=str)
+    parser.add_argument('--video', help="Video to stream to the website", required=True, type=str)
+    parser.add_argument('--viewers', help="Number of MJPEG viewers", default=30, type=int)
+    parser.add_argument('--slow_viewers', help="How many of the viewers read slowly", default=0, type=int)
+    parser.add_argument('--duration', help="Seconds to run the test", default=30, type=float)
+    parser.add_argument('--fps', help="Frames per second sent to the website", default=10, type=float)
+    parser.add_argument('--binary', help="Send binary frames instead of base64", action='store_true')
+    parser.add_argument('--server_pid', help="PID of the website process, to measure its CPU", type=int)
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    sio = socketio.Client()
+    sio.connect(args.url)
+    sender = threading.Thread(target=send_frames, args=(sio, args.video, 1.0 / args.fps, args.binary, True, stop), daemon=True)
+    sender.start()
+
+    viewers = [Viewer(f"{args.url}/video_feed", stop, slow=0.5 if i < args.slow_viewers else 0) for i in range(args.viewers)]
+    for v in viewers:
+        v.start()
+
+    cpu_start = server_cpu_seconds(args.server_pid) if args.server_pid != None else None
+    start = time.monotonic()
+    time.sleep(args.duration)
+    elapsed = time.monotonic() - start
+    cpu = server_cpu_seconds(args.server_pid) - cpu_start if cpu_start != None else None
+    stop.set()
+    sender.join()
+    sio.disconnect()
+
+    fps = sorted(v.frames / elapsed for v in viewers)
+    errors = [v.error for v in viewers if v.error != None]
+    print(f"{len(viewers)} viewers for {elapsed:.1f}s, sending {args.fps} fps")
+    print(f"per viewer fps min {fps[0]:.1f} median {fps[len(fps) // 2]:.1f} max {fps[-1]:.1f}")
+    if cpu != None:
+        print(f"server CPU {cpu:.2f}s, {cpu / elapsed * 100:.1f}% of a core")
+    if len(errors) > 0:
+        print(f"{len(errors)} viewers failed, first error {errors[0]}")
+
+
+if __name__ == '__main__':
+    main()
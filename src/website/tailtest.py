@@ -0,0 +1,95 @@
+'''Load test for the log tail of the monitoring website. Connects many log page
+clients, keeps appending lines to the log the website tails, grows the log in
+steps, and reports the server CPU at each size - it should not grow with the log.
+Rotates the log at the end and checks the clients still get new lines.
+
+python tailtest.py --log /log/catflap.log --clients 20 --server_pid $(pgrep -f app.py)
+'''
+import argparse
+import os
+import threading
+import time
+import socketio
+
+from loadtest import server_cpu_seconds
+
+
+class LogClient():
+    '''A log page - counts the lines pushed to it'''
+    def __init__(self, url):
+        self.lines = 0
+        self.snapshot = None
+        self._sio = socketio.Client()
+        self._sio.on('new_element', self._new_element)
+        self._sio.on('new_lines', self._new_lines)
+        self._sio.connect(url)
+        self._sio.emit('update_list')
+
+    def _new_element(self, data):
+        self.snapshot = data['element']
+
+    def _new_lines(self, data):
+        self.lines += len(data['lines'])
+
+    def disconnect(self):
+        self._sio.disconnect()
+
+
+def write_lines(log, count, rate, stop):
+    '''Appends count lines a second, like the cat flap does'''
+    n = 0
+    while stop.is_set() == False:
+        with open(log, 'a') as f:
+            for _ in range(count):
+                f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')},000 tailtest(1):INFO line {n}\n")
+                n += 1
+        time.sleep(1.0 / rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the website log tail")
+    parser.add_argument('--url', help="The website", default='http://localhost:5000', type=str)
+    parser.add_argument('--log', help="The log file the website tails", required=True, type=str)
+    parser.add_argument('--clients', help="Number of log page clients", default=20, type=int)
+    parser.add_argument('--sizes', help="Log sizes in MB to measure at", default='1,50,200', type=str)
+    parser.add_argument('--duration', help="Seconds to measure at each size", default=10, type=float)
+    parser.add_argument('--server_pid', help="PID of the website process, to measure its CPU", type=int)
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    clients = [LogClient(args.url) for _ in range(args.clients)]
+    writer = threading.Thread(target=write_lines, args=(args.log, 5, 2, stop), daemon=True)
+    writer.start()
+
+    padding = ('x' * 199 + '\n') * 5000
+    for size in [float(s) for s in args.sizes.split(',')]:
+        # Grow the log to the size - the tail only reads the end of it, in one go
+        with open(args.log, 'a') as f:
+            while f.tell() < size * 1024 * 1024:
+                f.write(padding)
+        time.sleep(2)
+        cpu_start = server_cpu_seconds(args.server_pid) if args.server_pid != None else None
+        received = sum(c.lines for c in clients)
+        start = time.monotonic()
+        time.sleep(args.duration)
+        elapsed = time.monotonic() - start
+        lines = (sum(c.lines for c in clients) - received) / len(clients) / elapsed
+        cpu = f", server CPU {(server_cpu_seconds(args.server_pid) - cpu_start) / elapsed * 100:.1f}% of a core" if cpu_start != None else ""
+        print(f"log {os.path.getsize(args.log) / 1024 / 1024:.0f}MB: {lines:.1f} lines/s per client{cpu}")
+
+    # Rotate - the clients should carry on getting lines from the new file
+    os.rename(args.log, args.log + '.rotated')
+    received = sum(c.lines for c in clients)
+    time.sleep(3)
+    rotated = sum(c.lines for c in clients) - received
+    stop.set()
+    writer.join()
+    for c in clients:
+        c.disconnect()
+    os.remove(args.log + '.rotated')
+    print(f"after rotating {rotated / len(clients):.0f} lines per client, {sum(1 for c in clients if c.snapshot == None)} clients got no snapshot")
+    print("PASS" if rotated > 0 else "FAIL")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,46 +3,55 @@ import base64
 import socketio
 import time
 
-# Create a SocketIO client
-sio = socketio.Client()
-
-# Connect to the Flask-SocketIO server
-sio.connect('http://localhost:5000')  # Adjust the URL to match your server
-
 # Video file path
 video_file_path = '/Users/toby/work/projects/catflap/data/incoming/Cat-with-mouse/20230310/20221014-011509_catcam.mp4'
 
 # Function to send frames to the server
-def send_frames():
-    cap = cv2.VideoCapture(video_file_path)
-
-    while cap.isOpened():
-        ret, frame = cap.read()
-
-        if not ret:
+def send_frames(sio, video_file_path=video_file_path, delay=0.1, binary=False, loop=False, stop=None):
+    '''Send the frames of a video to the server. base64 'image_data' messages like the
+    old catflap, or binary 'image_frame' messages like the WebPublisher. Sends until the
+    video ends, or with loop until the stop event is set'''
+    while True:
+        cap = cv2.VideoCapture(video_file_path)
+
+        while cap.isOpened() and (stop == None or stop.is_set() == False):
+            ret, frame = cap.read()
+
+            if not ret:
+                break
+
+            # Convert the frame to JPEG format
+            _, buffer = cv2.imencode('.jpg', frame)
+            if binary == True:
+                sio.emit('image_frame', buffer.tobytes())
+            else:
+                jpeg_bytes = base64.b64encode(buffer.tobytes()).decode('utf-8')
+
+                # print("Emitting image data " + jpeg_bytes)
+                # Send the frame to the server
+                sio.emit('image_data', {'image': jpeg_bytes})
+
+            # Delay to simulate real-time streaming (adjust as needed)
+            time.sleep(delay)
+
+        cap.release()
+        if loop == False or (stop != None and stop.is_set() == True):
             break
 
-        # Convert the frame to JPEG format
-        _, buffer = cv2.imencode('.jpg', frame)
-        jpeg_bytes = base64.b64encode(buffer.tobytes()).decode('utf-8')
-
-        # print("Emitting image data " + jpeg_bytes)
-        # Send the frame to the server
-        sio.emit('image_data', {'image': jpeg_bytes})
-
-        # Delay to simulate real-time streaming (adjust as needed)
-        time.sleep(0.1)
+if __name__ == '__main__':
+    # Create a SocketIO client
+    sio = socketio.Client()
 
-    cap.release()
+    # Event handler for disconnect event
+    @sio.event
+    def disconnect():
+        print('Disconnected from server')
 
-# Event handler for disconnect event
-@sio.event
-def disconnect():
-    print('Disconnected from server')
+    # Connect to the Flask-SocketIO server
+    sio.connect('http://localhost:5000')  # Adjust the URL to match your server
 
-if __name__ == '__main__':
     try:
-        send_frames()
+        send_frames(sio)
     except KeyboardInterrupt:
         print('User interrupted the script')
     finally:
@@ -0,0 +1,7 @@
+import sys
+from os import path
+
+# The cat flap modules are flat, run from src/catflap with src/modules on the path
+here = path.dirname(path.abspath(__file__))
+for d in ('catflap', 'modules'):
+    sys.path.insert(0, path.join(here, '..', 'src', d))
@@ -0,0 +1,59 @@
+import threading
+import time
+import numpy as np
+
+import videorecorder
+from videorecorder import ClipRecorder, VideoRecorder
+
+
+def test_frames_in_flight_stay_in_their_episode(tmp_path, monkeypatch):
+    go = threading.Event()
+    encode = videorecorder.cv.imencode
+    def slow_encode(*args, **kwargs):
+        go.wait(5)
+        return encode(*args, **kwargs)
+    monkeypatch.setattr(videorecorder.cv, 'imencode', slow_encode)
+    clips = []
+    def write_clip(self, frames, fps, start=None):
+        clips.append(len(list(frames)))
+        return clips[-1]
+    monkeypatch.setattr(VideoRecorder, 'write_clip', write_clip)
+
+    recorder = ClipRecorder(str(tmp_path), preroll=60, buffers=4)
+    recorder.start_episode()
+    for _ in range(3):
+        assert recorder.add_frame(np.zeros((32, 32, 3), np.uint8)) == True
+    # All three are still waiting to be compressed when the episode ends
+    recorder.end_episode()
+    go.set()
+    while recorder._free.qsize() < 4:
+        time.sleep(0.01)
+    recorder.start_episode()
+    for _ in range(2):
+        recorder.add_frame(np.zeros((32, 32, 3), np.uint8))
+    recorder.close()
+    assert clips == [3, 2]
+
+
+def test_writer_keeps_going_after_a_failed_clip(tmp_path, monkeypatch):
+    # The first clip finds no directory to go to, the next one does
+    attempts = []
+    init = VideoRecorder.__init__
+    def counting_init(self, *args, **kwargs):
+        attempts.append(args)
+        init(self, *args, **kwargs)
+    monkeypatch.setattr(VideoRecorder, '__init__', counting_init)
+    recorder = ClipRecorder(str(tmp_path / 'clips'), preroll=60)
+    for episode in range(2):
+        recorder.start_episode()
+        for _ in range(2):
+            recorder.add_frame(np.zeros((32, 32, 3), np.uint8))
+            time.sleep(0.1)
+        recorder.end_episode()
+        for _ in range(500):
+            if len(attempts) > episode:
+                break
+            time.sleep(0.01)
+        (tmp_path / 'clips').mkdir(exist_ok=True)
+    recorder.close()
+    assert len(list((tmp_path / 'clips').glob('*_catcam.mp4'))) == 1
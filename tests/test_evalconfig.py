@@ -0,0 +1,44 @@
+import json
+import shutil
+from os import path
+
+from evalconfig import ConfigStore
+from statetypes import CatDetection
+
+HERE = path.join(path.dirname(path.abspath(__file__)), '..', 'src', 'catflap')
+
+
+def write(name, config) -> None:
+    with open(name, 'w') as j:
+        json.dump(config, j)
+
+
+def store_in(tmp_path, eval_config) -> ConfigStore:
+    for name in ('labels.json', 'trigger_config.json'):
+        shutil.copy(path.join(HERE, name), tmp_path / name)
+    write(tmp_path / 'eval_config.json', eval_config)
+    return ConfigStore(str(tmp_path / 'labels.json'), str(tmp_path / 'trigger_config.json'),
+                       str(tmp_path / 'eval_config.json'), CatDetection)
+
+
+def with_unknown_label() -> dict:
+    with open(path.join(HERE, 'eval_config.json')) as j:
+        config = json.load(j)
+    config['thresholds'].append({'label': 'Fox', 'values': {'min_result_count': 2, 'average_threshold': 0.5}})
+    return config
+
+
+def test_unknown_label_is_ignored_at_startup(tmp_path, caplog):
+    store = store_in(tmp_path, with_unknown_label())
+    assert store.current.version == 1
+    assert 'Fox' not in store.current.eval.slot
+    assert 'threshold for unknown label Fox, ignored' in caplog.text
+
+
+def test_unknown_label_is_rejected_on_reload(tmp_path):
+    with open(path.join(HERE, 'eval_config.json')) as j:
+        store = store_in(tmp_path, json.load(j))
+    write(tmp_path / 'eval_config.json', with_unknown_label())
+    assert store.reload() == False
+    assert store.current.version == 1
+    assert store.failures == 1
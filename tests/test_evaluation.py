@@ -0,0 +1,138 @@
+'''Evaluation and VectorEvaluation must decide as the evaluation before them did,
+record for record. Streams recorded with threshold_sweep.py are checked too when
+CATFLAP_DETECTION_CACHE is the directory of its cache.'''
+import json
+import os
+from os import path
+
+import numpy as np
+import pytest
+
+import baseline_evaluation
+from evaluation import Evaluation, ThresholdTable, VectorEvaluation, recorded_streams, synthetic_streams
+from statetypes import CatDetection
+
+HERE = path.join(path.dirname(path.abspath(__file__)), '..', 'src', 'catflap')
+CONFIGS = ('trigger_config.json', 'eval_config.json')
+DECIDED = (CatDetection.CAT_ALONE, CatDetection.CAT_WITH_MOUSE)
+
+
+def load(name:str):
+    with open(path.join(HERE, name)) as j:
+        return json.load(j)
+
+
+def mismatches(labels:list, config:dict, frames:list) -> int:
+    '''Records that any of the ways of evaluating the stream gets a different result
+        for than the baseline'''
+    flat = [r for f in frames for r in f]
+    # The baseline adds 'Undecided' to the list it is given
+    reference = baseline_evaluation.Evaluation(list(labels), config, CatDetection)
+    expected = [reference.add_record(l, s) for l, s in flat]
+
+    legacy = Evaluation(labels, config, CatDetection)
+    one = VectorEvaluation(labels, config, CatDetection)
+    framed = VectorEvaluation(labels, config, CatDetection)
+    by_frame = []
+    for f in frames:
+        by_frame += framed.add_records([l for l, _ in f], [s for _, s in f])
+    whole = VectorEvaluation(labels, config, CatDetection).add_records([l for l, _ in flat], [s for _, s in flat])
+    candidates = [[legacy.add_record(l, s) for l, s in flat], [one.add_record(l, s) for l, s in flat], by_frame, whole]
+
+    # Stopping at the first decision and carrying on one at a time gives the same too
+    if any(r in DECIDED for r in expected):
+        early = VectorEvaluation(labels, config, CatDetection)
+        results = early.add_records([l for l, _ in flat], [s for _, s in flat], until=DECIDED)
+        candidates.append(results + [early.add_record(l, s) for l, s in flat[len(results):]])
+
+    return sum(sum(1 for a, b in zip(expected, results) if a != b) + abs(len(expected) - len(results))
+               for results in candidates)
+
+
+def boundary_streams(count:int, config:dict, seed:int=1) -> list:
+    '''Streams of the configured labels with scores on and next to their thresholds, so
+        the averages often land exactly on one - where a change of >= or of the order
+        of the sums shows. Half step in 1/256 as the model's scores do, half in tenths,
+        which are not exact in binary'''
+    rng = np.random.default_rng(seed)
+    thresholds = [(t['label'], t['values']['average_threshold']) for t in config['thresholds']]
+    streams = []
+    for n in range(count):
+        step = 1 / 256 if n % 2 == 0 else 0.1
+        frames = []
+        for _ in range(rng.integers(10, 60)):
+            frame = []
+            for _ in range(rng.integers(1, 3)):
+                label, threshold = thresholds[rng.integers(0, len(thresholds))]
+                frame.append((label, min(1.0, max(0.0, threshold + step * int(rng.integers(-2, 3))))))
+            frames.append(frame)
+        streams.append(frames)
+    return streams
+
+
+@pytest.mark.parametrize('config_name', CONFIGS)
+def test_boundary_streams_match_baseline(config_name):
+    labels = load('labels.json')['labels']
+    config = load(config_name)
+    streams = boundary_streams(200, config)
+    assert sum(mismatches(labels, config, frames) for frames in streams) == 0
+
+
+@pytest.mark.parametrize('config_name', CONFIGS)
+def test_synthetic_streams_match_baseline(config_name):
+    labels = load('labels.json')['labels']
+    config = load(config_name)
+    streams = synthetic_streams(100, labels)
+    assert sum(mismatches(labels, config, frames) for frames in streams) == 0
+
+
+@pytest.mark.parametrize('config_name', CONFIGS)
+def test_recorded_streams_match_baseline(config_name):
+    cache = os.environ.get('CATFLAP_DETECTION_CACHE')
+    if cache == None:
+        pytest.skip("CATFLAP_DETECTION_CACHE is not set")
+    labels = load('labels.json')['labels']
+    config = load(config_name)
+    streams = recorded_streams(cache, labels)
+    assert len(streams) > 0
+    assert sum(mismatches(labels, config, frames) for frames in streams) == 0
+
+
+def test_baseline_decides_on_synthetic_streams():
+    '''The streams are worth comparing on - both decisions are reached'''
+    labels = load('labels.json')['labels']
+    config = load('eval_config.json')
+    seen = set()
+    for frames in synthetic_streams(100, labels):
+        reference = baseline_evaluation.Evaluation(list(labels), config, CatDetection)
+        seen.update(reference.add_record(l, s) for f in frames for l, s in f)
+    assert set(DECIDED) <= seen
+
+
+def loose_config() -> dict:
+    '''What the baseline ran with, though a threshold is for a label the model does not
+        have, one label has two and one value is out of range'''
+    config = load('eval_config.json')
+    config['thresholds'] += [
+        {'label': 'Fox', 'values': {'min_result_count': 2, 'average_threshold': 0.5}},
+        {'label': 'Cat-alone', 'values': {'min_result_count': 2, 'average_threshold': 0.45}},
+        {'label': 'Cat-with-mouse', 'values': {'min_result_count': 0, 'average_threshold': 1.2}},
+    ]
+    return config
+
+
+def test_loose_config_is_used_as_the_baseline_did():
+    labels = load('labels.json')['labels']
+    config = loose_config()
+    table = ThresholdTable(labels, config, CatDetection)
+    assert len(table.ignored) == 5
+    # The model only ever gives its own labels
+    known = {'thresholds': [t for t in config['thresholds'] if t['label'] in labels]}
+    streams = synthetic_streams(50, labels) + boundary_streams(50, known)
+    assert sum(mismatches(labels, config, frames) for frames in streams) == 0
+
+
+def test_loose_config_is_rejected_when_strict():
+    labels = load('labels.json')['labels']
+    with pytest.raises(ValueError, match='unknown label Fox'):
+        ThresholdTable(labels, loose_config(), CatDetection, strict=True)
@@ -0,0 +1,109 @@
+import threading
+import time
+import numpy as np
+
+from framepool import FramePool, idle_loop_allocations
+from inference_executor import InferenceExecutor, InferencePool
+
+
+class BlockingDetector():
+    '''Holds every inference until it is let go'''
+    def __init__(self) -> None:
+        self.started = threading.Event()
+        self.go = threading.Event()
+
+    def detect(self, image, roi=None, pixel_format=None):
+        self.started.set()
+        self.go.wait(5)
+        return []
+
+
+def test_idle_loop_allocates_no_frames():
+    result = idle_loop_allocations(frames=100)
+    assert result['frames'] == 100
+    assert result['frame_sized'] == 0
+
+
+def test_held_buffer_is_not_handed_out():
+    pool = FramePool(2)
+    a = pool.recycle(np.zeros((4, 4, 3), np.uint8))
+    b = pool.recycle(np.zeros((4, 4, 3), np.uint8))
+    pool.hold(a)
+    assert pool.acquire() is b
+    pool.hold(b)
+    pool.hold(b)
+    assert pool.acquire() is None
+    pool.release(b)
+    assert pool.acquire() is None
+    pool.release(b)
+    assert pool.acquire() is b
+    # Frames that are not in the pool are ignored
+    pool.hold(np.zeros(1))
+    pool.release(np.zeros(1))
+    assert pool.held == 1
+
+
+def test_inference_holds_frame_until_released():
+    pool = FramePool(3)
+    frames = [pool.recycle(np.zeros((4, 4, 3), np.uint8)) for _ in range(3)]
+    detector = BlockingDetector()
+    executor = InferenceExecutor(detector, max_pending=1)
+    try:
+        for f in frames:
+            pool.hold(f)
+        running = executor.submit(frames[0], release=pool.release)
+        assert detector.started.wait(5) == True
+        waiting = executor.submit(frames[1], release=pool.release)
+        # Replaced before it ran, so handed back
+        newest = executor.submit(frames[2], release=pool.release)
+        assert waiting.cancelled() == True
+        assert pool.acquire() is frames[1]
+        detector.go.set()
+        newest.result(5)
+        running.result(5)
+        # The newest result is waiting to be taken, the older one was replaced
+        assert pool.held == 1
+        taken = executor.take_latest()
+        assert taken is newest
+        assert pool.held == 1
+        taken.release()
+        assert pool.held == 0
+    finally:
+        executor.shutdown()
+
+
+def test_result_of_discarded_episode_is_released():
+    pool = FramePool(2)
+    frame = pool.recycle(np.zeros((4, 4, 3), np.uint8))
+    detector = BlockingDetector()
+    executor = InferenceExecutor(detector, max_pending=1)
+    try:
+        pool.hold(frame)
+        running = executor.submit(frame, release=pool.release)
+        assert detector.started.wait(5) == True
+        # A new episode starts while the frame is being run
+        executor.discard()
+        detector.go.set()
+        running.result(5)
+        while executor.completed == 0:
+            time.sleep(0.01)
+        assert executor.take_latest() is None
+        assert pool.held == 0
+    finally:
+        detector.go.set()
+        executor.shutdown()
+
+
+def test_result_finishing_after_shutdown_is_released():
+    pool = FramePool(2)
+    frame = pool.recycle(np.zeros((4, 4, 3), np.uint8))
+    detector = BlockingDetector()
+    client = InferencePool([detector]).client('camera')
+    pool.hold(frame)
+    running = client.submit(frame, release=pool.release)
+    assert detector.started.wait(5) == True
+    threading.Timer(0.2, detector.go.set).start()
+    client._pool.shutdown()
+    running.result(5)
+    assert client.take_latest() is None
+    assert pool.held == 0
@@ -0,0 +1,62 @@
+import json
+import tempfile
+from argparse import Namespace
+from os import path
+
+import numpy as np
+
+from replay import FakeCatFlapControl, StubDetector
+from states import CatFlapFSM
+from statetypes import GlobalData, Event, States
+
+HERE = path.join(path.dirname(path.abspath(__file__)), '..', 'src', 'catflap')
+
+
+class CountingDetector(StubDetector):
+    '''Every frame is a cat alone, and the inferences are counted'''
+    def __init__(self, labels:list) -> None:
+        super(CountingDetector, self).__init__('Cat-alone', 0.95, labels)
+        self.calls = 0
+
+    def detect(self, image, roi=None):
+        self.calls += 1
+        return super(CountingDetector, self).detect(image, roi)
+
+
+def locked_state(result_cache:int):
+    '''Global data in movement locked with a fresh evaluation, and its detector'''
+    args = Namespace(trigger='210,180,250,280', headless=True, result_cache=result_cache,
+                     label_json=path.join(HERE, 'labels.json'),
+                     trigger_json=path.join(HERE, 'trigger_config.json'),
+                     eval_json=path.join(HERE, 'eval_config.json'),
+                     record_path=tempfile.mkdtemp(prefix='reuse'))
+    with open(args.label_json) as j:
+        detector = CountingDetector(json.load(j)['labels'])
+    frame = np.random.default_rng(0).integers(0, 255, (480, 640, 3), np.uint8)
+    data = GlobalData(args, event=Event(frame), tflite=detector)
+    fsm = CatFlapFSM(data, FakeCatFlapControl())
+    data.evaluation = data.config.eval.evaluation()
+    return fsm, data, detector
+
+
+def test_repeated_cache_hits_do_not_unlock():
+    fsm, data, detector = locked_state(result_cache=8)
+    frame = data.get_images(1)[0]
+    try:
+        states = [CatFlapFSM.movementLockedState.run(Event(frame), data) for _ in range(20)]
+    finally:
+        fsm.exit()
+    # One inference, reused for every other frame, is one result
+    assert detector.calls == 1
+    assert all(s == States.MOVEMENT_LOCKED for s in states)
+
+
+def test_new_inferences_unlock():
+    fsm, data, detector = locked_state(result_cache=0)
+    frame = data.get_images(1)[0]
+    try:
+        states = [CatFlapFSM.movementLockedState.run(Event(frame), data) for _ in range(20)]
+    finally:
+        fsm.exit()
+    assert detector.calls == 20
+    assert States.UNLOCKED in states